@@ -1,21 +1,69 @@
+import asyncio
+import logging
 import os
+import time
+import uuid
+from contextlib import asynccontextmanager
 from http import HTTPStatus
-from typing import Any, Sequence, Optional
+from typing import Any, Awaitable, Callable, List, Sequence, Optional
 import json
 
 import uvicorn
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException
 from fastapi import FastAPI, Request
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
 from pydantic import BaseModel
 
-from src.agents.orchestrator import Orchestrator
+from src.agents.orchestrator import LATEST_STATE_KEY, Orchestrator, checkpointed_runs, course_views
+from src.blobs import blob_store
+from src.cache import cache_refresher
+from src.config import config
 from src.data_models import WorkflowState
+from src.documents import UploadError, document_store, file_sha256
+from src.image_proxy import FORMATS as IMAGE_FORMATS, ImageProxyError, image_proxy, negotiate_format
+from src.loop_monitor import loop_monitor
+from src.metrics import RUN_LATENCY, RUNS_IN_FLIGHT
+from src.pages import page_store
+from src.precompute import precomputed_store
+from src.prompts import count_tokens
+from src.profiling import PROFILE_FORMATS, is_admin, profile_path, profile_run
+from src.routing import latency_budget, mark_degraded, model_router
+from src.runs import run_manager
+from src.scheduler import scheduling, upstream_scheduler
+from src.search_index import KINDS as SEARCH_KINDS, search_index
+from src.state_backend import state_backend
+from src.storage import storage
+from src.tracing import render_waterfall, span, tracer, waterfall
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Start background monitors and open the shared state and checkpointer with the server."""
+    loop_monitor.start()
+    await state_backend.open()
+    cache_refresher.start()
+    storage.start()
+    await orchestrator.open_checkpointer(config.CHECKPOINT_DB)
+    # Runs checkpointed before runs were tracked count towards the quota too
+    await asyncio.to_thread(lambda: storage.adopt_runs(checkpointed_runs()))
+    # Load the local tokenizer off the event loop before the first request
+    await asyncio.to_thread(count_tokens, "")
+    yield
+    await cache_refresher.stop()
+    await storage.stop()
+    await orchestrator.close_checkpointer()
+    await tracer.flush()
+    await state_backend.close()
+    await loop_monitor.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 router = APIRouter()
 app.add_middleware(
     CORSMiddleware,
@@ -30,8 +78,26 @@ orchestrator = Orchestrator()
 class WorkflowRequest(BaseModel):
     # uuid: str
     file_name: Optional[str] = ""
+    document_id: Optional[str] = ""  # returned by /upload_document/, takes precedence
+    user_query: Optional[str] = ""
+    user_metadata: Optional[dict] = {}  # interests, career_goals, education_level, background, hobbies
+    lazy_roadmaps: Optional[bool] = None  # defaults to config.LAZY_ROADMAPS
+    deadline_s: Optional[float] = None  # degrade the run to answer within this many seconds
+
+
+class CourseRequest(BaseModel):
+    # Lectures of the course, as uploaded document ids and/or files in tmp/
+    document_ids: List[str] = []
+    file_names: List[str] = []
     user_query: Optional[str] = ""
-    # user_metadata: Optional[dict] = {}
+    user_metadata: Optional[dict] = {}
+    lazy_roadmaps: Optional[bool] = None
+
+
+class PersonalizeRequest(BaseModel):
+    # Fields left out keep the value of the original run
+    user_query: Optional[str] = None
+    user_metadata: Optional[dict] = None
 
 
 @app.exception_handler(RequestValidationError)
@@ -51,7 +117,7 @@ async def validation_exception_handler(
         JSONResponse: A JSON response containing information about the validation errors.
     """
     errors: Sequence[dict[str, Any]] = exc.errors()
-    print(errors)
+    logger.error(f"Request validation failed: {errors}")
 
     return JSONResponse(
         status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
@@ -70,36 +136,229 @@ async def validation_exception_handler(
     )
 
 
-@router.post("/run_workflow/")
-async def run_workflow(request: WorkflowRequest):
+@router.post("/upload_document/")
+async def upload_document(request: Request):
+    """ Endpoint streaming a multipart file upload to disk, deduplicated by SHA-256."""
+    content_length = request.headers.get("content-length")
     try:
+        document = await document_store.save_multipart(
+            request.stream(),
+            request.headers.get("content-type", ""),
+            int(content_length) if content_length else None,
+        )
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
 
-        # detele the tmp/workflow_state.json file if it exists
-        workflow_state_path = os.path.join("tmp", "workflow_state.json")
-        if os.path.exists(workflow_state_path):
-            os.remove(workflow_state_path)
+    return {
+        "status": "success",
+        "data": {
+            "document_id": document["document_id"],
+            "filename": document["filename"],
+            "size": document["size"],
+            "deduplicated": document["deduplicated"],
+        }
+    }
 
-        document_path = os.path.join("tmp", request.file_name)
 
-        if not os.path.exists(document_path):
+def resolve_document(document_id: Optional[str], file_name: Optional[str]) -> str:
+    """Path of an uploaded document (by id) or of a file in tmp/, or a 404"""
+    if document_id:
+        document_path = document_store.get_path(document_id)
+        if document_path is None:
             raise HTTPException(
-                status_code=404, detail=f"Document not found: {document_path}"
+                status_code=404, detail=f"Document not found: {document_id}"
+            )
+    else:
+        document_path = os.path.join("tmp", file_name)
+
+    if not os.path.exists(document_path):
+        raise HTTPException(
+            status_code=404, detail=f"Document not found: {document_path}"
+        )
+    return document_path
+
+
+async def find_precomputed(
+        document_id: str,
+        user_query: Optional[str],
+        user_metadata: Optional[dict],
+        any_inputs: bool = False,
+) -> Optional[dict]:
+    """Offline result (see src/precompute.py) computed for the same document and inputs
+    (or for any inputs with `any_inputs`)"""
+    record = await asyncio.to_thread(precomputed_store.get, document_id)
+    if record is None:
+        return None
+    state = record["state"]
+    if any_inputs:
+        return record
+    if (state.get("text_input") or "") != (user_query or "") or (
+        state.get("user_metadata") or {}
+    ) != (user_metadata or {}):
+        return None
+    return record
+
+
+async def execute_run(
+        run_id: str,
+        invoke: Callable[[], Awaitable[WorkflowState]],
+        kind: str,
+        document: str,
+        profile: bool = False,
+        deadline: Optional[float] = None,
+        weight: float = 1.0,
+) -> WorkflowState:
+    """Execute one run of the workflow graph (`invoke`: run, resume or personalize),
+    with metrics, tracing and profiling.
+
+    The latency budget lets the model router trade quality for speed late in a
+    run; a client `deadline` replaces it and lets the agents degrade their work.
+    `weight` is the run's share of the upstream slots relative to other runs."""
+    start = time.perf_counter()
+    status = "exception"
+    # Tracked for the quota: evicting the run deletes its checkpoints and index entries
+    await asyncio.to_thread(storage.run_dir, run_id)
+    budget = latency_budget(deadline or config.RUN_LATENCY_BUDGET, degrade=deadline is not None)
+    with RUNS_IN_FLIGHT.track_inprogress(), budget, scheduling("interactive", run_id, weight), span(
+        "run", trace_id=run_id, document=document, kind=kind,
+        **({"deadline_s": deadline} if deadline else {})
+    ):
+        # The deadline bounds the response time, not only the agents' own work
+        timeout = asyncio.timeout(deadline)
+        try:
+            async with profile_run(run_id, enabled=profile), timeout:
+                result = await invoke()
+            status = "error" if result.get("error") else "ok"
+        except TimeoutError:
+            if not timeout.expired():
+                raise
+            result = await deadline_result(run_id)
+            status = "deadline"
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            RUN_LATENCY.labels(status=status).observe(time.perf_counter() - start)
+            tracer.finish_trace(run_id)
+    return result
+
+
+async def deadline_result(run_id: str) -> WorkflowState:
+    """State of a run stopped at its deadline: its latest checkpoint, with the
+    nodes it did not get to marked as degraded (resuming the run runs them)"""
+    state = await orchestrator.get_state(run_id) or WorkflowState(
+        uuid=run_id, relevant_concepts=[], concept_applications={}, error=None
+    )
+    for node in await orchestrator.pending_nodes(run_id):
+        mark_degraded(state, "deadline", node)
+    return state
+
+
+@router.post("/run_workflow/")
+async def run_workflow(
+        request: WorkflowRequest,
+        http_request: Request,
+        profile: bool = False,
+        x_profile: Optional[str] = Header(default=None),
+        x_admin_token: Optional[str] = Header(default=None),
+        x_client_id: Optional[str] = Header(default=None),
+):
+    # Profiling is opt-in (?profile=true or X-Profile: 1) and admin-only
+    profile = profile or x_profile in ("1", "true")
+    if profile and not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Profiling requires a valid admin token")
+    if request.deadline_s is not None and request.deadline_s < config.MIN_DEADLINE:
+        raise HTTPException(
+            status_code=400, detail=f"deadline_s must be at least {config.MIN_DEADLINE}"
+        )
+
+    try:
+
+        # Forget the previous run's state, which the frontend polls for
+        await state_backend.delete(LATEST_STATE_KEY)
+
+        document_path = resolve_document(request.document_id, request.file_name)
+
+        run_id = uuid.uuid4().hex
+        await asyncio.to_thread(storage.touch, document_path, run_id=run_id)
+        document_id = request.document_id or await asyncio.to_thread(file_sha256, document_path)
+        precomputed = await find_precomputed(
+            document_id, request.user_query, request.user_metadata
+        )
+        degraded = None
+        if (
+            precomputed is None
+            and request.deadline_s is not None
+            and request.deadline_s < config.DEGRADATION_THRESHOLDS["cached_results"]
+        ):
+            # No time for a run: the document's result for other inputs beats nothing
+            precomputed = await find_precomputed(
+                document_id, request.user_query, request.user_metadata, any_inputs=True
+            )
+            if precomputed is not None:
+                degraded = {
+                    "cached_results": [
+                        c["name"] for c in precomputed["state"].get("relevant_concepts", [])
+                    ]
+                }
+        if precomputed is not None:
+            state = await orchestrator.import_state(
+                run_id,
+                {
+                    **precomputed["state"],
+                    "document_path": document_path,
+                    "last_applications_timestamp": time.time(),
+                    "last_roadmap_timestamp": time.time(),
+                    **({"degraded": degraded} if degraded else {}),
+                },
             )
+            return {
+                "status": "success",
+                "run_id": run_id,
+                "precomputed": True,
+                "data": state
+            }
 
         initial_state = WorkflowState(
-            uuid="uuid_temporary",
+            uuid=run_id,
             document_path=document_path,
             text_input=request.user_query,
-            user_metadata={},  # request.user_metadata,
+            user_metadata=request.user_metadata or {},
             relevant_concepts=[],
             concept_applications={},
+            lazy_roadmaps=(
+                config.LAZY_ROADMAPS if request.lazy_roadmaps is None else request.lazy_roadmaps
+            ),
             error=None,
         )
 
-        result = await orchestrator.workflow.compile().ainvoke(initial_state)
+        # A client's new run supersedes (cancels) its previous one
+        await run_manager.start(
+            run_id,
+            execute_run(
+                run_id,
+                lambda: orchestrator.run(initial_state),
+                kind="run",
+                document=request.document_id or request.file_name,
+                profile=profile,
+                deadline=request.deadline_s,
+            ),
+            client_id=x_client_id,
+        )
+        try:
+            result = await run_manager.wait(run_id, http_request.is_disconnected)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise  # this request itself is being cancelled
+            return {
+                "status": "cancelled",
+                "run_id": run_id,
+                "message": await run_manager.status(run_id),
+            }
 
         return {
             "status": "success",
+            "run_id": run_id,
             "data": result
         }
 
@@ -107,31 +366,480 @@ async def run_workflow(request: WorkflowRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/courses/")
+async def run_course(
+        request: CourseRequest,
+        http_request: Request,
+        x_client_id: Optional[str] = Header(default=None),
+):
+    """ Endpoint running the workflow once for a batch of lectures, sharing concepts,
+    applications and roadmaps between them."""
+    document_paths = [resolve_document(d, None) for d in request.document_ids]
+    document_paths += [resolve_document(None, f) for f in request.file_names]
+    # The same lecture listed twice is processed once
+    document_paths = list(dict.fromkeys(document_paths))
+    if not document_paths:
+        raise HTTPException(status_code=400, detail="No documents in the course")
+    if len(document_paths) > config.MAX_COURSE_DOCUMENTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {config.MAX_COURSE_DOCUMENTS} documents per course",
+        )
+
+    course_id = uuid.uuid4().hex
+    await asyncio.to_thread(storage.touch, *document_paths, run_id=course_id)
+    initial_state = WorkflowState(
+        uuid=course_id,
+        document_path="",
+        text_input=request.user_query,
+        user_metadata=request.user_metadata or {},
+        relevant_concepts=[],
+        concept_applications={},
+        lazy_roadmaps=(
+            config.LAZY_ROADMAPS if request.lazy_roadmaps is None else request.lazy_roadmaps
+        ),
+        error=None,
+    )
+    await run_manager.start(
+        course_id,
+        execute_run(
+            course_id,
+            lambda: orchestrator.run_course(initial_state, document_paths),
+            kind="course",
+            document=",".join(os.path.basename(p) for p in document_paths),
+            # A course does the work of one run per lecture
+            weight=len(document_paths),
+        ),
+        client_id=x_client_id,
+    )
+    try:
+        result = await run_manager.wait(course_id, http_request.is_disconnected)
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        return {
+            "status": "cancelled",
+            "run_id": course_id,
+            "message": await run_manager.status(course_id),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "status": "success",
+        "run_id": course_id,
+        "data": {
+            "lectures": course_views(result),
+            "concepts": len(result.get("relevant_concepts", [])),
+            "error": result.get("error"),
+        }
+    }
+
+
+@router.get("/courses/{course_id}")
+async def get_course(course_id: str):
+    """ Endpoint returning the per-lecture views of a course run."""
+    state = await orchestrator.get_state(course_id)
+    if state is None or not state.get("course_documents"):
+        return {
+            "status": "not_found",
+            "message": f"No course run with id: {course_id}"
+        }
+
+    return {
+        "status": "success",
+        "data": {
+            "lectures": course_views(state),
+            "concepts": len(state.get("relevant_concepts", [])),
+            "error": state.get("error"),
+        }
+    }
+
+
+@router.post("/runs/{run_id}/resume")
+async def resume_run(
+        run_id: str,
+        http_request: Request,
+        x_client_id: Optional[str] = Header(default=None),
+):
+    """ Endpoint continuing a run from its last checkpoint, re-attempting only failed parts."""
+    if await run_manager.status(run_id) == "running":
+        raise HTTPException(status_code=409, detail=f"Run is still running: {run_id}")
+    if await orchestrator.get_state(run_id) is None:
+        raise HTTPException(status_code=404, detail=f"No checkpoint for run: {run_id}")
+
+    await run_manager.start(
+        run_id,
+        execute_run(
+            run_id, lambda: orchestrator.resume(run_id), kind="resume", document=""
+        ),
+        client_id=x_client_id,
+    )
+    try:
+        result = await run_manager.wait(run_id, http_request.is_disconnected)
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        return {
+            "status": "cancelled",
+            "run_id": run_id,
+            "message": await run_manager.status(run_id),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "status": "success",
+        "run_id": run_id,
+        "data": result
+    }
+
+
+@router.post("/runs/{run_id}/personalize")
+async def personalize_run(
+        run_id: str,
+        request: PersonalizeRequest,
+        http_request: Request,
+        x_client_id: Optional[str] = Header(default=None),
+):
+    """ Endpoint re-running a finished run for a new query or profile, reusing its concepts."""
+    if await run_manager.status(run_id) == "running":
+        raise HTTPException(status_code=409, detail=f"Run is still running: {run_id}")
+    state = await orchestrator.get_state(run_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail=f"No checkpoint for run: {run_id}")
+    if not state.get("relevant_concepts"):
+        raise HTTPException(
+            status_code=409, detail=f"Run has no concepts to reuse, resume it first: {run_id}"
+        )
+
+    # The personalized results are a new run; the original one is kept
+    new_run_id = uuid.uuid4().hex
+    await run_manager.start(
+        new_run_id,
+        execute_run(
+            new_run_id,
+            lambda: orchestrator.personalize(
+                run_id,
+                new_run_id,
+                text_input=request.user_query,
+                user_metadata=request.user_metadata,
+            ),
+            kind="personalize",
+            document=os.path.basename(state.get("document_path", "")),
+        ),
+        client_id=x_client_id,
+    )
+    try:
+        result = await run_manager.wait(new_run_id, http_request.is_disconnected)
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling():
+            raise
+        return {
+            "status": "cancelled",
+            "run_id": new_run_id,
+            "message": await run_manager.status(new_run_id),
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "status": "success",
+        "run_id": new_run_id,
+        "source_run_id": run_id,
+        "data": result
+    }
+
+
+@router.get("/precomputed/{document_id}")
+async def get_precomputed(document_id: str):
+    """ Endpoint returning the offline precomputed result of a document."""
+    record = await asyncio.to_thread(precomputed_store.get, document_id)
+    if record is None:
+        return {
+            "status": "not_found",
+            "message": f"No precomputed result for document: {document_id}"
+        }
+
+    return {
+        "status": "success",
+        "data": record
+    }
+
+
+@router.get("/documents/{document_id}/pages")
+async def get_document_pages(document_id: str, concept: Optional[str] = None):
+    """ Endpoint returning the OCR'd pages of a document, or only those mentioning `concept`."""
+    pages = await asyncio.to_thread(page_store.pages, document_id)
+    if not pages:
+        return {
+            "status": "not_found",
+            "message": f"No OCR pages for document: {document_id}"
+        }
+    if concept:
+        numbers = set(await asyncio.to_thread(page_store.concept_pages, document_id, concept))
+        pages = [page for page in pages if page["page"] in numbers]
+
+    return {
+        "status": "success",
+        "data": pages
+    }
+
+
+@router.get("/search")
+async def search(q: str, kind: Optional[str] = None, limit: int = 20):
+    """ Endpoint searching the concepts, applications and roadmap items of past runs."""
+    if kind is not None and kind not in SEARCH_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown kind, expected one of {list(SEARCH_KINDS)}")
+    limit = max(1, min(limit, config.SEARCH_MAX_RESULTS))
+    results = await asyncio.to_thread(search_index.search, q, kind, limit)
+    return {
+        "status": "success",
+        "data": results
+    }
+
+
+@router.get("/runs/{run_id}/roadmap")
+async def get_roadmap(run_id: str, application: str, concept: Optional[str] = None):
+    """ Endpoint returning an application's roadmap, generating it on first request."""
+    try:
+        roadmap = await orchestrator.get_roadmap(run_id, application, concept)
+    except KeyError:
+        return {
+            "status": "not_found",
+            "message": f"No application '{application}' in run: {run_id}"
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return {
+        "status": "success",
+        "data": roadmap
+    }
+
+
 @router.get("/get_workflow_state/")
-async def get_workflow_state():
-    """ Endpoint to retrieve the tmp/workflow_state.json file."""
+async def get_workflow_state(run_id: Optional[str] = None, expand: bool = False):
+    """ Endpoint to retrieve a run's checkpointed state, or the latest saved workflow state.
+    Large fields are blob references unless `expand` is set."""
     try:
-        workflow_state_path = os.path.join("tmp", "workflow_state.json")
+        if run_id:
+            workflow_state = await orchestrator.get_state(run_id)
+            if workflow_state is None:
+                return {
+                    "status": "not_found",
+                    "message": f"No workflow state for run: {run_id}"
+                }
+            return {
+                "status": "success",
+                "data": await blob_store.aresolve(workflow_state) if expand else workflow_state
+            }
 
-        if not os.path.exists(workflow_state_path):
+        workflow_state = await state_backend.get_json(LATEST_STATE_KEY)
+        if workflow_state is None:
             return {
                 "status": "not_found",
-                "message": f"Workflow state file not found: {workflow_state_path}"
+                "message": "No workflow state saved yet"
             }
 
-        with open(workflow_state_path, "r") as file:
-            workflow_state = json.load(file)
-
         return {
             "status": "success",
-            "data": workflow_state
+            "data": await blob_store.aresolve(workflow_state) if expand else workflow_state
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.get("/blobs/{blob_id}")
+async def get_blob(blob_id: str, if_none_match: Optional[str] = Header(default=None)):
+    """ Endpoint returning a stored blob; blobs are immutable and cached forever."""
+    path = blob_store.path(blob_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail=f"Unknown blob: {blob_id}")
+
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{blob_id}"',
+    }
+    if if_none_match and blob_id in if_none_match:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(path, media_type="application/json", headers=headers)
+
+
+@router.get("/images/{image_id}/{size}")
+async def get_image(
+    image_id: str,
+    size: str,
+    accept: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None),
+):
+    """ Endpoint serving a proxied image resized to `size`, as WebP when the client accepts it."""
+    fmt = negotiate_format(accept)
+    try:
+        path = await image_proxy.get(image_id, size, fmt)
+    except ImageProxyError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    etag = f'"{image_id}-{size}.{fmt}"'
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": etag,
+        "Vary": "Accept",
+    }
+    if if_none_match and etag in if_none_match:
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(path, media_type=IMAGE_FORMATS[fmt][1], headers=headers)
+
+
+@router.get("/runs/{run_id}")
+async def get_run_status(run_id: str):
+    """ Endpoint returning whether a run is running, completed, failed, cancelled or interrupted."""
+    status = await run_manager.status(run_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"Unknown run: {run_id}")
+
+    data = {"run_id": run_id, "run_status": status}
+    if status == "running":
+        data["worker"] = await run_manager.owner(run_id)
+    return {
+        "status": "success",
+        "data": data
+    }
+
+
+@router.post("/runs/{run_id}/cancel")
+async def cancel_run(run_id: str):
+    """ Endpoint cancelling a running workflow and its in-flight upstream calls."""
+    if not await run_manager.cancel(run_id, reason="requested"):
+        return {
+            "status": "not_found",
+            "message": f"No running workflow with id: {run_id}"
+        }
+
+    return {
+        "status": "success",
+        "run_id": run_id
+    }
+
+
+@router.get("/runs/{run_id}/trace")
+async def get_run_trace(run_id: str, format: str = "json"):
+    """ Endpoint returning the spans of a run as a waterfall (json or text)."""
+    rows = waterfall(run_id, await tracer.load_trace(run_id))
+    if not rows:
+        raise HTTPException(status_code=404, detail=f"No trace for run: {run_id}")
+
+    if format == "text":
+        return PlainTextResponse(render_waterfall(rows))
+
+    return {
+        "status": "success",
+        "data": rows
+    }
+
+
+@router.get("/runs/{run_id}/profile")
+async def get_run_profile(
+        run_id: str,
+        format: str = "html",
+        x_admin_token: Optional[str] = Header(default=None),
+):
+    """ Endpoint returning a profiled run's artifact (html, speedscope or pstats)."""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+    if format not in PROFILE_FORMATS:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown format, expected one of {list(PROFILE_FORMATS)}"
+        )
+
+    try:
+        path = profile_path(run_id, format)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"No profile for run: {run_id}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"No profile for run: {run_id}")
+
+    return FileResponse(path, filename=os.path.basename(path))
+
+
+@router.get("/debug/stalls")
+async def get_loop_stalls(x_admin_token: Optional[str] = Header(default=None)):
+    """ Endpoint listing recent event-loop stalls with their blocking stacks."""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+    return {
+        "status": "success",
+        "data": list(loop_monitor.stalls)
+    }
+
+
+@router.get("/debug/scheduler")
+async def get_scheduler(x_admin_token: Optional[str] = Header(default=None)):
+    """ Endpoint listing the upstream slots in use and the calls queued per priority class."""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+    return {
+        "status": "success",
+        "data": upstream_scheduler.snapshot()
+    }
+
+
+@router.get("/debug/images")
+async def get_image_cache(x_admin_token: Optional[str] = Header(default=None)):
+    """ Endpoint reporting the size of the image proxy cache and the sources failing to load."""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+    return {
+        "status": "success",
+        "data": await asyncio.to_thread(image_proxy.stats)
+    }
+
+
+@router.get("/debug/storage")
+async def get_storage(x_admin_token: Optional[str] = Header(default=None)):
+    """ Endpoint reporting the disk usage of run artifacts, uploads, blobs, databases and traces against the quota."""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+    return {
+        "status": "success",
+        "data": await asyncio.to_thread(storage.stats)
+    }
+
+
+@router.get("/debug/routing")
+async def get_model_routing(x_admin_token: Optional[str] = Header(default=None)):
+    """ Endpoint listing the rolling latency and error stats the model router decides on."""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+    return {
+        "status": "success",
+        "data": {
+            "tiers": config.MODEL_TIERS,
+            "stats": model_router.snapshot(),
+        }
+    }
+
+
+@router.get("/metrics")
+async def metrics():
+    """ Endpoint exposing Prometheus metrics (aggregated over workers in multiprocess mode)."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 app.include_router(router)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Workers share run state through the state backend (see src/state_backend.py)
+    uvicorn.run("app:app", host="0.0.0.0", port=8000, workers=config.WORKERS)
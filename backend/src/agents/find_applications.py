@@ -7,15 +7,46 @@ import json
 import logging
 import base64
 import asyncio
+from src.blobs import blob_store
 from src.config import config
 
 from mistralai import Mistral
 
 from src.data_models import WorkflowState, ApplicationData
+from src.image_proxy import image_proxy
+from src.pages import page_store
+from src.prompts import build_messages
+from src.routing import mark_degraded, should_degrade
+from src.schemas import ApplicationOutput, OutputError
+from src.tracing import span
+from src.upstream import mistral_chat_json
 from src.utils import search_google_images
 
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = """You are an expert at connecting abstract mathematical/scientific/linguistic concepts to exciting real-world applications that inspire learning."""
+
+USER_INSTRUCTIONS = """For the concept given below, find 1-2 fascinating real-world applications that would excite and motivate learners, especially young learners.
+These applications should be relevant to the user's input and their interests, hobbies, or career goals.
+When a lecture excerpt is given, prefer applications of the concept as the lecture presents it.
+Focus on:
+- Modern technology applications (apps, devices, systems)
+- Surprising everyday applications
+- Cutting-edge research or industry uses
+- Applications that show the power and relevance of this concept
+
+Examples of the kind of applications I want:
+- Fourier Transform → Shazam music recognition, JPEG compression, MRI imaging, noise cancellation
+- Matrices → chatGPT (transformer architectures), Netflix recommendations, autonomous cars, medical diagnosis
+- Graph Theory → GPS navigation, social networks, supply chain optimization
+
+For each application, provide:
+1. name: Clear, recognizable name (company/product if applicable)
+2. brief_description: 1 sentence summary of what it does (e.g. "Shazam identifies songs from short audio clips") will be used to query Google Images
+3. description: Extended description of how this application uses the concept, its significance, wow factor and any interesting details
+
+Return as JSON array."""
+
 
 def encode_image(image_path: str) -> str:
     """Encode image file to base64 string"""
@@ -35,72 +66,86 @@ class AgentApplicationsFinder:
             logger.info("Finding real-world applications for concepts")
 
             concept_applications = {}
+            user_metadata = state.get("user_metadata", {})
+            document_hashes = state.get("document_hashes") or []
 
             for concept in state["relevant_concepts"]:
                 concept_name = concept["name"]
                 domain = concept.get("domain", "")
 
-                # Generate applications prompt
-                applications_prompt = f"""
-                    For the {domain} concept "{concept_name}", find 1-2 fascinating real-world applications that would excite and motivate learners, especially young learners.
-                    These applications should be relevant to the users input query and their interests, hobbies, or career goals.
-                    here is the user input: {state['text_input']}
-                    Focus on:
-                    - Modern technology applications (apps, devices, systems)
-                    - Surprising everyday applications
-                    - Cutting-edge research or industry uses
-                    - Applications that show the power and relevance of this concept
-
-                    Examples of the kind of applications I want:
-                    - Fourier Transform → Shazam music recognition, JPEG compression, MRI imaging, noise cancellation
-                    - Matrices → chatGPT (transformer architectures), Netflix recommendations, autonomous cars, medical diagnosis
-                    - Graph Theory → GPS navigation, social networks, supply chain optimization
-
-                    For each application, provide:
-                    1. name: Clear, recognizable name (company/product if applicable)
-                    2. brief_description: 1 sentence summary of what it does (e.g. "Shazam identifies songs from short audio clips") will be used to query Google Images
-                    3. description: Extended description of how this application uses the concept, its significance, wow factor and any interesting details, wow 
-                    
-                    Return as JSON array.
-                    """
-                # Prepare messages for Mistral chat
-                messages = [
-                    {
-                        "role": "system",
-                        "content": "You are an expert at connecting abstract mathematical/scientific/linguistic concepts to exciting real-world applications that inspire learning.",
+                if should_degrade("cached_results"):
+                    # Out of time: keep what an earlier attempt found, call nothing
+                    concept_applications[concept_name] = state.get(
+                        "concept_applications", {}
+                    ).get(concept_name, [])
+                    mark_degraded(state, "cached_results", concept_name)
+                    continue
+
+                # Pages of the lecture about the concept, OCR'd once per document
+                excerpt = (
+                    await asyncio.to_thread(page_store.excerpt, document_hashes, concept_name)
+                    if document_hashes
+                    else ""
+                )
+
+                # Static instructions first, concept and user query last
+                messages = build_messages(
+                    agent="find_applications",
+                    system_prompt=SYSTEM_PROMPT,
+                    instructions=USER_INSTRUCTIONS,
+                    inputs={
+                        "Concept": concept_name,
+                        "Domain": domain,
+                        "User input": state["text_input"],
+                        "Interests": user_metadata.get("interests"),
+                        "Career goals": user_metadata.get("career_goals"),
+                        "Hobbies": user_metadata.get("hobbies"),
+                        "Lecture excerpt": excerpt,
                     },
-                    {"role": "user", "content": applications_prompt},
-                ]
-
-                response = self.mistral_client.chat.complete(
-                    model=config.MISTRAL_MODEL,
-                    messages=messages,
-                    # max_tokens=2000,
-                    response_format={"type": "json_object"},
-                    # temperature=0.4
+                    truncatable=["Lecture excerpt", "User input"],
                 )
-                # Parse the response
+
                 try:
-                    raw_response = response.choices[0].message.content
-                    applications = json.loads(raw_response)
-                    if not isinstance(applications, list):
-                        applications = [applications]
-                    for application in applications:
-                        application["images"] = await search_google_images(application["name"] + application["brief_description"])
-                except json.JSONDecodeError:
-                    # Fallback parsing
-                    import re
-
-                    json_match = re.search(
-                        r"\[.*\]", response.choices[0].message.content, re.DOTALL
+                    applications = await mistral_chat_json(
+                        self.mistral_client,
+                        agent="find_applications",
+                        messages=messages,
+                        schema=ApplicationOutput,
+                        many=True,
+                        cache="applications",
+                        attributes={"concept": concept_name},
+                        # max_tokens=2000,
+                        response_format={"type": "json_object"},
+                        # temperature=0.4
                     )
-                    if json_match:
-                        applications = json.loads(json_match.group())
-                    else:
-                        logger.warning(
-                            f"Could not parse applications for {concept_name}"
-                        )
-                        applications = []
+                except OutputError as e:
+                    logger.warning(f"Could not parse applications for {concept_name}: {e}")
+                    applications = []
+
+                if (
+                    len(applications) > config.DEGRADED_MAX_APPLICATIONS
+                    and should_degrade("cap_applications")
+                ):
+                    applications = applications[: config.DEGRADED_MAX_APPLICATIONS]
+                    mark_degraded(state, "cap_applications", concept_name)
+                for application in applications:
+                    if should_degrade("skip_images"):
+                        application["images"] = []
+                        mark_degraded(state, "skip_images", application["name"])
+                        continue
+                    with span(
+                        "image_lookup",
+                        concept=concept_name,
+                        application=application["name"],
+                    ):
+                        images = await search_google_images(application["name"] + application["brief_description"])
+                        application["images"] = await image_proxy.arewrite(images)
+
+                # Keep the large fields out of the graph state
+                for application in applications:
+                    for key in ("description", "images"):
+                        if key in application:
+                            application[key] = await blob_store.aput(application[key])
 
                 concept_applications[concept_name] = applications
                 logger.info(
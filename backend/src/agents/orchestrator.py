@@ -3,13 +3,29 @@
 orchestrator.py
 """
 import asyncio
+import copy
 import logging
+import os
+import re
+import sqlite3
 import time
-import json
+from typing import Any, Dict, List, Optional, Tuple
 
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import StateGraph, END
 
-from src.data_models import WorkflowState
+from src.blobs import blob_store
+from src.config import config
+from src.data_models import RoadmapData, WorkflowState
+from src.metrics import instrument_node, record_cache
+from src.routing import mark_degraded, should_degrade
+from src.scheduler import scheduling
+from src.search_index import search_index
+from src.singleflight import SingleFlight, flight_key
+from src.state_backend import state_backend
+from src.storage import storage
+from src.tracing import span, trace_node
 
 from src.agents.extract_concepts import AgentConceptsExtractor
 from src.agents.find_applications import AgentApplicationsFinder
@@ -19,75 +35,526 @@ from src.agents.roadmap_agent import AgentRoadmap
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared-state key of the most recently saved workflow state (polled by the frontend)
+LATEST_STATE_KEY = "workflow_state:latest"
+
+# Personalization inputs each re-runnable stage reads ("user_metadata.<key>"
+# for a metadata field). Concept extraction is left out on purpose: concepts
+# come from the document, the query and profile only add context there.
+# A stage also re-runs whenever an earlier stage does.
+STAGE_INPUTS = {
+    "find_applications": (
+        "text_input",
+        "user_metadata.interests",
+        "user_metadata.career_goals",
+        "user_metadata.hobbies",
+    ),
+    "generate_roadmaps": (
+        "user_metadata.interests",
+        "user_metadata.career_goals",
+        "user_metadata.education_level",
+        "user_metadata.background",
+        "user_metadata.hobbies",
+    ),
+}
+
+
+def changed_inputs(old: WorkflowState, new: WorkflowState) -> List[str]:
+    """Personalization inputs that differ between two states"""
+    changed = []
+    if (old.get("text_input") or "") != (new.get("text_input") or ""):
+        changed.append("text_input")
+    old_metadata = old.get("user_metadata") or {}
+    new_metadata = new.get("user_metadata") or {}
+    for key in sorted(set(old_metadata) | set(new_metadata)):
+        if old_metadata.get(key) != new_metadata.get(key):
+            changed.append(f"user_metadata.{key}")
+    return changed
+
+
+def _after_applications(state: WorkflowState) -> str:
+    """Lazy runs stop after applications, their roadmaps are generated on request"""
+    return END if state.get("lazy_roadmaps") else "generate_roadmaps"
+
+
+def _find_application(
+    state: WorkflowState, application: str, concept: Optional[str] = None
+) -> Tuple[str, Dict[str, Any]]:
+    """Concept name and data of an application of a run
+
+    Raises:
+        KeyError: If no application with that name exists (under `concept`)
+    """
+    for concept_name, apps in state.get("concept_applications", {}).items():
+        if concept is not None and concept_name != concept:
+            continue
+        for app in apps:
+            if app["name"] == application:
+                return concept_name, app
+    raise KeyError(application)
+
+
+def _normalize_name(name: str) -> str:
+    """Key under which concepts or applications with the same name are merged"""
+    return re.sub(r"[^0-9a-z]+", " ", name.casefold()).strip()
+
+
+def merge_course_concepts(lectures: List[Tuple[str, List[Dict[str, Any]]]]) -> List[Dict[str, Any]]:
+    """Merge the concepts of several lectures, keeping one entry per distinct name
+
+    Each merged concept lists the `documents` it was extracted from; the first
+    lecture's wording and the highest confidence are kept.
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    for document_path, concepts in lectures:
+        for concept in concepts:
+            key = _normalize_name(concept["name"])
+            if key not in merged:
+                merged[key] = {**concept, "documents": []}
+            entry = merged[key]
+            entry["confidence"] = max(entry.get("confidence", 0), concept.get("confidence", 0))
+            if document_path not in entry["documents"]:
+                entry["documents"].append(document_path)
+    return list(merged.values())
+
+
+def course_views(state: WorkflowState) -> List[Dict[str, Any]]:
+    """Per-lecture views over the shared results of a course run"""
+    views = []
+    for document_path in state.get("course_documents") or []:
+        concepts = [
+            c for c in state.get("relevant_concepts", [])
+            if document_path in c.get("documents", [])
+        ]
+        views.append(
+            {
+                "document": os.path.basename(document_path),
+                "relevant_concepts": concepts,
+                "concept_applications": {
+                    c["name"]: state.get("concept_applications", {}).get(c["name"], [])
+                    for c in concepts
+                },
+            }
+        )
+    return views
+
+
+def _log_prefetch_failure(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Roadmap prefetch failed: {task.exception()}")
+
+
+def delete_checkpoints(run_id: str, db_path: str = config.CHECKPOINT_DB) -> None:
+    """Delete every checkpoint of a run (blocking), e.g. once it is evicted"""
+    if not os.path.exists(db_path):
+        return
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        with conn:
+            for table in ("checkpoints", "writes"):
+                conn.execute(f"DELETE FROM {table} WHERE thread_id = ?", (run_id,))
+    except sqlite3.OperationalError as e:
+        logger.warning(f"Could not delete the checkpoints of run {run_id}: {e}")
+    finally:
+        conn.close()
+
+
+def checkpointed_runs(db_path: str = config.CHECKPOINT_DB) -> List[str]:
+    """Ids of the runs with a checkpoint (blocking)"""
+    if not os.path.exists(db_path):
+        return []
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        return [row[0] for row in conn.execute("SELECT DISTINCT thread_id FROM checkpoints")]
+    except sqlite3.OperationalError:
+        return []  # no checkpoint table yet
+    finally:
+        conn.close()
+
+
+storage.on_evict("run", delete_checkpoints)
+
 
 class Orchestrator:
     """Orchestrator class to manage the LangGraph workflow"""
 
-    def __init__(self):
-        """Initialize the Orchestrator with the agents and workflow"""
+    def __init__(self, publish_state: bool = True):
+        """Initialize the Orchestrator with the agents and workflow
+
+        Args:
+            publish_state: Save each run's state as the latest one polled by
+                the frontend and index it for search (disabled for offline
+                batch runs)
+        """
+        self.publish_state = publish_state
 
         self._agent_applications_finder = AgentApplicationsFinder()
         self._agent_concept_extractor = AgentConceptsExtractor()
         self._agent_roadmap = AgentRoadmap()
 
         self.workflow = self._build_workflow()
+        self.checkpointer: Optional[AsyncSqliteSaver] = None
+        self.graph = self.workflow.compile()
+        # On-demand roadmaps being generated, by (run id, concept, application);
+        # a client going away must not cancel a generation others may share
+        self._roadmap_flights = SingleFlight("roadmap", cancel_abandoned=False)
+        self._background_tasks: set = set()
+
+    async def open_checkpointer(self, db_path: str) -> None:
+        """Persist every node's output per run id in a local SQLite database"""
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        conn = await aiosqlite.connect(db_path)
+        self.checkpointer = AsyncSqliteSaver(conn)
+        await self.checkpointer.setup()
+        self.graph = self.workflow.compile(checkpointer=self.checkpointer)
+        logger.info(f"Workflow checkpoints stored in {db_path}")
+
+    async def close_checkpointer(self) -> None:
+        if self.checkpointer is not None:
+            await self.checkpointer.conn.close()
+            self.checkpointer = None
+            self.graph = self.workflow.compile()
+
+    @staticmethod
+    def _run_config(run_id: str) -> Dict[str, Any]:
+        return {"configurable": {"thread_id": run_id}}
+
+    async def run(self, state: WorkflowState) -> WorkflowState:
+        """Run the whole workflow, checkpointed under the state's uuid"""
+        result = await self.graph.ainvoke(state, config=self._run_config(state["uuid"]))
+        self._prefetch_top_roadmap(result)
+        return result
+
+    async def import_state(self, run_id: str, state: WorkflowState) -> WorkflowState:
+        """Checkpoint a finished state computed elsewhere (e.g. precomputed) as a run"""
+        state = {**state, "uuid": run_id}
+        if self.checkpointer is not None:
+            await self.graph.aupdate_state(
+                self._run_config(run_id), state, as_node="save_workflow_state_roadmaps"
+            )
+        if self.publish_state:
+            await state_backend.set_json(LATEST_STATE_KEY, state)
+        await self._index_run(state)
+        return state
 
-    def _build_workflow(self) -> StateGraph:
-        """Build the LangGraph workflow"""
-        workflow = StateGraph(WorkflowState)
+    async def _index_run(self, state: WorkflowState) -> None:
+        """Add a run's content to the search index, without ever failing the run"""
+        if not self.publish_state:
+            return
+        try:
+            await asyncio.to_thread(search_index.index_run, state)
+        except Exception as e:
+            logger.warning(f"Could not index run {state.get('uuid')}: {e}")
+
+    async def get_state(self, run_id: str) -> Optional[WorkflowState]:
+        """Latest checkpointed state of a run, or None if unknown"""
+        if self.checkpointer is None:
+            return None
+        snapshot = await self.graph.aget_state(self._run_config(run_id))
+        return snapshot.values or None
+
+    async def pending_nodes(self, run_id: str) -> Tuple[str, ...]:
+        """Nodes a run was due to run next from its latest checkpoint (all of
+        them from the entry point if it has none)"""
+        if self.checkpointer is None:
+            return ()
+        snapshot = await self.graph.aget_state(self._run_config(run_id))
+        if not snapshot.values:
+            return ("extract_relevant_concepts",)
+        return tuple(snapshot.next)
+
+    async def resume(self, run_id: str) -> WorkflowState:
+        """Continue a run from its last completed node
+
+        An interrupted run (restart, cancellation) continues with its next
+        node. A finished run re-runs only the stage that failed: extraction,
+        applications, or the roadmaps that are missing.
+
+        Raises:
+            KeyError: If no checkpoint exists for `run_id`
+        """
+        if self.checkpointer is None:
+            raise KeyError(run_id)
+        run_config = self._run_config(run_id)
+        snapshot = await self.graph.aget_state(run_config)
+        state = snapshot.values
+        if not state:
+            raise KeyError(run_id)
+
+        if snapshot.next:
+            logger.info(f"Resuming run {run_id} at {snapshot.next}")
+            return await self.graph.ainvoke(None, config=run_config)
+
+        if not state.get("relevant_concepts"):
+            logger.info(f"Resuming run {run_id} from concept extraction")
+            return await self.graph.ainvoke({**state, "error": None}, config=run_config)
+
+        if not state.get("concept_applications"):
+            resume_after = "extract_relevant_concepts"
+        elif state.get("error") or (not state.get("lazy_roadmaps") and any(
+            not app.get("RoadmapData")
+            for apps in state["concept_applications"].values()
+            for app in apps
+        )):
+            resume_after = "save_workflow_state_applications"
+        else:
+            logger.info(f"Run {run_id} is already complete")
+            return state
 
-        # Add nodes
-        workflow.add_node(
+        # Mark the run as if it had just finished `resume_after`, then continue
+        logger.info(f"Resuming run {run_id} after {resume_after}")
+        await self.graph.aupdate_state(run_config, {"error": None}, as_node=resume_after)
+        return await self.graph.ainvoke(None, config=run_config)
+
+    async def run_course(
+        self, state: WorkflowState, document_paths: List[str]
+    ) -> WorkflowState:
+        """Run the workflow once for a whole course
+
+        Concepts are extracted from every lecture concurrently and merged
+        across lectures; applications and roadmaps are then generated once
+        per distinct concept and application, in a single run checkpointed
+        under the state's uuid. See `course_views` for per-lecture results.
+
+        Raises:
+            RuntimeError: If concept extraction failed for every lecture
+        """
+        extract = instrument_node(
             "extract_relevant_concepts",
-            self._agent_concept_extractor.extract_relevant_concepts_node,
+            trace_node(
+                "extract_relevant_concepts",
+                self._agent_concept_extractor.extract_relevant_concepts_node,
+            ),
         )
-        workflow.add_node(
-            "find_applications", self._agent_applications_finder.find_applications_node
+        semaphore = asyncio.Semaphore(config.COURSE_EXTRACTION_CONCURRENCY)
+
+        async def extract_lecture(document_path: str) -> WorkflowState:
+            async with semaphore:
+                with span("lecture", document=os.path.basename(document_path)):
+                    return await extract(
+                        {**state, "document_path": document_path, "relevant_concepts": []}
+                    )
+
+        results = await asyncio.gather(*(extract_lecture(p) for p in document_paths))
+        lectures = []
+        document_hashes = []
+        for document_path, result in zip(document_paths, results):
+            if result.get("error"):
+                logger.warning(f"Skipping lecture {document_path}: {result['error']}")
+            else:
+                lectures.append((document_path, result["relevant_concepts"]))
+                document_hashes += result.get("document_hashes") or []
+        if not lectures:
+            raise RuntimeError("Concept extraction failed for every lecture")
+
+        concepts = merge_course_concepts(lectures)
+        logger.info(
+            f"Course {state['uuid']}: {sum(len(c) for _, c in lectures)} concepts "
+            f"from {len(lectures)} lectures merged into {len(concepts)}"
         )
 
-        workflow.add_node(
-            "save_workflow_state_applications",
-            self._save_workflow_state_applications
+        course_state = {
+            **state,
+            "document_path": "",
+            "course_documents": [p for p, _ in lectures],
+            "document_hashes": document_hashes,
+            "relevant_concepts": concepts,
+            "concept_applications": {},
+            "error": None,
+        }
+        run_config = self._run_config(state["uuid"])
+        await self.graph.aupdate_state(
+            run_config, course_state, as_node="extract_relevant_concepts"
         )
-
-        workflow.add_node(
-            "generate_roadmaps", self._generate_roadmaps_wrapper
+        result = await self.graph.ainvoke(None, config=run_config)
+        self._prefetch_top_roadmap(result)
+        return result
+
+    async def personalize(
+        self,
+        run_id: str,
+        new_run_id: str,
+        text_input: Optional[str] = None,
+        user_metadata: Optional[Dict[str, Any]] = None,
+    ) -> WorkflowState:
+        """Fork a finished run with a new query and/or profile
+
+        The concepts of `run_id` are reused; only the stages whose inputs
+        changed (see STAGE_INPUTS) run again, under `new_run_id`. The
+        original run is left untouched.
+
+        Raises:
+            KeyError: If no checkpoint exists for `run_id`
+            ValueError: If the run has no extracted concepts to reuse
+        """
+        state = await self.get_state(run_id)
+        if state is None:
+            raise KeyError(run_id)
+        if not state.get("relevant_concepts"):
+            raise ValueError(f"Run {run_id} has no concepts to reuse")
+
+        new_state = copy.deepcopy(state)
+        new_state["uuid"] = new_run_id
+        new_state["error"] = None
+        if text_input is not None:
+            new_state["text_input"] = text_input
+        if user_metadata is not None:
+            new_state["user_metadata"] = user_metadata
+
+        changed = changed_inputs(state, new_state)
+        if not state.get("concept_applications") or any(
+            field in STAGE_INPUTS["find_applications"] for field in changed
+        ):
+            resume_after = "extract_relevant_concepts"
+            new_state["concept_applications"] = {}
+        elif any(field in STAGE_INPUTS["generate_roadmaps"] for field in changed):
+            resume_after = "save_workflow_state_applications"
+            for apps in new_state["concept_applications"].values():
+                for app in apps:
+                    app["RoadmapData"] = None
+        else:
+            # Nothing downstream depends on the change: copy the results as is
+            resume_after = "save_workflow_state_roadmaps"
+
+        logger.info(
+            f"Personalizing run {run_id} as {new_run_id} after {resume_after} "
+            f"(changed: {changed or 'nothing'})"
         )
-
-        workflow.add_node(
-            "save_workflow_state_roadmaps",
-            self._save_workflow_state_roadmaps
+        run_config = self._run_config(new_run_id)
+        await self.graph.aupdate_state(run_config, new_state, as_node=resume_after)
+        if resume_after == "save_workflow_state_roadmaps":
+            await self._index_run(new_state)
+            return new_state
+        result = await self.graph.ainvoke(None, config=run_config)
+        self._prefetch_top_roadmap(result)
+        return result
+
+    async def get_roadmap(
+        self, run_id: str, application: str, concept: Optional[str] = None
+    ) -> List[RoadmapData]:
+        """Roadmap of one application of a run, generated on first request
+
+        The roadmap is stored in the run's checkpoint, so later requests (and
+        concurrent ones, which share the same generation) return it as is.
+
+        Raises:
+            KeyError: If the run or the application is unknown
+        """
+        state = await self.get_state(run_id)
+        if state is None:
+            raise KeyError(run_id)
+        concept_name, app = _find_application(state, application, concept)
+
+        roadmap = await blob_store.aresolve(app["RoadmapData"]) if app.get("RoadmapData") else None
+        record_cache("roadmap", hit=bool(roadmap))
+        if roadmap:
+            return roadmap
+
+        # Not generated yet, or its blob was evicted. Runs at the highest
+        # priority of its requesters: a live request joining the prefetch of
+        # the top roadmap promotes it
+        return await self._roadmap_flights.do(
+            flight_key(run_id, concept_name, application),
+            lambda: self._generate_roadmap(run_id, state, concept_name, application),
         )
 
+    async def _generate_roadmap(
+        self, run_id: str, state: WorkflowState, concept_name: str, application: str
+    ) -> List[RoadmapData]:
+        with span(
+            "roadmap", trace_id=run_id, concept=concept_name, application=application, lazy=True
+        ):
+            roadmap_state = await self._agent_roadmap.generate_roadmap(
+                {**state}, application
+            )
+        roadmap = [roadmap_state["roadmap"]]
+        roadmap_ref = await blob_store.aput(roadmap, run_id=run_id)
+
+        # Read-modify-write of the run's checkpoint: the lock is shared by every
+        # worker, so roadmaps generated concurrently elsewhere are not lost
+        async with state_backend.lock(f"run:{run_id}:state"):
+            latest = await self.get_state(run_id)
+            concept_applications = latest["concept_applications"]
+            _find_application(latest, application, concept_name)[1]["RoadmapData"] = roadmap_ref
+            await self.graph.aupdate_state(
+                self._run_config(run_id),
+                {"concept_applications": concept_applications},
+                as_node="save_workflow_state_roadmaps",
+            )
+        await self._index_run(latest)
+        logger.info(f"Generated on-demand roadmap for {application} (run {run_id})")
+        return roadmap
+
+    def _prefetch_top_roadmap(self, state: WorkflowState) -> None:
+        """In lazy mode, start generating the first application's roadmap"""
+        if (
+            not state.get("lazy_roadmaps")
+            or not config.PREFETCH_TOP_ROADMAP
+            or state.get("error")
+            or self.checkpointer is None
+        ):
+            return
+        for apps in state.get("concept_applications", {}).values():
+            if apps:
+                task = asyncio.create_task(self._prefetch_roadmap(state["uuid"], apps[0]["name"]))
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+                task.add_done_callback(_log_prefetch_failure)
+                return
+
+    async def _prefetch_roadmap(self, run_id: str, application: str) -> List[RoadmapData]:
+        # Speculative work yields upstream slots to live users and batches
+        with scheduling("prefetch", run_id):
+            return await self.get_roadmap(run_id, application)
+
+    def _build_workflow(self) -> StateGraph:
+        """Build the LangGraph workflow"""
+        workflow = StateGraph(WorkflowState)
+
+        # Add nodes (each one instrumented with a latency histogram and a trace span)
+        nodes = {
+            "extract_relevant_concepts": self._agent_concept_extractor.extract_relevant_concepts_node,
+            "find_applications": self._agent_applications_finder.find_applications_node,
+            "save_workflow_state_applications": self._save_workflow_state_applications,
+            "generate_roadmaps": self._generate_roadmaps_wrapper,
+            "save_workflow_state_roadmaps": self._save_workflow_state_roadmaps,
+        }
+        for name, node in nodes.items():
+            workflow.add_node(name, instrument_node(name, trace_node(name, node)))
+
         # Add edges
         # Define the workflow flow
         workflow.set_entry_point("extract_relevant_concepts")
 
         workflow.add_edge("extract_relevant_concepts", "find_applications")
         workflow.add_edge("find_applications", "save_workflow_state_applications")
-        workflow.add_edge("save_workflow_state_applications", "generate_roadmaps")
+        workflow.add_conditional_edges(
+            "save_workflow_state_applications",
+            _after_applications,
+            ["generate_roadmaps", END],
+        )
         workflow.add_edge("generate_roadmaps", "save_workflow_state_roadmaps")
         workflow.add_edge("save_workflow_state_roadmaps", END)
         return workflow
 
     async def _save_workflow_state_applications(self, state: WorkflowState, ) -> None:
-        """Save the current workflow state to a json file"""
-        file_path = f"tmp/workflow_state.json"
+        """Save the current workflow state to the shared state backend"""
         state["last_applications_timestamp"] = time.time()
-        with open(file_path, "w") as f:
-            json.dump(state, f, indent=4)
+        if self.publish_state:
+            await state_backend.set_json(LATEST_STATE_KEY, state)
+        await self._index_run(state)
 
-        logger.info(f"Workflow state (application) saved to {file_path}")
+        logger.info(f"Workflow state (application) saved to {LATEST_STATE_KEY}")
         return state
 
     async def _save_workflow_state_roadmaps(self, state: WorkflowState, ) -> None:
-        """Save the current workflow state to a json file"""
-        file_path = f"tmp/workflow_state.json"
+        """Save the current workflow state to the shared state backend"""
         state["last_roadmap_timestamp"] = time.time()
-        with open(file_path, "w") as f:
-            json.dump(state, f, indent=4)
+        if self.publish_state:
+            await state_backend.set_json(LATEST_STATE_KEY, state)
+        await self._index_run(state)
 
-        logger.info(f"Workflow state (roadmap) saved to {file_path}")
+        logger.info(f"Workflow state (roadmap) saved to {LATEST_STATE_KEY}")
         return state
 
     async def _generate_roadmaps_wrapper(self, state: WorkflowState) -> WorkflowState:
@@ -101,6 +568,13 @@ class Orchestrator:
 
             concept_applications = state.get("concept_applications", {})
             roadmaps_generated = 0
+            # The same application found for several concepts gets one roadmap
+            roadmaps_by_name = {
+                _normalize_name(app["name"]): app["RoadmapData"]
+                for applications in concept_applications.values()
+                for app in applications
+                if app.get("RoadmapData")
+            }
 
             # Generate roadmaps for each application
             for concept_name, applications in concept_applications.items():
@@ -108,15 +582,34 @@ class Orchestrator:
                 logger.info(f"Processing applications for concept: {concept_name}")
 
                 for app in applications:
+                    if app.get("RoadmapData"):
+                        # Already generated (e.g. by a previous attempt of this run)
+                        continue
+                    if _normalize_name(app["name"]) in roadmaps_by_name:
+                        app["RoadmapData"] = roadmaps_by_name[_normalize_name(app["name"])]
+                        continue
+                    # Past a deadline, the other roadmaps are left to GET /runs/{id}/roadmap
+                    if should_degrade("cached_results"):
+                        mark_degraded(state, "cached_results", app["name"])
+                        continue
+                    if roadmaps_generated and should_degrade("top_roadmap_only"):
+                        mark_degraded(state, "top_roadmap_only", app["name"])
+                        continue
                     try:
                         # Generate roadmap for this application
-                        roadmap_state = await self._agent_roadmap.generate_roadmap(
-                            state, app["name"]
-                        )
+                        with span(
+                            "roadmap", concept=concept_name, application=app["name"]
+                        ):
+                            roadmap_state = await self._agent_roadmap.generate_roadmap(
+                                state, app["name"]
+                            )
 
                         # Add the roadmap to the application data
                         if "roadmap" in roadmap_state:
-                            app["RoadmapData"] = [roadmap_state["roadmap"]]
+                            app["RoadmapData"] = await blob_store.aput(
+                                [roadmap_state["roadmap"]]
+                            )
+                            roadmaps_by_name[_normalize_name(app["name"])] = app["RoadmapData"]
                             roadmaps_generated += 1
                             logger.info(f"Generated roadmap for {app['name']}")
 
@@ -3,6 +3,7 @@
 agent_roadmap.py
 """
 
+import asyncio
 import json
 
 
@@ -11,11 +12,53 @@ from src.config import config
 from mistralai import Mistral
 
 from src.data_models import WorkflowState
+from src.pages import page_store
+from src.prompts import build_messages
+from src.schemas import RoadmapOutput
+from src.upstream import mistral_chat_json
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = """You are an AI tutor generating a focused, three-phase learning roadmap to help a learner understand or build a specific real-world application.
+
+Deconstruct the technical foundation of the target application (given at the end of the user message) into the core technical concepts and principles it relies on, and organize them into a progressive roadmap that equips a learner with the essential knowledge to comprehend and potentially implement it.
+
+Your output MUST be a single, valid JSON object. Do not include any explanations, markdown, or text before or after the JSON. The object must match this structure exactly:
+
+{
+"title": "string (a concise, relevant title for the roadmap, ideally referencing the application)",
+"description_1": [  // Phase 1: Foundational concepts
+    ["string (concept/topic name)", "string (estimated time to learn, e.g., '5 hours', '3 days')", "string (brief description of what the concept is and how it helps in understanding the application)"],
+    ...
+],
+"description_2": [  // Phase 2: Intermediate concepts
+    ["string (concept/topic name)", "string (estimated time to learn)", "string (brief description)"],
+    ...
+],
+"description_3": [  // Phase 3: Advanced or specialized concepts
+    ["string (concept/topic name)", "string (estimated time to learn)", "string (brief description)"],
+    ...
+]
+}
+
+Instructions:
+
+- Each of the "description_X" fields must contain a list of 1–4 items.
+- Each item must be a list with exactly 3 strings: [concept name, estimated learning time, brief description].
+- Concepts must follow a logical progression:
+- **description_1**: Beginner-level foundations needed to explore the application (absolute basics needed to get started).
+- **description_2**: Intermediate ideas that build on Phase 1 and relate directly to how the application works internally.
+- **description_3**: Advanced techniques or specialized knowledge needed for deeper understanding or real-world implementation (deeper mechanics, optimization, implementation challenges).
+- If relevant concepts are provided, place them in the appropriate phase and describe them clearly.
+- If a lecture excerpt is provided, match its notation and level when describing the concepts it covers.
+- Only include technical and scientific concepts that are essential to understanding how the application works — avoid general productivity tips, soft skills, or unrelated tangents.
+- You may optionally tailor the content using the user's background, if provided — but the roadmap must still be driven by the application.
+- The roadmap should clearly show how a learner can go from beginner to capable of understanding and analyzing the core technologies behind the application."""
+
+USER_INSTRUCTIONS = """Generate the learning roadmap JSON object for the target application below."""
+
 
 class AgentRoadmap:
     def __init__(self):
@@ -28,115 +71,59 @@ class AgentRoadmap:
         try:
             logger.info("Generating personalized learning roadmap")
 
-            # Prepare the prompt for generating the roadmap
-            system_prompt = """
-            You are an AI assistant tasked with generating a focused, three-phase learning roadmap to help a learner understand or build a specific real-world application.
-
-            Your goal is to deconstruct the technical foundation of the target application (provided in the user message) and generate a progressive roadmap that equips a learner with the essential knowledge to comprehend and potentially implement it.
-
-            Your output MUST be a single, valid JSON object. Do not include any explanations, markdown, or text before or after the JSON. The object must match this structure exactly:
-
-            {
-            "title": "string (a concise, relevant title for the roadmap, ideally referencing the application)",
-            "description_1": [  // Phase 1: Foundational concepts
-                ["string (concept/topic name)", "string (estimated time to learn, e.g., '5 hours')", "string (brief description of what the concept is and why it's useful)"],
-                ...
-            ],
-            "description_2": [  // Phase 2: Intermediate concepts
-                ["string (concept/topic name)", "string (estimated time to learn)", "string (brief description)"],
-                ...
-            ],
-            "description_3": [  // Phase 3: Advanced or specialized concepts
-                ["string (concept/topic name)", "string (estimated time to learn)", "string (brief description)"],
-                ...
-            ]
-            }
-
-            Instructions:
-
-            - Each of the "description_X" fields must contain a list of 1–4 items.
-            - Each item must be a list with exactly 3 strings: [concept name, estimated learning time, brief description].
-            - Concepts must follow a logical progression:
-            - **description_1**: Beginner-level foundations needed to explore the application.
-            - **description_2**: Intermediate ideas that build on Phase 1 and relate directly to how the application works internally.
-            - **description_3**: Advanced techniques or specialized knowledge needed for deeper understanding or real-world implementation.
-            - If relevant concepts are provided, place them in the appropriate phase and describe them clearly.
-            - Ensure all concepts are *directly relevant* to the target application — avoid unrelated or overly generic topics.
-            - You may optionally tailor the content using the user's background, if provided — but the roadmap must still be driven by the application.
-            """
-
             user_metadata = state.get("user_metadata", {})
             relevant_concepts = state.get("relevant_concepts", [])
 
-            user_message_content = f"""
-            You are an AI tutor generating a focused learning roadmap to help someone understand and potentially build the following application:
-
-            **Target Application**: {str_application_name}
-
-            Your objective is to break down this application into the core technical concepts and principles it relies on, and then organize those into a structured, three-phase learning roadmap:
-            - **description_1**: Foundational knowledge (absolute basics needed to get started)
-            - **description_2**: Intermediate concepts (used within the application or required to understand how it works internally)
-            - **description_3**: Advanced or specialized topics (deeper mechanics, optimization, or real-world implementation challenges)
-
-            Use this structure to ensure a natural progression in learning difficulty. Each concept must include:
-            1. The concept name
-            2. An estimated time to learn it (e.g., "10 hours", "3 days")
-            3. A brief description of what the concept is and how it helps in understanding the application
-
-            Also, incorporate the following **relevant technical concepts** associated with this application, placing them in the appropriate phase:
-            {", ".join([c["name"] for c in relevant_concepts]) if relevant_concepts else "None specified"}
-
-            Only include technical and scientific concepts that are essential to understanding how the application works — avoid general productivity tips, soft skills, or unrelated tangents.
-
-            You may optionally tailor the content using the user's background, if available:
-
-            - Interests: {user_metadata.get("interests", "Not specified")}
-            - Career Goals: {user_metadata.get("career_goals", "Not specified")}
-            - Education Level: {user_metadata.get("education_level", "Not specified")}
-            - Background: {user_metadata.get("background", "Not specified")}
-            - Hobbies: {user_metadata.get("hobbies", "Not specified")}
-
-            **Final output must be a single JSON object** matching this structure:
-            
-            "title": "...",
-            "description_1": [ [concept, time, brief_description], ... ],
-            "description_2": [ [concept, time, brief_description], ... ],
-            "description_3": [ [concept, time, brief_description], ... ]
-            
-
-            This roadmap should clearly show how a learner can go from beginner to capable of understanding and analyzing the core technologies behind **{str_application_name}**.
-            """
-
-            # Prepare messages for Mistral chat
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message_content},
-            ]
+            # Pages of the lecture about the concept behind the application
+            excerpt = ""
+            document_hashes = state.get("document_hashes") or []
+            concept_name = next(
+                (
+                    concept
+                    for concept, apps in (state.get("concept_applications") or {}).items()
+                    if any(app["name"] == str_application_name for app in apps)
+                ),
+                None,
+            )
+            if document_hashes and concept_name:
+                excerpt = await asyncio.to_thread(page_store.excerpt, document_hashes, concept_name)
+
+            # Static instructions and schema first, application and profile last
+            messages = build_messages(
+                agent="roadmap",
+                system_prompt=SYSTEM_PROMPT,
+                instructions=USER_INSTRUCTIONS,
+                inputs={
+                    "Target application": str_application_name,
+                    "Relevant concepts": ", ".join(c["name"] for c in relevant_concepts),
+                    "Interests": user_metadata.get("interests"),
+                    "Career goals": user_metadata.get("career_goals"),
+                    "Education level": user_metadata.get("education_level"),
+                    "Background": user_metadata.get("background"),
+                    "Hobbies": user_metadata.get("hobbies"),
+                    "Lecture excerpt": excerpt,
+                },
+                truncatable=[
+                    "Lecture excerpt",
+                    "Hobbies",
+                    "Interests",
+                    "Background",
+                    "Career goals",
+                    "Relevant concepts",
+                ],
+            )
 
             # Call Mistral API to generate the roadmap
-            response = self.mistral_client.chat.complete(
-                model=config.MISTRAL_MODEL,
+            roadmap = await mistral_chat_json(
+                self.mistral_client,
+                agent="roadmap",
                 messages=messages,
+                schema=RoadmapOutput,
+                cache="roadmaps",
+                attributes={"application": str_application_name},
                 response_format={"type": "json_object"},
             )
 
-            # Parse the response to extract the roadmap
-            try:
-                raw_response = response.choices[0].message.content
-                roadmap = json.loads(raw_response)
-                if not isinstance(roadmap, dict):
-                    raise ValueError("Response is not a valid JSON object")
-            except json.JSONDecodeError:
-                import re
-
-                # Fallback parsing if JSON is not directly parsable
-                json_match = re.search(r"\{.*\}", raw_response, re.DOTALL)
-                if json_match:
-                    roadmap = json.loads(json_match.group())
-                else:
-                    logger.error("Could not parse roadmap JSON")
-                    raise ValueError("Response does not contain valid JSON")
-
             roadmap["application"] = str_application_name
             # Update the state with the generated roadmap
             state["roadmap"] = roadmap
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed store for large state payloads
+blobs.py
+
+Roadmaps, image lists and long descriptions are written once under the
+SHA-256 of their canonical JSON and referenced from the workflow state as
+`{"$blob": "<id>"}`, which keeps checkpoints, the state file and polling
+responses small. Blobs never change, so they can be cached forever.
+
+Each blob is recorded in the storage index (see src/storage.py) with the
+runs that wrote it, which protect it from eviction while they run; reads
+update its modification time, which the index takes as an access.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from src.config import config
+from src.storage import storage
+from src.tracing import current_trace_id
+
+logger = logging.getLogger(__name__)
+
+REF_KEY = "$blob"
+# Reads update a blob's modification time at most this often (seconds)
+ACCESS_RESOLUTION = 3600
+
+
+def is_ref(value: Any) -> bool:
+    """Whether `value` is a blob reference"""
+    return isinstance(value, dict) and len(value) == 1 and isinstance(value.get(REF_KEY), str)
+
+
+class BlobStore:
+    """Stores JSON values under `<root>/<sha256>.json`"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, blob_id: str) -> Optional[str]:
+        """Path of a stored blob, or None if the id is invalid or unknown"""
+        if len(blob_id) != 64 or not all(c in "0123456789abcdef" for c in blob_id):
+            return None
+        path = os.path.join(self.root, f"{blob_id}.json")
+        return path if os.path.exists(path) else None
+
+    def put(self, value: Any, run_id: Optional[str] = None) -> Dict[str, str]:
+        """Store `value` (once per distinct content) and return its reference;
+        the blob is recorded as used by `run_id` (by default the current trace's run)"""
+        data = json.dumps(
+            value, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+        blob_id = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.root, f"{blob_id}.json")
+        if self.path(blob_id) is None:
+            os.makedirs(self.root, exist_ok=True)
+            # Write then rename, so readers never see a partial blob
+            incoming_path = os.path.join(self.root, f".incoming-{uuid.uuid4().hex}")
+            with open(incoming_path, "wb") as f:
+                f.write(data)
+            os.replace(incoming_path, path)
+        storage.record(path, "blob", run_id or current_trace_id())
+        return {REF_KEY: blob_id}
+
+    def get(self, blob_id: str) -> Any:
+        """Value of a stored blob
+
+        Raises:
+            KeyError: If the blob is unknown
+        """
+        path = self.path(blob_id)
+        if path is None:
+            raise KeyError(blob_id)
+        with open(path, "rb") as f:
+            value = json.loads(f.read())
+        now = time.time()
+        try:
+            if now - os.path.getmtime(path) > ACCESS_RESOLUTION:
+                os.utime(path, (now, now))
+        except OSError:
+            pass  # evicted meanwhile
+        return value
+
+    def resolve(self, value: Any) -> Any:
+        """Copy of `value` with every blob reference replaced by its content"""
+        if is_ref(value):
+            try:
+                return self.resolve(self.get(value[REF_KEY]))
+            except KeyError:
+                logger.warning(f"Missing blob {value[REF_KEY]}")
+                return None
+        if isinstance(value, dict):
+            return {k: self.resolve(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        return value
+
+    async def aput(self, value: Any, run_id: Optional[str] = None) -> Dict[str, str]:
+        return await asyncio.to_thread(self.put, value, run_id)
+
+    async def aresolve(self, value: Any) -> Any:
+        return await asyncio.to_thread(self.resolve, value)
+
+
+blob_store = BlobStore(root=config.BLOBS_DIR)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""Upstream response caches on the shared state backend
+cache.py
+
+Cached values are shared by every worker process. Each cache has a soft and
+a hard TTL (CACHE_TTLS): an entry is fresh until the soft TTL, then served
+stale while a prefetch-priority task refreshes it, and dropped at the hard
+TTL. The entries requested most in this process are also refreshed ahead of
+their soft TTL by `cache_refresher`, so popular content never goes stale.
+Hits, stale hits and misses are counted in `cache_requests_total{cache=...}`.
+"""
+
+import asyncio
+import contextvars
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from src.config import config
+from src.metrics import record_cache
+from src.scheduler import scheduling
+from src.singleflight import SingleFlight
+from src.state_backend import state_backend
+
+logger = logging.getLogger(__name__)
+
+# Key of the fetch time in stored entries, next to "value"
+FETCHED_AT_KEY = "$fetched_at"
+
+# Misses and refreshes in flight, per cache
+_flights: Dict[str, SingleFlight] = {}
+
+
+@dataclass
+class _Tracked:
+    """Entry requested in this process, with what is needed to refresh it"""
+
+    cache: str
+    fetch: Callable[[], Awaitable[Any]]
+    fetched_at: float
+    requests: int = 0
+
+
+def cache_key(cache: str, key: str) -> str:
+    return f"cache:{cache}:{hashlib.sha256(key.encode('utf-8')).hexdigest()}"
+
+
+def _unwrap(entry: Any) -> Tuple[Any, float]:
+    """Value and fetch time of a stored entry (entries stored before soft TTLs count as fresh)"""
+    if isinstance(entry, dict) and FETCHED_AT_KEY in entry:
+        return entry["value"], entry[FETCHED_AT_KEY]
+    return entry, time.time()
+
+
+def _cache_flights(cache: str) -> SingleFlight:
+    return _flights.setdefault(cache, SingleFlight(cache))
+
+
+async def cached(cache: str, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    """Value of `key` in `cache`, fetched and stored on a miss
+
+    Stale values are returned at once and refreshed in the background.
+    Empty results (e.g. from a failed upstream call) are not stored.
+    Concurrent misses of the same key share one fetch.
+    """
+    backend_key = cache_key(cache, key)
+    value, fetched_at = _unwrap(await state_backend.get_json(backend_key))
+    cache_refresher.track(backend_key, cache, fetch, fetched_at)
+    if value is None:
+        record_cache(cache, hit=False)
+        return await _cache_flights(cache).do(
+            backend_key, lambda: _fetch_and_store(cache, backend_key, fetch)
+        )
+
+    stale = time.time() - fetched_at >= config.CACHE_TTLS[cache]["soft"]
+    record_cache(cache, hit=True, stale=stale)
+    if stale:
+        cache_refresher.refresh(backend_key, cache, fetch)
+    return value
+
+
+async def _fetch_and_store(
+    cache: str, backend_key: str, fetch: Callable[[], Awaitable[Any]]
+) -> Any:
+    value = await fetch()
+    if value:
+        fetched_at = time.time()
+        await state_backend.set_json(
+            backend_key,
+            {"value": value, FETCHED_AT_KEY: fetched_at},
+            ttl=config.CACHE_TTLS[cache]["hard"],
+        )
+        cache_refresher.track(backend_key, cache, fetch, fetched_at, request=False)
+    return value
+
+
+class CacheRefresher:
+    """Refreshes stale entries, and the most requested ones before they go stale"""
+
+    def __init__(self, interval: float, top: int, ahead: float, max_tracked: int):
+        self.interval = interval
+        self.top = top
+        self.ahead = ahead
+        self.max_tracked = max_tracked
+        # backend key -> entry, least recently requested first
+        self._tracked: "OrderedDict[str, _Tracked]" = OrderedDict()
+        self._background_tasks: set = set()
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def track(
+        self,
+        backend_key: str,
+        cache: str,
+        fetch: Callable[[], Awaitable[Any]],
+        fetched_at: float,
+        request: bool = True,
+    ) -> None:
+        entry = self._tracked.get(backend_key)
+        if entry is None:
+            entry = self._tracked[backend_key] = _Tracked(cache, fetch, fetched_at)
+            if len(self._tracked) > self.max_tracked:
+                self._tracked.popitem(last=False)
+        entry.fetch, entry.fetched_at = fetch, fetched_at
+        if request:
+            entry.requests += 1
+            self._tracked.move_to_end(backend_key)
+
+    def refresh(self, backend_key: str, cache: str, fetch: Callable[[], Awaitable[Any]]) -> None:
+        """Refetch an entry in the background, unless it is already being fetched"""
+        if _cache_flights(cache).is_in_flight(backend_key):
+            return
+        # A clean context: the refresh is not part of the run, trace or
+        # deadline of the request that found the entry stale
+        task = asyncio.get_running_loop().create_task(
+            self._refresh(backend_key, cache, fetch), context=contextvars.Context()
+        )
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _refresh(
+        self, backend_key: str, cache: str, fetch: Callable[[], Awaitable[Any]]
+    ) -> None:
+        with scheduling("prefetch", f"cache:{cache}"):
+            try:
+                await _cache_flights(cache).do(
+                    backend_key, lambda: _fetch_and_store(cache, backend_key, fetch)
+                )
+            except Exception as e:
+                logger.warning(f"Refreshing {cache} entry failed: {e}")
+
+    def refresh_popular(self) -> int:
+        """Start refreshing the most requested entries close to their soft TTL;
+        returns how many were started"""
+        now = time.time()
+        popular = sorted(self._tracked.items(), key=lambda item: -item[1].requests)[: self.top]
+        started = 0
+        for backend_key, entry in popular:
+            soft_ttl = config.CACHE_TTLS[entry.cache]["soft"]
+            if entry.requests and now - entry.fetched_at >= self.ahead * soft_ttl:
+                self.refresh(backend_key, entry.cache, entry.fetch)
+                started += 1
+        # Halve the counts so popularity follows recent requests
+        for entry in self._tracked.values():
+            entry.requests //= 2
+        return started
+
+    def start(self) -> None:
+        self._loop_task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = [t for t in (self._loop_task, *self._background_tasks) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop_task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            started = self.refresh_popular()
+            if started:
+                logger.info(f"Refreshing {started} popular cache entries")
+
+
+cache_refresher = CacheRefresher(
+    interval=config.CACHE_REFRESH_INTERVAL,
+    top=config.CACHE_REFRESH_TOP,
+    ahead=config.CACHE_REFRESH_AHEAD,
+    max_tracked=config.CACHE_TRACKED_KEYS,
+)
@@ -4,7 +4,7 @@ config.py
 """
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Optional
 from dotenv import load_dotenv
 
@@ -18,23 +18,169 @@ class Config:
     # Mistral API Configuration
     MISTRAL_API_KEY: str = os.getenv("MISTRAL_API_KEY", "")
     MISTRAL_MODEL: str = "mistral-small-latest" #"mistral-medium-latest"  # "mistral-small-latest"
-    MISTRAL_MODEL_VISION: str = "mistral-small-latest"  # "mistral-medium-latest"  # "mistral-small-latest"
     # Google Custom Search Configuration
     GOOGLE_API_KEY: str = os.getenv("GOOGLE_API_KEY", "")
     GOOGLE_CSE_ID: str = os.getenv("GOOGLE_CSE_ID", "")
 
+    # Model Routing Settings
+    # Models tried per agent, primary first then faster fallbacks
+    MODEL_TIERS: dict = field(
+        default_factory=lambda: {
+            "extract_concepts": ["mistral-small-latest"],  # needs document understanding
+            "find_applications": ["mistral-small-latest", "ministral-8b-latest", "ministral-3b-latest"],
+            "roadmap": ["mistral-small-latest", "ministral-8b-latest", "ministral-3b-latest"],
+        }
+    )
+    # p95 latency (s) above which a model is considered degraded for an agent
+    MODEL_LATENCY_SLO: dict = field(
+        default_factory=lambda: {
+            "extract_concepts": 45.0,
+            "find_applications": 10.0,
+            "roadmap": 15.0,
+        }
+    )
+    MODEL_MAX_ERROR_RATE: float = 0.25
+    MODEL_STATS_WINDOW: float = 300.0  # seconds of calls the rolling stats cover
+    MODEL_STATS_MIN_SAMPLES: int = 5  # calls needed before a model can be judged
+    MODEL_MAX_ATTEMPTS: int = 2  # a failed call is retried once on the next tier
+    RUN_LATENCY_BUDGET: float = float(os.getenv("RUN_LATENCY_BUDGET", "180"))  # seconds per run
+    # Outputs still invalid after local repair are asked for again this many times
+    LLM_OUTPUT_MAX_REASKS: int = 1
+
+    # Upstream Scheduling Settings (see src/scheduler.py)
+    # Concurrent calls per upstream, shared by interactive, background and prefetch work
+    SCHEDULER_LIMITS: dict = field(
+        default_factory=lambda: {
+            "mistral": int(os.getenv("MISTRAL_CONCURRENCY", "16")),
+            "google": int(os.getenv("GOOGLE_CONCURRENCY", "16")),
+        }
+    )
+    SCHEDULER_RESERVED_INTERACTIVE: int = 4  # slots of each upstream only interactive calls get
+    # The limits are shared by every process through the state backend (see src/scheduler.py)
+    SCHEDULER_LEASE_TTL: float = 30.0  # seconds a dead process's slots stay taken
+    SCHEDULER_POLL_INTERVAL: float = 0.05  # seconds between slot requests of queued calls
+
+    # Deadline Settings (runs started with a `deadline_s`)
+    # Remaining seconds of budget below which each degradation applies, in order
+    DEGRADATION_THRESHOLDS: dict = field(
+        default_factory=lambda: {
+            "skip_images": 60.0,  # applications without image search
+            "cap_applications": 45.0,  # at most DEGRADED_MAX_APPLICATIONS per concept
+            "top_roadmap_only": 30.0,  # roadmap of the top application only, others on request
+            "cached_results": 15.0,  # no more upstream calls, serve what is already computed
+        }
+    )
+    DEGRADED_MAX_APPLICATIONS: int = 1
+    MIN_DEADLINE: float = 1.0  # seconds
+
     # Image Search Settings
     MAX_IMAGE_RESULTS: int = 1
     IMAGE_SEARCH_SAFE: str = "active"
+    # Image Proxy Settings (see src/image_proxy.py)
+    IMAGES_DIR: str = "tmp/images"  # resized variants of the proxied images
+    IMAGE_SIZES: dict = field(
+        default_factory=lambda: {
+            "thumb": 160,  # longest side in px
+            "card": 640,
+        }
+    )
+    IMAGE_QUALITY: int = 80
+    IMAGE_CACHE_MAX_MB: int = int(os.getenv("IMAGE_CACHE_MAX_MB", "500"))
+    IMAGE_MAX_SOURCE_MB: int = 15  # larger source images are not proxied
+    IMAGE_FETCH_TIMEOUT: float = 10.0  # seconds
+    IMAGE_FAILURE_TTL: float = 600.0  # seconds a failing source is not fetched again
+    IMAGE_MAX_REDIRECTS: int = 5  # redirects followed per source, each to a public address
+    IMAGE_MAX_PIXELS: int = 40_000_000  # larger source images are not decoded
 
 
     # Workflow Settings
     MAX_CONCEPTS_PER_REQUEST: int = 10
     CONCEPT_CONFIDENCE_THRESHOLD: float = 0.7
 
+    # Prompt Settings
+    # Max prompt tokens per agent (text only, attached documents are not counted)
+    PROMPT_TOKEN_BUDGETS: dict = field(
+        default_factory=lambda: {
+            "extract_concepts": 1500,
+            "find_applications": 1500,
+            "roadmap": 2000,
+        }
+    )
+
+    # Run Settings
+    RUN_STATUS_TTL: float = 7 * 24 * 3600  # seconds run statuses are kept
+    # A running run's worker renews its lease every RUN_HEARTBEAT_INTERVAL; a run
+    # whose lease is older than RUN_LEASE_TTL is reported as interrupted
+    RUN_LEASE_TTL: float = 60.0
+    RUN_HEARTBEAT_INTERVAL: float = 15.0
+    DISCONNECT_POLL_INTERVAL: float = 1.0  # seconds between client disconnect checks
+    CHECKPOINT_DB: str = os.getenv("CHECKPOINT_DB", "tmp/checkpoints.sqlite")
+    # Lazy mode ends runs after applications; roadmaps are generated on request
+    LAZY_ROADMAPS: bool = os.getenv("LAZY_ROADMAPS", "false").lower() in ("1", "true")
+    PREFETCH_TOP_ROADMAP: bool = True  # in lazy mode, generate the first roadmap in the background
+    COURSE_EXTRACTION_CONCURRENCY: int = 4  # lectures of a course extracted at once
+    MAX_COURSE_DOCUMENTS: int = 30
+    PRECOMPUTED_DB: str = os.getenv("PRECOMPUTED_DB", "tmp/precomputed.sqlite")  # see src/precompute.py
+    SEARCH_INDEX_DB: str = os.getenv("SEARCH_INDEX_DB", "tmp/search.sqlite")  # see src/search_index.py
+    SEARCH_MAX_RESULTS: int = 50
+    # Documents are OCR'd once into per-page markdown (see src/pages.py)
+    OCR_MODEL: str = "mistral-ocr-latest"
+    PAGES_DB: str = os.getenv("PAGES_DB", "tmp/pages.sqlite")
+    EXTRACTION_MAX_DOCUMENT_CHARS: int = 200_000  # OCR'd text concepts are extracted from
+    CONCEPT_MAX_PAGES: int = 3  # pages indexed per concept, most mentions first
+    PAGE_EXCERPT_MAX_CHARS: int = 1500  # lecture excerpt given to the applications and roadmap agents
+
+    # Shared State Settings (run statuses, latest state, caches) for multiple workers
+    STATE_BACKEND: str = os.getenv("STATE_BACKEND", "sqlite")  # sqlite, redis or memory
+    STATE_DB: str = os.getenv("STATE_DB", "tmp/state.sqlite")
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    WORKERS: int = int(os.getenv("WORKERS", "1"))  # uvicorn worker processes
+    # Upstream caches (see src/cache.py): entries are served fresh until the soft
+    # TTL, then served stale while being refreshed until the hard TTL (seconds)
+    CACHE_TTLS: dict = field(
+        default_factory=lambda: {
+            "google_images": {"soft": 24 * 3600, "hard": 7 * 24 * 3600},
+            "applications": {"soft": 3 * 24 * 3600, "hard": 30 * 24 * 3600},
+            "roadmaps": {"soft": 7 * 24 * 3600, "hard": 30 * 24 * 3600},
+        }
+    )
+    CACHE_REFRESH_INTERVAL: float = 300.0  # seconds between refreshes of the popular entries
+    CACHE_REFRESH_TOP: int = 20  # most requested entries of each process kept hot
+    CACHE_REFRESH_AHEAD: float = 0.8  # popular entries are refreshed past this fraction of their soft TTL
+    CACHE_TRACKED_KEYS: int = 1000  # entries whose requests are counted, per process
+
+    # Tracing Settings
+    TRACE_MAX_RUNS: int = 200  # traces kept in memory for the waterfall endpoint
+    TRACE_EXPORT_PATH: str = os.getenv("TRACE_EXPORT_PATH", "tmp/traces.jsonl")
+    TRACE_EXPORT_MAX_MB: int = 50  # the export file is rotated past this size
+    TRACE_EXPORT_BACKUPS: int = 3  # rotated export files kept (traces.jsonl.1 is the newest)
+    TRACE_SHARED_TTL: float = 7 * 24 * 3600  # seconds finished traces are kept on the shared state backend
+    OTLP_ENDPOINT: str = os.getenv("OTLP_ENDPOINT", "")  # e.g. http://localhost:4318
+
+    # Admin / Profiling Settings
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")  # admin endpoints are disabled when empty
+    PROFILE_INTERVAL: float = 0.001  # sampling interval in seconds
+
+    # Event-Loop Monitor Settings
+    LOOP_MONITOR_INTERVAL: float = 0.1  # heartbeat period in seconds
+    LOOP_STALL_THRESHOLD: float = float(os.getenv("LOOP_STALL_THRESHOLD", "0.5"))
+    LOOP_STALL_HISTORY: int = 100  # recent stalls kept for /debug/stalls
+    LOOP_STALL_STACK_DEPTH: int = 15
+
     # File Settings
     # ALLOWED_IMAGE_EXTENSIONS: set = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"}
-    # MAX_FILE_SIZE_MB: int = 10
+    ALLOWED_DOCUMENT_EXTENSIONS: tuple = (".pdf", ".jpg", ".jpeg", ".png")
+    MAX_FILE_SIZE_MB: int = int(os.getenv("MAX_FILE_SIZE_MB", "50"))
+    DOCUMENTS_DIR: str = "tmp/documents"  # uploads, stored by SHA-256
+    BLOBS_DIR: str = "tmp/blobs"  # roadmaps, images and descriptions referenced from state
+    RUNS_DIR: str = "tmp/runs"  # artifacts of each run (e.g. profiles), under <run_id>/
+
+    # Storage Settings (see src/storage.py): runs, uploads, blobs, databases and
+    # traces share one disk quota
+    STORAGE_INDEX_DB: str = os.getenv("STORAGE_INDEX_DB", "tmp/storage.sqlite")
+    STORAGE_QUOTA_MB: int = int(os.getenv("STORAGE_QUOTA_MB", "2048"))
+    STORAGE_CLEANUP_INTERVAL: float = 300.0  # seconds between cleanups
+    LEGACY_PAGES_ROOT: str = "tmp"  # holds the <uuid>/page_*.jpg directories of older versions
 
     def validate(self) -> bool:
         """Validate that required configuration is present"""
@@ -7,6 +7,8 @@ from typing import Dict, List, Any, Optional, TypedDict
 
 
 class ApplicationData(TypedDict):
+    # images, description and RoadmapData are stored as blob references
+    # ({"$blob": id}) in the workflow state, see src/blobs.py
     concept_name: str  # Name of the concept this application relates to
     name: str
     brief_description: str
@@ -39,4 +41,8 @@ class WorkflowState(TypedDict):
     ]  # Key: concept name, Value: list of applications
     last_applications_timestamp = Optional[str]
     last_roadmap_timestamp = Optional[str]
+    course_documents: Optional[List[str]]  # lectures of a course run (document_path is empty)
+    document_hashes: Optional[List[str]]  # SHA-256 of the run's documents, keys of their OCR pages (src/pages.py)
+    lazy_roadmaps: Optional[bool]  # end after applications, roadmaps generated on request
+    degraded: Optional[Dict[str, List[str]]]  # degradation step -> concepts/applications it affected
     error: Optional[str]
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed store for uploaded lecture documents
+documents.py
+
+Uploads are streamed from the request body to disk chunk by chunk while
+their SHA-256 is computed, so memory stays flat whatever the file size.
+The hash is the document id: identical uploads are stored once.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from python_multipart import MultipartParser
+from python_multipart.multipart import parse_options_header
+
+from src.config import config
+from src.storage import storage
+
+logger = logging.getLogger(__name__)
+
+# Leading bytes of the accepted document types
+MAGIC_BYTES = {
+    ".pdf": (b"%PDF-",),
+    ".png": (b"\x89PNG\r\n\x1a\n",),
+    ".jpg": (b"\xff\xd8\xff",),
+    ".jpeg": (b"\xff\xd8\xff",),
+}
+# Bytes buffered before the type is checked, whatever the chunking of the body
+MAGIC_LENGTH = max(len(magic) for magics in MAGIC_BYTES.values() for magic in magics)
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file, the id of an uploaded document with the same content"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class UploadError(Exception):
+    """Rejected upload, carrying the HTTP status code to answer with"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class DocumentStore:
+    """Stores uploaded documents under `<root>/<sha256><ext>`"""
+
+    def __init__(self, root: str, max_size: int, allowed_extensions: tuple):
+        self.root = root
+        self.max_size = max_size
+        self.allowed_extensions = allowed_extensions
+
+    def _metadata_path(self, document_id: str) -> str:
+        return os.path.join(self.root, f"{document_id}.json")
+
+    def get_metadata(self, document_id: str) -> Optional[Dict[str, Any]]:
+        """Metadata of a stored document, or None if unknown"""
+        if not document_id.isalnum():
+            return None
+        try:
+            with open(self._metadata_path(document_id)) as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def get_path(self, document_id: str) -> Optional[str]:
+        """Path of a stored document, or None if unknown"""
+        metadata = self.get_metadata(document_id)
+        if metadata is None or not os.path.exists(metadata["path"]):
+            return None
+        return metadata["path"]
+
+    async def save_multipart(
+        self,
+        body: AsyncIterator[bytes],
+        content_type: str,
+        content_length: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        """Stream the first file part of a multipart body into the store
+
+        Raises:
+            UploadError: On a malformed body, a disallowed type or an oversized file
+        """
+        mime_type, params = parse_options_header(content_type)
+        boundary = params.get(b"boundary")
+        if mime_type != b"multipart/form-data" or not boundary:
+            raise UploadError(400, "Expected a multipart/form-data body")
+        # Reject early when the declared size already exceeds the limit
+        if content_length is not None and content_length > self.max_size + 64 * 1024:
+            raise UploadError(413, f"File exceeds {self.max_size} bytes")
+
+        os.makedirs(self.root, exist_ok=True)
+        incoming_path = os.path.join(self.root, f".incoming-{uuid.uuid4().hex}")
+        upload = _PartReceiver()
+        parser = MultipartParser(boundary, upload.callbacks())
+        sha256 = hashlib.sha256()
+        size = 0
+        head = b""
+        output = None
+
+        try:
+            async for chunk in body:
+                parser.write(chunk)
+                if upload.filename is None and upload.finished:
+                    break
+                data = upload.take_data()
+                if output is None:
+                    # The first chunks of a part can be a few bytes long: buffer
+                    # until the longest magic number can be checked
+                    head += data
+                    if not head or (len(head) < MAGIC_LENGTH and not upload.finished):
+                        continue
+                    extension = os.path.splitext(upload.filename or "")[1].lower()
+                    self._check_type(extension, head)
+                    output = open(incoming_path, "wb")
+                    data, head = head, b""
+                elif not data:
+                    continue
+
+                size += len(data)
+                if size > self.max_size:
+                    raise UploadError(413, f"File exceeds {self.max_size} bytes")
+                # Hash and write off the event loop
+                await asyncio.to_thread(_hash_and_write, sha256, output, data)
+                if upload.finished:
+                    break
+            parser.finalize()
+
+            if output is None:
+                raise UploadError(400, "No file part in the upload")
+            output.close()
+            return await asyncio.to_thread(
+                self._commit, incoming_path, sha256.hexdigest(), upload, size
+            )
+        finally:
+            if output is not None and not output.closed:
+                output.close()
+            if os.path.exists(incoming_path):
+                os.remove(incoming_path)
+
+    def _check_type(self, extension: str, head: bytes) -> None:
+        if extension not in self.allowed_extensions:
+            raise UploadError(
+                415,
+                f"Unsupported file type '{extension}', expected one of {list(self.allowed_extensions)}",
+            )
+        if not head.startswith(MAGIC_BYTES.get(extension, (b"",))):
+            raise UploadError(415, f"File content does not match its '{extension}' extension")
+
+    def _commit(
+        self, incoming_path: str, digest: str, upload: "_PartReceiver", size: int
+    ) -> Dict[str, Any]:
+        """Move a finished upload to its content address, deduplicating by hash"""
+        existing = self.get_metadata(digest)
+        if existing is not None and os.path.exists(existing["path"]):
+            logger.info(f"Upload deduplicated: {digest}")
+            storage.touch(existing["path"])
+            return {**existing, "deduplicated": True}
+
+        extension = os.path.splitext(upload.filename)[1].lower()
+        path = os.path.join(self.root, f"{digest}{extension}")
+        os.replace(incoming_path, path)
+        metadata = {
+            "document_id": digest,
+            "filename": os.path.basename(upload.filename),
+            "content_type": upload.content_type,
+            "size": size,
+            "path": path,
+            "created": time.time(),
+        }
+        with open(self._metadata_path(digest), "w") as f:
+            json.dump(metadata, f, indent=4)
+        storage.record(path, "document")
+        logger.info(f"Stored upload {metadata['filename']} as {digest} ({size} bytes)")
+        return {**metadata, "deduplicated": False}
+
+
+def _hash_and_write(sha256, output, data: bytes) -> None:
+    sha256.update(data)
+    output.write(data)
+
+
+class _PartReceiver:
+    """Collects the headers and data of the first file part from the parser"""
+
+    def __init__(self):
+        self.filename: Optional[str] = None
+        self.content_type: str = ""
+        self.finished = False
+        self._in_file = False
+        self._done_with_file = False
+        self._data: List[bytes] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: Dict[bytes, bytes] = {}
+
+    def callbacks(self) -> Dict[str, Any]:
+        return {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_end": self._on_end,
+        }
+
+    def take_data(self) -> bytes:
+        data = b"".join(self._data)
+        self._data.clear()
+        return data
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        filename = options.get(b"filename")
+        # Only the first part carrying a file is stored, form fields are ignored
+        if filename is not None and self.filename is None:
+            self.filename = filename.decode("utf-8", errors="replace")
+            self.content_type = self._headers.get(b"content-type", b"").decode()
+            self._in_file = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._in_file:
+            self._data.append(data[start:end])
+
+    def _on_part_end(self) -> None:
+        if self._in_file:
+            self._in_file = False
+            self.finished = True
+
+    def _on_end(self) -> None:
+        self.finished = True
+
+
+document_store = DocumentStore(
+    root=config.DOCUMENTS_DIR,
+    max_size=config.MAX_FILE_SIZE_MB * 1024 * 1024,
+    allowed_extensions=config.ALLOWED_DOCUMENT_EXTENSIONS,
+)
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""Proxy and resize cache for the images found by image search
+image_proxy.py
+
+Image search returns full-size images on arbitrary hosts. Their URLs are
+registered here instead and rewritten to `/images/<id>/<size>`: the first
+request fetches the source once, renders every size of IMAGE_SIZES as WebP
+and JPEG, and stores the variants under IMAGES_DIR. Later requests are
+served from disk. The cache is bounded by IMAGE_CACHE_MAX_MB; the least
+recently served variants are evicted first and rendered again on request.
+
+An image id is the blob id of its source URL (see src/blobs.py), so only
+URLs returned by image search can be fetched through the proxy. Every hop
+of a fetch (redirects are followed one by one) must resolve to a public
+address, and the connection goes to the address that was checked, so the
+proxy cannot be pointed at the internal network. Sources over
+IMAGE_MAX_PIXELS are rejected before they are decoded.
+"""
+
+import asyncio
+import io
+import ipaddress
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from PIL import Image, ImageOps
+
+from src.blobs import blob_store
+from src.config import config
+from src.metrics import track_upstream
+from src.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Format -> (Pillow format, media type), preferred first
+FORMATS = {
+    "webp": ("WEBP", "image/webp"),
+    "jpg": ("JPEG", "image/jpeg"),
+}
+SOURCE_KEY = "image_url"
+# Variants served within this many seconds of their last access are not touched again
+ACCESS_RESOLUTION = 3600
+
+
+class ImageProxyError(Exception):
+    """Image that cannot be served, carrying the HTTP status code to answer with"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def negotiate_format(accept: Optional[str]) -> str:
+    """WebP for the clients accepting it, else JPEG"""
+    return "webp" if accept and "image/webp" in accept else "jpg"
+
+
+def render_variants(
+    data: bytes, sizes: Dict[str, int], quality: int, max_pixels: int
+) -> Dict[Tuple[str, str], bytes]:
+    """Every (size, format) variant of an image, scaled down to fit `sizes` (longest side in px)
+
+    Raises:
+        ImageProxyError: If `data` is not an image Pillow can read, or has
+            more than `max_pixels` pixels
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            # Only the header is read so far
+            if source.width * source.height > max_pixels:
+                raise ImageProxyError(502, "Source image is too large")
+            # JPEGs are decoded at the smallest scale still covering the largest size
+            side = max(sizes.values())
+            source.draft("RGB", (side, side))
+            image = ImageOps.exif_transpose(source)
+            image.load()
+    except ImageProxyError:
+        raise
+    except Exception as e:
+        logger.warning(f"Could not read source image: {e}")
+        raise ImageProxyError(502, "Source is not a readable image") from e
+
+    if image.mode in ("P", "LA") or (image.mode == "RGB" and "transparency" in image.info):
+        image = image.convert("RGBA")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+
+    variants = {}
+    for size, side in sizes.items():
+        resized = image.copy()
+        resized.thumbnail((side, side), Image.Resampling.LANCZOS)  # never upscales
+        for fmt, (pillow_format, _) in FORMATS.items():
+            output = resized
+            if pillow_format == "JPEG" and output.mode == "RGBA":
+                # JPEG has no alpha: flatten on white
+                output = Image.new("RGB", resized.size, "white")
+                output.paste(resized, mask=resized.getchannel("A"))
+            buffer = io.BytesIO()
+            output.save(buffer, pillow_format, quality=quality)
+            variants[(size, fmt)] = buffer.getvalue()
+    return variants
+
+
+async def _public_address(host: str, port: int) -> str:
+    """An address `host` resolves to, if every address it resolves to is public
+
+    Raises:
+        ValueError: If `host` resolves to a private, loopback, link-local or
+            otherwise non-public address
+    """
+    infos = await asyncio.get_running_loop().getaddrinfo(
+        host, port, type=socket.SOCK_STREAM
+    )
+    addresses = [info[4][0] for info in infos]
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"{host} resolves to a non-public address")
+    if not addresses:
+        raise ValueError(f"{host} does not resolve")
+    return addresses[0]
+
+
+async def _pinned_request(client: httpx.AsyncClient, url: httpx.URL) -> httpx.Request:
+    """Request for `url` sent to the public address its host was checked
+    against, so a second DNS answer cannot point it elsewhere"""
+    if url.scheme not in ("http", "https"):
+        raise ValueError(f"Unsupported scheme: {url.scheme}")
+    port = url.port or (443 if url.scheme == "https" else 80)
+    address = await _public_address(url.host, port)
+    return client.build_request(
+        "GET",
+        url.copy_with(host=address),
+        headers={"Host": url.netloc.decode("ascii")},
+        # TLS is still verified against the host name
+        extensions={"sni_hostname": url.host},
+    )
+
+
+class ImageProxy:
+    """Resized variants of proxied images under `<root>/<id>-<size>.<format>`"""
+
+    def __init__(
+        self,
+        root: str,
+        sizes: Dict[str, int],
+        max_bytes: int,
+        max_source_bytes: int,
+        quality: int,
+        failure_ttl: float,
+        max_redirects: int,
+        max_pixels: int,
+    ):
+        self.root = root
+        self.sizes = sizes
+        self.max_bytes = max_bytes
+        self.max_source_bytes = max_source_bytes
+        self.quality = quality
+        self.failure_ttl = failure_ttl
+        self.max_redirects = max_redirects
+        self.max_pixels = max_pixels
+        self._flights = SingleFlight("image_proxy")
+        # image id -> time its source last failed, so broken hosts are not hammered
+        self._failures: Dict[str, float] = {}
+        self._size: Optional[int] = None  # bytes on disk, computed on first write
+        # Guards `_size` and eviction: variants are stored from worker threads
+        self._size_lock = threading.Lock()
+
+    # --- URLs -----------------------------------------------------------------
+
+    def proxy_url(self, url: str, size: str) -> str:
+        """Proxy URL serving `url` at `size` (registers the source)"""
+        image_id = blob_store.put({SOURCE_KEY: url})["$blob"]
+        return f"/images/{image_id}/{size}"
+
+    def rewrite(self, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Copy of image search results pointing at the proxy: `url` at card
+        size, `thumbnail` at thumbnail size, the original kept in `source_url`"""
+        rewritten = []
+        for image in images:
+            url = image.get("url")
+            if not url or not url.startswith(("http://", "https://")):
+                continue
+            rewritten.append(
+                {
+                    **image,
+                    "url": self.proxy_url(url, "card"),
+                    "thumbnail": self.proxy_url(url, "thumb"),
+                    "source_url": url,
+                }
+            )
+        return rewritten
+
+    async def arewrite(self, images: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self.rewrite, images)
+
+    # --- Serving --------------------------------------------------------------
+
+    def _variant_path(self, image_id: str, size: str, fmt: str) -> str:
+        return os.path.join(self.root, f"{image_id}-{size}.{fmt}")
+
+    def _source_url(self, image_id: str) -> str:
+        try:
+            source = blob_store.get(image_id)
+        except KeyError:
+            raise ImageProxyError(404, f"Unknown image: {image_id}")
+        if not isinstance(source, dict) or SOURCE_KEY not in source:
+            raise ImageProxyError(404, f"Unknown image: {image_id}")
+        return source[SOURCE_KEY]
+
+    def _cached_variant(self, image_id: str, size: str, fmt: str) -> Optional[str]:
+        """Path of a stored variant, marked as recently used, or None"""
+        path = self._variant_path(image_id, size, fmt)
+        try:
+            if time.time() - os.stat(path).st_mtime > ACCESS_RESOLUTION:
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    async def get(self, image_id: str, size: str, fmt: str) -> str:
+        """Path of the variant of an image, fetching and rendering it on a miss
+
+        Raises:
+            ImageProxyError: If the image, size or format is unknown, or its
+                source cannot be fetched or read
+        """
+        if len(image_id) != 64 or not all(c in "0123456789abcdef" for c in image_id):
+            raise ImageProxyError(404, f"Unknown image: {image_id}")
+        if size not in self.sizes:
+            raise ImageProxyError(404, f"Unknown size '{size}', expected one of {list(self.sizes)}")
+        if fmt not in FORMATS:
+            raise ImageProxyError(404, f"Unknown format '{fmt}'")
+        path = await asyncio.to_thread(self._cached_variant, image_id, size, fmt)
+        if path is not None:
+            return path
+
+        failed_at = self._failures.get(image_id)
+        if failed_at is not None and time.time() - failed_at < self.failure_ttl:
+            raise ImageProxyError(502, "Image source recently failed")
+        source_url = await asyncio.to_thread(self._source_url, image_id)
+        try:
+            await self._flights.do(image_id, lambda: self._fetch_and_render(image_id, source_url))
+        except ImageProxyError as e:
+            if e.status_code == 502:
+                now = time.time()
+                self._failures = {
+                    k: t for k, t in self._failures.items() if now - t < self.failure_ttl
+                }
+                self._failures[image_id] = now
+            raise
+        return self._variant_path(image_id, size, fmt)
+
+    async def _fetch_and_render(self, image_id: str, source_url: str) -> None:
+        data = await self._fetch(source_url)
+        variants = await asyncio.to_thread(
+            render_variants, data, self.sizes, self.quality, self.max_pixels
+        )
+        await asyncio.to_thread(self._store, image_id, variants)
+        self._failures.pop(image_id, None)
+
+    async def _fetch(self, url: str) -> bytes:
+        """Bytes of a source image, at most `max_source_bytes`
+
+        Raises:
+            ImageProxyError: If the source cannot be fetched, is too large or
+                is not on a public address
+        """
+        try:
+            async with httpx.AsyncClient(
+                timeout=config.IMAGE_FETCH_TIMEOUT,
+                headers={"User-Agent": "motivate-me-image-proxy/1.0"},
+            ) as client, track_upstream("image_host", "fetch") as upstream:
+                target = httpx.URL(url)
+                for _ in range(self.max_redirects + 1):
+                    response = await client.send(await _pinned_request(client, target), stream=True)
+                    try:
+                        upstream["status"] = response.status_code
+                        if not response.is_redirect:
+                            response.raise_for_status()
+                            return await self._read(response)
+                        target = target.join(response.headers["location"])
+                    finally:
+                        await response.aclose()
+                raise ImageProxyError(502, "Could not fetch image")
+        except (httpx.HTTPError, httpx.InvalidURL, OSError, KeyError, ValueError) as e:
+            logger.warning(f"Could not fetch image {url}: {e!r}")
+            raise ImageProxyError(502, "Could not fetch image") from e
+
+    async def _read(self, response: httpx.Response) -> bytes:
+        chunks = []
+        received = 0
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            if received > self.max_source_bytes:
+                raise ImageProxyError(502, "Source image is too large")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _store(self, image_id: str, variants: Dict[Tuple[str, str], bytes]) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        written = 0
+        for (size, fmt), data in variants.items():
+            # Write then rename, so readers never see a partial image
+            incoming_path = os.path.join(self.root, f".incoming-{uuid.uuid4().hex}")
+            with open(incoming_path, "wb") as f:
+                f.write(data)
+            os.replace(incoming_path, self._variant_path(image_id, size, fmt))
+            written += len(data)
+
+        with self._size_lock:
+            if self._size is None:
+                self._size = self.disk_usage()
+            else:
+                self._size += written
+            if self._size > self.max_bytes:
+                self._size = self.evict()
+
+    # --- Eviction -------------------------------------------------------------
+
+    def _variants(self) -> List[os.DirEntry]:
+        try:
+            with os.scandir(self.root) as entries:
+                return [e for e in entries if e.is_file() and not e.name.startswith(".")]
+        except FileNotFoundError:
+            return []
+
+    def disk_usage(self) -> int:
+        return sum(entry.stat().st_size for entry in self._variants())
+
+    def evict(self) -> int:
+        """Delete the least recently served variants until the cache is 10% under
+        its bound; returns the bytes left"""
+        entries = sorted(self._variants(), key=lambda e: e.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        for entry in entries:
+            if total <= target:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.info(f"Evicted {evicted} cached image variants, {total / 2**20:.1f} MB left")
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        entries = self._variants()
+        return {
+            "variants": len(entries),
+            "bytes": sum(entry.stat().st_size for entry in entries),
+            "max_bytes": self.max_bytes,
+            "failing_sources": len(self._failures),
+        }
+
+
+image_proxy = ImageProxy(
+    root=config.IMAGES_DIR,
+    sizes=config.IMAGE_SIZES,
+    max_bytes=config.IMAGE_CACHE_MAX_MB * 2**20,
+    max_source_bytes=config.IMAGE_MAX_SOURCE_MB * 2**20,
+    quality=config.IMAGE_QUALITY,
+    failure_ttl=config.IMAGE_FAILURE_TTL,
+    max_redirects=config.IMAGE_MAX_REDIRECTS,
+    max_pixels=config.IMAGE_MAX_PIXELS,
+)
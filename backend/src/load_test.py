@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""Load and soak test harness for the FastAPI app
+load_test.py
+
+Drives `/run_workflow/` and `/get_workflow_state/` with open-loop (Poisson)
+arrivals against mocked Mistral and Google upstreams, and reports throughput,
+per-endpoint latency percentiles, event-loop lag and RSS growth.
+
+RUN (from backend/):
+    python -m src.load_test --rate 2 --duration 60
+    python -m src.load_test --rate 0.5 --duration 1800 --mistral-latency 1.5   # soak
+    python -m src.load_test --url http://127.0.0.1:8000 --rate 1 --duration 60  # external server
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import statistics
+import time
+import types
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from src.utils import percentile
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------
+# Mocked upstreams
+# ---------------------------------------------------------------------------
+
+
+def _jittered(latency: float) -> float:
+    """Return the latency with +/-50% uniform jitter"""
+    return max(0.0, random.uniform(latency * 0.5, latency * 1.5))
+
+
+def _message(content: str) -> Any:
+    """Build an object shaped like a Mistral chat completion response"""
+    message = types.SimpleNamespace(content=content)
+    usage = types.SimpleNamespace(
+        prompt_tokens=len(content) // 4, completion_tokens=len(content) // 4
+    )
+    return types.SimpleNamespace(
+        choices=[types.SimpleNamespace(message=message)], usage=usage
+    )
+
+
+class MockChat:
+    """Stand-in for `Mistral.chat` returning canned JSON for one agent"""
+
+    def __init__(
+        self, kind: str, latency: float, concepts: int, applications: int, malformed_rate: float = 0.0
+    ):
+        self.kind = kind
+        self.malformed_rate = malformed_rate
+        self.latency = latency
+        self.concepts = concepts
+        self.applications = applications
+
+    def _content(self) -> str:
+        if self.kind == "concepts":
+            return json.dumps(
+                [
+                    {
+                        "name": f"Concept {i}",
+                        "type": "theorem",
+                        "domain": "mathematics",
+                        "significance": "Mocked concept",
+                        "confidence": 0.9,
+                    }
+                    for i in range(self.concepts)
+                ]
+            )
+        if self.kind == "applications":
+            return json.dumps(
+                [
+                    {
+                        "name": f"Application {i}",
+                        "brief_description": "Mocked application",
+                        "description": "Mocked application description " * 20,
+                    }
+                    for i in range(self.applications)
+                ]
+            )
+        rows = [["Topic", "5 hours", "Mocked topic description"]] * 3
+        return json.dumps(
+            {
+                "title": "Mocked roadmap",
+                "description_1": rows,
+                "description_2": rows,
+                "description_3": rows,
+            }
+        )
+
+    def _reply(self) -> str:
+        """Canned content, with one of the usual LLM defects at `malformed_rate`"""
+        content = self._content()
+        if random.random() >= self.malformed_rate:
+            return content
+        defect = random.choice(("truncated", "fenced", "wrapped"))
+        if defect == "truncated":
+            return content[: int(len(content) * 0.7)]
+        if defect == "fenced":
+            return f"Here is the JSON:\n```json\n{content}\n```"
+        return json.dumps({self.kind: json.loads(content)})
+
+    def complete(self, **kwargs) -> Any:
+        # The real SDK call is blocking, so the mock blocks too
+        time.sleep(_jittered(self.latency))
+        return _message(self._reply())
+
+    async def complete_async(self, **kwargs) -> Any:
+        await asyncio.sleep(_jittered(self.latency))
+        return _message(self._reply())
+
+
+class MockFiles:
+    """Stand-in for `Mistral.files`"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+
+    def upload(self, file: Dict[str, Any], purpose: str) -> Any:
+        time.sleep(_jittered(self.latency))
+        return types.SimpleNamespace(id="mock-file-id")
+
+    async def upload_async(self, file: Dict[str, Any], purpose: str) -> Any:
+        await asyncio.sleep(_jittered(self.latency))
+        return types.SimpleNamespace(id="mock-file-id")
+
+    def get_signed_url(self, file_id: str) -> Any:
+        return types.SimpleNamespace(url=f"https://mock.invalid/{file_id}")
+
+    async def get_signed_url_async(self, file_id: str) -> Any:
+        return types.SimpleNamespace(url=f"https://mock.invalid/{file_id}")
+
+
+class MockOCR:
+    """Stand-in for `Mistral.ocr`, one page per mocked concept"""
+
+    def __init__(self, latency: float, concepts: int):
+        self.latency = latency
+        self.concepts = concepts
+
+    def _response(self) -> Any:
+        pages = [
+            types.SimpleNamespace(
+                index=i,
+                markdown=f"# Lecture part {i + 1}\n\nConcept {i} is introduced here.\n\nMocked page content.",
+            )
+            for i in range(self.concepts)
+        ]
+        return types.SimpleNamespace(pages=pages)
+
+    def process(self, model: str, document: Dict[str, Any]) -> Any:
+        time.sleep(_jittered(self.latency))
+        return self._response()
+
+    async def process_async(self, model: str, document: Dict[str, Any]) -> Any:
+        await asyncio.sleep(_jittered(self.latency))
+        return self._response()
+
+
+class MockMistral:
+    """Stand-in for the `Mistral` client used by the agents"""
+
+    def __init__(self, kind: str, args: argparse.Namespace):
+        self.chat = MockChat(
+            kind, args.mistral_latency, args.concepts, args.applications, args.malformed_rate
+        )
+        self.files = MockFiles(args.upload_latency)
+        self.ocr = MockOCR(args.upload_latency, args.concepts)
+
+
+def install_mock_upstreams(orchestrator: Any, args: argparse.Namespace) -> None:
+    """Replace the Mistral clients and Google image search with local mocks"""
+    import src.agents.find_applications as find_applications
+
+    orchestrator._agent_concept_extractor.mistral_client = MockMistral(
+        "concepts", args
+    )
+    orchestrator._agent_applications_finder.mistral_client = MockMistral(
+        "applications", args
+    )
+    orchestrator._agent_roadmap.mistral_client = MockMistral("roadmap", args)
+
+    async def mock_search_google_images(query: str) -> List[Dict[str, Any]]:
+        await asyncio.sleep(_jittered(args.image_latency))
+        return [
+            {
+                "url": "https://mock.invalid/image.jpg",
+                "title": query,
+                "thumbnail": "https://mock.invalid/thumb.jpg",
+                "context": "",
+                "width": 640,
+                "height": 480,
+            }
+        ]
+
+    find_applications.search_google_images = mock_search_google_images
+
+
+# ---------------------------------------------------------------------------
+# Measurements
+# ---------------------------------------------------------------------------
+
+
+def current_rss_mb() -> float:
+    """Resident set size of this process in MB"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        # Not Linux: fall back to the peak RSS (KB on Linux, bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 if peak < 1 << 32 else peak / (1024 * 1024)
+
+
+def linear_slope(points: List[tuple]) -> float:
+    """Least-squares slope of (x, y) points"""
+    if len(points) < 2:
+        return 0.0
+    xs, ys = zip(*points)
+    mean_x, mean_y = statistics.fmean(xs), statistics.fmean(ys)
+    denominator = sum((x - mean_x) ** 2 for x in xs)
+    if denominator == 0:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / denominator
+
+
+class LoadStats:
+    """Collects latencies, errors, loop lag and RSS samples during a test"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.loop_lag: List[float] = []
+        self.rss: List[tuple] = []
+        self.runs_started = 0
+        self.runs_completed = 0
+
+    def record(self, endpoint: str, seconds: float, ok: bool) -> None:
+        self.latencies[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        endpoints = {}
+        for endpoint, values in self.latencies.items():
+            endpoints[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_rps": len(values) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p95_ms": percentile(values, 95) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+                "max_ms": max(values) * 1000 if values else 0.0,
+            }
+        rss_values = [rss for _, rss in self.rss]
+        return {
+            "elapsed_s": elapsed,
+            "runs_started": self.runs_started,
+            "runs_completed": self.runs_completed,
+            "runs_per_minute": self.runs_completed / elapsed * 60 if elapsed else 0.0,
+            "endpoints": endpoints,
+            "loop_lag_ms": {
+                "p50": percentile(self.loop_lag, 50) * 1000,
+                "p99": percentile(self.loop_lag, 99) * 1000,
+                "max": max(self.loop_lag, default=0.0) * 1000,
+            },
+            "rss_mb": {
+                "start": rss_values[0] if rss_values else 0.0,
+                "end": rss_values[-1] if rss_values else 0.0,
+                "peak": max(rss_values, default=0.0),
+                "growth_mb_per_min": linear_slope(self.rss) * 60,
+            },
+        }
+
+
+async def sample_loop_lag(stats: LoadStats, interval: float, stop: asyncio.Event) -> None:
+    """Measure how late the event loop wakes up a sleeping task"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def sample_rss(stats: LoadStats, interval: float, stop: asyncio.Event) -> None:
+    """Record RSS periodically so growth over a soak can be fitted"""
+    origin = time.perf_counter()
+    while not stop.is_set():
+        stats.rss.append((time.perf_counter() - origin, current_rss_mb()))
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+    stats.rss.append((time.perf_counter() - origin, current_rss_mb()))
+
+
+# ---------------------------------------------------------------------------
+# Load generation
+# ---------------------------------------------------------------------------
+
+
+async def timed_request(
+    client: httpx.AsyncClient,
+    stats: LoadStats,
+    endpoint: str,
+    method: str,
+    url: str,
+    **kwargs,
+) -> Optional[httpx.Response]:
+    """Send one request and record its latency under `endpoint`"""
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        stats.record(endpoint, time.perf_counter() - start, response.is_success)
+        return response
+    except httpx.HTTPError as e:
+        logger.debug(f"{endpoint} failed: {e}")
+        stats.record(endpoint, time.perf_counter() - start, False)
+        return None
+
+
+async def simulate_student(
+    client: httpx.AsyncClient, stats: LoadStats, args: argparse.Namespace
+) -> None:
+    """One student: submit a lecture and poll the state until the run ends"""
+    stats.runs_started += 1
+    payload = {"file_name": args.file_name, "user_query": args.user_query}
+    run = asyncio.create_task(
+        timed_request(client, stats, "run_workflow", "POST", "/run_workflow/", json=payload)
+    )
+    while not run.done():
+        await timed_request(
+            client, stats, "get_workflow_state", "GET", "/get_workflow_state/"
+        )
+        await asyncio.wait({run}, timeout=args.poll_interval)
+    response = run.result()
+    if response is not None and response.is_success:
+        stats.runs_completed += 1
+
+
+async def generate_load(client: httpx.AsyncClient, args: argparse.Namespace) -> Dict[str, Any]:
+    """Start students at Poisson arrival times for `args.duration` seconds"""
+    stats = LoadStats()
+    stop = asyncio.Event()
+    samplers = [
+        asyncio.create_task(sample_loop_lag(stats, args.lag_interval, stop)),
+        asyncio.create_task(sample_rss(stats, args.rss_interval, stop)),
+    ]
+    students = set()
+    start = time.perf_counter()
+    deadline = start + args.duration
+
+    while time.perf_counter() < deadline:
+        if args.max_in_flight and len(students) >= args.max_in_flight:
+            await asyncio.wait(students, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            task = asyncio.create_task(simulate_student(client, stats, args))
+            students.add(task)
+            task.add_done_callback(students.discard)
+            await asyncio.sleep(random.expovariate(args.rate))
+
+    if students:
+        logger.info(f"Waiting for {len(students)} in-flight runs to finish")
+        await asyncio.wait(students, timeout=args.drain_timeout)
+        for task in students:
+            task.cancel()
+
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await asyncio.gather(*samplers)
+    return stats.report(elapsed)
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """Print the report as a readable table"""
+    print("\n=== Load Test Report ===")
+    print(
+        f"Elapsed: {report['elapsed_s']:.1f}s | runs started: {report['runs_started']}"
+        f" | completed: {report['runs_completed']}"
+        f" ({report['runs_per_minute']:.1f}/min)"
+    )
+    print(
+        f"{'endpoint':<22}{'reqs':>7}{'errs':>6}{'rps':>8}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    for endpoint, row in report["endpoints"].items():
+        print(
+            f"{endpoint:<22}{row['requests']:>7}{row['errors']:>6}"
+            f"{row['throughput_rps']:>8.2f}{row['p50_ms']:>10.1f}"
+            f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}{row['max_ms']:>10.1f}"
+        )
+    lag = report["loop_lag_ms"]
+    print(f"Event-loop lag ms: p50={lag['p50']:.1f} p99={lag['p99']:.1f} max={lag['max']:.1f}")
+    rss = report["rss_mb"]
+    print(
+        f"RSS MB: start={rss['start']:.1f} end={rss['end']:.1f} peak={rss['peak']:.1f}"
+        f" growth={rss['growth_mb_per_min']:.2f} MB/min"
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load/soak test the motivate-me API")
+    parser.add_argument("--url", default=None, help="Target a running server instead of the in-process app (no mocks, lag/RSS are client-side)")
+    parser.add_argument("--rate", type=float, default=1.0, help="Mean run arrivals per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to keep generating arrivals")
+    parser.add_argument("--max-in-flight", type=int, default=0, help="Cap on concurrent students (0 = open loop)")
+    parser.add_argument("--drain-timeout", type=float, default=600.0, help="Seconds to wait for in-flight runs at the end")
+    parser.add_argument("--poll-interval", type=float, default=2.0, help="Seconds between state polls, like the frontend")
+    parser.add_argument("--file-name", default="linear_algebra_2.pdf", help="Document in tmp/ to submit")
+    parser.add_argument("--user-query", default="Signal processing for music apps")
+    parser.add_argument("--mistral-latency", type=float, default=0.5, help="Mean mocked Mistral chat latency (s)")
+    parser.add_argument("--upload-latency", type=float, default=0.2, help="Mean mocked Mistral file upload and OCR latency (s)")
+    parser.add_argument("--image-latency", type=float, default=0.2, help="Mean mocked Google image search latency (s)")
+    parser.add_argument("--concepts", type=int, default=3, help="Concepts returned by the mocked extractor")
+    parser.add_argument("--applications", type=int, default=2, help="Applications returned per concept")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of mocked LLM replies with a defect (truncated, fenced, wrapped)")
+    parser.add_argument("--lag-interval", type=float, default=0.1, help="Event-loop lag sampling interval (s)")
+    parser.add_argument("--rss-interval", type=float, default=5.0, help="RSS sampling interval (s)")
+    parser.add_argument("--output", default=None, help="Write the JSON report to this path")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    timeout = httpx.Timeout(args.drain_timeout)
+    if args.url:
+        async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as client:
+            return await generate_load(client, args)
+
+    import app as app_module
+
+    install_mock_upstreams(app_module.orchestrator, args)
+    transport = httpx.ASGITransport(app=app_module.app)
+    # ASGITransport does not send lifespan events, so run the app's lifespan here
+    async with app_module.lifespan(app_module.app), httpx.AsyncClient(
+        transport=transport, base_url="http://load-test", timeout=timeout
+    ) as client:
+        return await generate_load(client, args)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    logging.getLogger("src").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = asyncio.run(main(arguments))
+    print_report(result)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump(result, f, indent=4)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Event-loop stall detector
+loop_monitor.py
+
+A heartbeat task measures loop lag continuously. A watchdog thread notices
+when the heartbeat stops for longer than the threshold and captures the
+stack of the loop thread while it is still blocked, together with the run
+id and graph node of the task that was running.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from prometheus_client import Counter, Histogram
+
+from src.config import config
+from src.tracing import _current_span, node_of
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop wakes up a sleeping heartbeat task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+LOOP_STALLS = Counter(
+    "event_loop_stalls_total",
+    "Event-loop stalls longer than the configured threshold",
+    ["node"],
+)
+
+
+class LoopMonitor:
+    """Measures event-loop lag and captures the blocking frame of stalls"""
+
+    def __init__(self, interval: float, threshold: float, history: int):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=history)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._heartbeat: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self) -> None:
+        """Start monitoring the running loop (call from inside it)"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._heartbeat = self._loop.create_task(self._beat())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.cancel()
+            try:
+                await self._heartbeat
+            except asyncio.CancelledError:
+                pass
+        if self._watchdog:
+            self._watchdog.join(timeout=self.interval * 2)
+
+    async def _beat(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            LOOP_LAG.observe(max(0.0, now - start - self.interval))
+            self._last_beat = now
+
+    def _watch(self) -> None:
+        captured_beat = None
+        while not self._stop.wait(self.interval / 2):
+            last_beat = self._last_beat
+            blocked_for = time.monotonic() - last_beat
+            # Capture each stall once, while the loop thread is still blocked
+            if blocked_for > self.threshold and captured_beat != last_beat:
+                captured_beat = last_beat
+                self._capture(blocked_for)
+
+    def _capture(self, blocked_for: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = traceback.format_stack(frame) if frame else []
+        run_id, node = self._running_context()
+        blocking_frame = (
+            f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}"
+            if frame
+            else "unknown"
+        )
+
+        stall = {
+            "timestamp": time.time(),
+            "blocked_for_s": round(blocked_for, 3),
+            "run_id": run_id,
+            "node": node,
+            "blocking_frame": blocking_frame,
+            "stack": stack[-config.LOOP_STALL_STACK_DEPTH:],
+        }
+        self.stalls.append(stall)
+        LOOP_STALLS.labels(node=node or "none").inc()
+        logger.warning(
+            f"Event loop blocked for {blocked_for:.2f}s+ (run={run_id}, node={node}) "
+            f"at {blocking_frame}\n" + "".join(stall["stack"])
+        )
+
+    def _running_context(self):
+        """Run id and graph node of the task currently running on the loop"""
+        try:
+            task = asyncio.tasks._current_tasks.get(self._loop)
+            if task is None:
+                return None, None
+            current = task.get_context().get(_current_span)
+        except Exception:
+            return None, None
+        if current is None:
+            return None, None
+        return current.trace_id, node_of(current)
+
+
+loop_monitor = LoopMonitor(
+    interval=config.LOOP_MONITOR_INTERVAL,
+    threshold=config.LOOP_STALL_THRESHOLD,
+    history=config.LOOP_STALL_HISTORY,
+)
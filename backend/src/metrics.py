@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Prometheus metrics for the workflow, upstream calls and caches
+metrics.py
+"""
+
+import functools
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# LLM and graph nodes take seconds to minutes, so extend the default buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+NODE_LATENCY = Histogram(
+    "workflow_node_duration_seconds",
+    "Duration of each LangGraph node",
+    ["node", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+RUN_LATENCY = Histogram(
+    "workflow_run_duration_seconds",
+    "Duration of a full workflow run",
+    ["status"],
+    buckets=LATENCY_BUCKETS,
+)
+RUNS_IN_FLIGHT = Gauge(
+    "workflow_runs_in_flight",
+    "Workflow runs currently executing",
+    multiprocess_mode="livesum",
+)
+RUNS_CANCELLED = Counter(
+    "workflow_runs_cancelled_total",
+    "Workflow runs cancelled, by reason (requested/superseded/disconnected)",
+    ["reason"],
+)
+DEGRADATIONS = Counter(
+    "workflow_degradations_total",
+    "Concepts or applications degraded to meet a run deadline, by step",
+    ["step"],
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Duration of calls to upstream services",
+    ["upstream", "operation", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_QUEUE_WAIT = Histogram(
+    "upstream_queue_wait_seconds",
+    "Time upstream calls waited for a scheduler slot, by priority class",
+    ["upstream", "priority"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total",
+    "Tokens consumed by LLM calls",
+    ["agent", "model", "kind"],
+)
+PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens",
+    "Prompt size per LLM call, counted with the local tokenizer",
+    ["agent"],
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000),
+)
+MODEL_ROUTES = Counter(
+    "llm_model_routes_total",
+    "LLM calls by chosen model and routing reason (primary/degraded/budget/fallback/failover)",
+    ["agent", "model", "reason"],
+)
+LLM_OUTPUTS = Counter(
+    "llm_outputs_total",
+    "Parsed LLM outputs by outcome (valid/repaired/reasked/invalid)",
+    ["agent", "outcome"],
+)
+COALESCED_CALLS = Counter(
+    "upstream_coalesced_total",
+    "Calls that joined an identical call in flight instead of making their own",
+    ["call"],
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "Cache lookups by result (hit/stale/miss)",
+    ["cache", "result"],
+)
+
+
+def instrument_node(name: str, node: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Wrap a LangGraph node so its duration is recorded under `name`"""
+
+    @functools.wraps(node)
+    async def wrapper(state, *args, **kwargs):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            result = await node(state, *args, **kwargs)
+            if isinstance(result, dict) and result.get("error"):
+                status = "error"
+            return result
+        except BaseException:
+            status = "exception"
+            raise
+        finally:
+            NODE_LATENCY.labels(node=name, status=status).observe(
+                time.perf_counter() - start
+            )
+
+    return wrapper
+
+
+@asynccontextmanager
+async def track_upstream(upstream: str, operation: str):
+    """Time an upstream call; the caller may set `ctx["status"]` (e.g. HTTP code)"""
+    ctx = {"status": "ok"}
+    start = time.perf_counter()
+    try:
+        yield ctx
+    except BaseException as e:
+        if ctx["status"] == "ok":
+            ctx["status"] = type(e).__name__
+        raise
+    finally:
+        UPSTREAM_LATENCY.labels(
+            upstream=upstream, operation=operation, status=str(ctx["status"])
+        ).observe(time.perf_counter() - start)
+
+
+def record_llm_usage(agent: str, model: str, response: Any) -> None:
+    """Count prompt/completion tokens reported in a Mistral response"""
+    usage: Optional[Any] = getattr(response, "usage", None)
+    if usage is None:
+        return
+    LLM_TOKENS.labels(agent=agent, model=model, kind="prompt").inc(
+        getattr(usage, "prompt_tokens", 0) or 0
+    )
+    LLM_TOKENS.labels(agent=agent, model=model, kind="completion").inc(
+        getattr(usage, "completion_tokens", 0) or 0
+    )
+
+
+def record_cache(cache: str, hit: bool, stale: bool = False) -> None:
+    """Count a cache lookup so hit rates can be derived per cache"""
+    result = ("stale" if stale else "hit") if hit else "miss"
+    CACHE_REQUESTS.labels(cache=cache, result=result).inc()
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Per-page OCR markdown of documents, with a concept -> pages index
+pages.py
+
+Documents are OCR'd once (see `mistral_ocr` in src/upstream.py) and their
+pages stored as markdown under the SHA-256 of the file. Concepts are
+extracted from this text, so re-runs, other queries and re-personalized
+runs of the same document never upload or OCR it again.
+The pages mentioning each concept are indexed in the same SQLite database
+the first time they are looked up, and later stages (applications,
+roadmaps) include the matching paragraphs as a short lecture excerpt
+instead of working from the bare concept name.
+
+The pages of a document are deleted when its upload is evicted (see
+src/storage.py).
+
+Calls are blocking; async callers run them with `asyncio.to_thread`.
+
+RUN (from backend/):
+    python -m src.pages <document_hash> --concept "Fourier Transform"
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from src.config import config
+from src.storage import storage
+
+logger = logging.getLogger(__name__)
+
+# Words of a concept name shorter than this are not matched on their own
+MIN_TERM_LENGTH = 4
+
+
+def concept_terms(concept: str) -> List[str]:
+    """Lowercase terms a page may mention a concept by: its full name, then its longer words"""
+    name = concept.strip().lower()
+    words = [w for w in re.findall(r"\w+", name) if len(w) >= MIN_TERM_LENGTH]
+    return [name] + [w for w in words if w != name]
+
+
+def _mentions(text: str, terms: List[str]) -> Tuple[int, int]:
+    """Mentions of a concept in `text`: of its full name, and of its words"""
+    text = text.lower()
+    full_name, *words = terms
+    return text.count(full_name), sum(text.count(w) for w in words)
+
+
+def _best(candidates: List[Tuple[Tuple[int, int], Any]]) -> List[Any]:
+    """Candidates mentioning the concept, most mentions first; only those naming
+    it in full if any do, the words of a name being often too generic"""
+    if any(full for (full, _), _ in candidates):
+        candidates = [c for c in candidates if c[0][0]]
+    else:
+        candidates = [c for c in candidates if c[0][1]]
+    return [item for _, item in sorted(candidates, key=lambda c: (-c[0][0], -c[0][1]))]
+
+
+class PageStore:
+    """SQLite store of OCR'd pages and of the pages mentioning each concept"""
+
+    def __init__(self, path: str, max_pages: int, max_excerpt_chars: int):
+        self.path = path
+        self.max_pages = max_pages
+        self.max_excerpt_chars = max_excerpt_chars
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents (document_hash TEXT PRIMARY KEY, "
+            "pages INTEGER, model TEXT, created REAL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages (document_hash TEXT, page INTEGER, markdown TEXT, "
+            "PRIMARY KEY (document_hash, page))"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS concept_pages (document_hash TEXT, concept TEXT, "
+            "pages TEXT, PRIMARY KEY (document_hash, concept))"
+        )
+        return conn
+
+    def has(self, document_hash: str) -> bool:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM documents WHERE document_hash = ?", (document_hash,)
+            ).fetchone()
+        return row is not None
+
+    def put(self, document_hash: str, pages: Sequence[str], model: str) -> None:
+        """Store the markdown of every page of a document (page numbers start at 1)"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM pages WHERE document_hash = ?", (document_hash,))
+            conn.execute("DELETE FROM concept_pages WHERE document_hash = ?", (document_hash,))
+            conn.executemany(
+                "INSERT INTO pages VALUES (?, ?, ?)",
+                [(document_hash, i, markdown) for i, markdown in enumerate(pages, start=1)],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                (document_hash, len(pages), model, time.time()),
+            )
+
+    def pages(self, document_hash: str) -> List[Dict[str, Any]]:
+        """Pages of a document as `{"page": n, "markdown": ...}`, empty if it was never OCR'd"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT page, markdown FROM pages WHERE document_hash = ? ORDER BY page",
+                (document_hash,),
+            ).fetchall()
+        return [{"page": page, "markdown": markdown} for page, markdown in rows]
+
+    def text(self, document_hash: str, max_chars: int) -> str:
+        """Markdown of a whole document with page markers, at most `max_chars`"""
+        text = "\n\n".join(f"[p. {p['page']}]\n{p['markdown']}" for p in self.pages(document_hash))
+        if len(text) > max_chars:
+            return text[:max_chars].rstrip() + "…"
+        return text
+
+    def concept_pages(self, document_hash: str, concept: str) -> List[int]:
+        """Pages of a document mentioning `concept`, most mentions first (indexed on first lookup)"""
+        key = concept.strip().lower()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT pages FROM concept_pages WHERE document_hash = ? AND concept = ?",
+                (document_hash, key),
+            ).fetchone()
+            if row is not None:
+                return json.loads(row[0])
+
+            terms = concept_terms(concept)
+            pages = _best(
+                [
+                    (_mentions(markdown, terms), page)
+                    for page, markdown in conn.execute(
+                        "SELECT page, markdown FROM pages WHERE document_hash = ? ORDER BY page",
+                        (document_hash,),
+                    )
+                ]
+            )[: self.max_pages]
+            stored = conn.execute(
+                "SELECT 1 FROM documents WHERE document_hash = ?", (document_hash,)
+            ).fetchone()
+            if stored is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO concept_pages VALUES (?, ?, ?)",
+                    (document_hash, key, json.dumps(pages)),
+                )
+        return pages
+
+    def index_concepts(self, document_hash: str, concepts: Sequence[str]) -> Dict[str, List[int]]:
+        """Index the pages mentioning each concept ahead of the stages that need them"""
+        return {concept: self.concept_pages(document_hash, concept) for concept in concepts}
+
+    def excerpt(self, document_hashes: Sequence[str], concept: str) -> str:
+        """Paragraphs of the documents mentioning `concept`, marked with their page,
+        at most `max_excerpt_chars`; empty if no stored page mentions it"""
+        terms = concept_terms(concept)
+        paragraphs: List[str] = []
+        length = 0
+        for document_hash in document_hashes:
+            pages = self.concept_pages(document_hash, concept)
+            if not pages:
+                continue
+            with self._connect() as conn:
+                markdown_by_page = dict(
+                    conn.execute(
+                        "SELECT page, markdown FROM pages WHERE document_hash = ? "
+                        f"AND page IN ({','.join('?' * len(pages))})",
+                        (document_hash, *pages),
+                    ).fetchall()
+                )
+            candidates = [
+                (_mentions(paragraph, terms), f"[p. {page}] {paragraph.strip()}")
+                for page in pages
+                for paragraph in re.split(r"\n\s*\n", markdown_by_page.get(page, ""))
+                if paragraph.strip()
+            ]
+            for paragraph in _best(candidates):
+                if length + len(paragraph) > self.max_excerpt_chars:
+                    remaining = self.max_excerpt_chars - length
+                    if remaining > 80:
+                        paragraphs.append(paragraph[:remaining].rstrip() + "…")
+                    return "\n".join(paragraphs)
+                paragraphs.append(paragraph)
+                length += len(paragraph) + 1
+        return "\n".join(paragraphs)
+
+    def delete(self, document_hash: str) -> None:
+        """Forget the pages of a document (e.g. once it is evicted)"""
+        with self._connect() as conn:
+            for table in ("documents", "pages", "concept_pages"):
+                conn.execute(f"DELETE FROM {table} WHERE document_hash = ?", (document_hash,))
+
+    def stats(self, document_hash: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT pages, model, created FROM documents WHERE document_hash = ?",
+                (document_hash,),
+            ).fetchone()
+            if row is None:
+                return None
+            indexed = conn.execute(
+                "SELECT COUNT(*) FROM concept_pages WHERE document_hash = ?", (document_hash,)
+            ).fetchone()[0]
+        return {"pages": row[0], "model": row[1], "created": row[2], "indexed_concepts": indexed}
+
+
+page_store = PageStore(
+    config.PAGES_DB,
+    max_pages=config.CONCEPT_MAX_PAGES,
+    max_excerpt_chars=config.PAGE_EXCERPT_MAX_CHARS,
+)
+# An evicted upload is OCR'd again if it is uploaded again
+storage.on_evict("document", page_store.delete)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect the stored OCR pages of a document")
+    parser.add_argument("document_hash", help="SHA-256 of the document file")
+    parser.add_argument("--concept", default=None, help="Print the excerpt about this concept")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    print(page_store.stats(args.document_hash))
+    if args.concept:
+        print(page_store.concept_pages(args.document_hash, args.concept))
+        print(page_store.excerpt([args.document_hash], args.concept))
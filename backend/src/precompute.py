@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""Offline bulk precompute of workflow results
+precompute.py
+
+Walks a directory of lecture documents and runs the workflow graph for each
+of them across a pool of worker processes, each running a few documents
+concurrently and taking the next one from a shared queue as soon as one
+finishes. Results are keyed by the document's SHA-256 (the same id as
+`/upload_document/` returns) and written as they complete, either to the
+SQLite store the API serves from or to a JSONL file. Documents already in
+the output are skipped, so re-running an interrupted batch resumes it.
+
+RUN (from backend/):
+    python -m src.precompute tmp/lectures --workers 4 --concurrency 4
+    python -m src.precompute tmp/lectures --output precomputed.jsonl
+    python -m src.precompute tmp/lectures --mock --mock-latency 0.2   # dry run, no upstream calls
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from src.config import config
+from src.documents import file_sha256
+from src.utils import percentile
+
+logger = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------
+# Result stores
+# ---------------------------------------------------------------------------
+
+
+class PrecomputedStore:
+    """SQLite store of precomputed results, by document id"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS precomputed (document_id TEXT PRIMARY KEY, "
+            "filename TEXT, status TEXT, error TEXT, duration_s REAL, created REAL, state TEXT)"
+        )
+        return conn
+
+    def completed_ids(self) -> Set[str]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT document_id FROM precomputed WHERE status = 'ok'")
+            return {row[0] for row in rows}
+
+    def write(self, record: Dict[str, Any]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO precomputed VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    record["document_id"],
+                    record["filename"],
+                    record["status"],
+                    record["error"],
+                    record["duration_s"],
+                    record["created"],
+                    json.dumps(record["state"]),
+                ),
+            )
+
+    def get(self, document_id: str) -> Optional[Dict[str, Any]]:
+        """Successful result for a document, or None"""
+        if not os.path.exists(self.path):
+            return None
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT filename, duration_s, created, state FROM precomputed "
+                "WHERE document_id = ? AND status = 'ok'",
+                (document_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        filename, duration_s, created, state = row
+        return {
+            "document_id": document_id,
+            "filename": filename,
+            "duration_s": duration_s,
+            "created": created,
+            "state": json.loads(state),
+        }
+
+
+class JsonlStore:
+    """Append-only JSONL file of precomputed results"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def completed_ids(self) -> Set[str]:
+        if not os.path.exists(self.path):
+            return set()
+        done = set()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # partial last line of an interrupted batch
+                if record.get("status") == "ok":
+                    done.add(record["document_id"])
+        return done
+
+    def write(self, record: Dict[str, Any]) -> None:
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def open_store(path: str):
+    return JsonlStore(path) if path.endswith(".jsonl") else PrecomputedStore(path)
+
+
+precomputed_store = PrecomputedStore(config.PRECOMPUTED_DB)
+
+
+# ---------------------------------------------------------------------------
+# Worker processes
+# ---------------------------------------------------------------------------
+
+# Per-process event loop and orchestrator, created by `_init_worker`
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(mock: Optional[Dict[str, Any]], tasks: Any, results: Any) -> None:
+    from src.agents.orchestrator import Orchestrator
+
+    logging.getLogger("src").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    # Batch runs must not replace the state the frontend is polling
+    orchestrator = Orchestrator(publish_state=False)
+    if mock is not None:
+        from src.load_test import install_mock_upstreams
+
+        install_mock_upstreams(orchestrator, argparse.Namespace(**mock))
+    _worker["loop"] = asyncio.new_event_loop()
+    _worker["orchestrator"] = orchestrator
+    _worker["tasks"] = tasks
+    _worker["results"] = results
+
+
+def _serve(user_query: str, concurrency: int) -> None:
+    """Run documents from the shared task queue, `concurrency` at a time, until
+    it is drained; each record is sent back as soon as its document is done"""
+    async def consume() -> None:
+        while True:
+            task = await asyncio.to_thread(_worker["tasks"].get)
+            if task is None:
+                return
+            document_id, path = task
+            record = await _process_document(document_id, path, user_query)
+            await asyncio.to_thread(_worker["results"].put, record)
+
+    async def run_all() -> None:
+        from src.state_backend import state_backend
+
+        try:
+            await asyncio.gather(*(consume() for _ in range(concurrency)))
+        finally:
+            # Its connection thread would keep the worker from exiting
+            await state_backend.close()
+
+    _worker["loop"].run_until_complete(run_all())
+
+
+async def _process_document(document_id: str, path: str, user_query: str) -> Dict[str, Any]:
+    from src.blobs import blob_store
+    from src.data_models import WorkflowState
+    from src.scheduler import scheduling
+
+    start = time.perf_counter()
+    state = WorkflowState(
+        uuid=uuid.uuid4().hex,
+        document_path=path,
+        text_input=user_query,
+        user_metadata={},
+        relevant_concepts=[],
+        concept_applications={},
+        error=None,
+    )
+    try:
+        # Batch work only gets the upstream slots interactive calls leave
+        with scheduling("background", document_id):
+            result = await _worker["orchestrator"].run(state)
+        error = result.get("error")
+        # Inline the blobs so each record is self-contained
+        result = await blob_store.aresolve(result)
+    except Exception as e:
+        result, error = None, f"{type(e).__name__}: {e}"
+    return {
+        "document_id": document_id,
+        "filename": os.path.basename(path),
+        "status": "error" if error else "ok",
+        "error": error,
+        "duration_s": time.perf_counter() - start,
+        "created": time.time(),
+        "state": result,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Batch driver
+# ---------------------------------------------------------------------------
+
+
+def discover(directory: str) -> List[str]:
+    """Documents with an accepted extension under `directory`, sorted"""
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in config.ALLOWED_DOCUMENT_EXTENSIONS:
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+def run_batch(args: argparse.Namespace) -> Dict[str, Any]:
+    store = open_store(args.output)
+    done = store.completed_ids()
+    # Identical files are processed once
+    documents: Dict[str, str] = {}
+    for path in discover(args.directory):
+        documents.setdefault(file_sha256(path), path)
+    pending = [(sha, path) for sha, path in documents.items() if sha not in done]
+    print(
+        f"{len(documents)} documents, {len(documents) - len(pending)} already precomputed, "
+        f"{len(pending)} to run on {args.workers} workers x {args.concurrency}"
+    )
+
+    mock = None
+    if args.mock:
+        mock = {
+            "mistral_latency": args.mock_latency,
+            "upload_latency": args.mock_latency,
+            "image_latency": args.mock_latency,
+            "concepts": 3,
+            "applications": 2,
+            "malformed_rate": 0.0,
+        }
+    # Workers pull documents one at a time, so a slow document only holds its
+    # own slot; a None per consumer tells it to stop
+    context = multiprocessing.get_context("spawn")
+    tasks, results = context.Queue(), context.Queue()
+    for task in pending:
+        tasks.put(task)
+    for _ in range(args.workers * args.concurrency):
+        tasks.put(None)
+    durations: List[float] = []
+    failed = 0
+    received: Set[str] = set()
+
+    def save(record: Dict[str, Any]) -> None:
+        nonlocal failed
+        store.write(record)
+        received.add(record["document_id"])
+        durations.append(record["duration_s"])
+        failed += record["status"] != "ok"
+        print(
+            f"[{len(durations)}/{len(pending)}] {record['status']:<5} "
+            f"{record['duration_s']:7.1f}s {record['filename']}"
+            + (f" ({record['error']})" if record["error"] else "")
+        )
+
+    start = time.perf_counter()
+    # Spawned workers start clean: no event loop or SQLite handle inherited
+    pool = ProcessPoolExecutor(
+        max_workers=args.workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(mock, tasks, results),
+    )
+    try:
+        workers = [
+            pool.submit(_serve, args.user_query, args.concurrency) for _ in range(args.workers)
+        ]
+        while len(received) < len(pending):
+            try:
+                save(results.get(timeout=1.0))
+            except queue.Empty:
+                if all(worker.done() for worker in workers):
+                    break  # every worker returned or died
+        error = next(
+            (w.exception() for w in workers if w.done() and w.exception() is not None), None
+        )
+        for sha, path in pending:
+            if sha not in received:  # lost with a worker process that died
+                save(
+                    {
+                        "document_id": sha,
+                        "filename": os.path.basename(path),
+                        "status": "error",
+                        "error": f"{type(error).__name__}: {error}" if error else "Worker exited",
+                        "duration_s": 0.0,
+                        "created": time.time(),
+                        "state": None,
+                    }
+                )
+    except KeyboardInterrupt:
+        print("Interrupted, re-run the same command to resume")
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+    elapsed = time.perf_counter() - start
+    return {
+        "documents": len(documents),
+        "skipped": len(documents) - len(pending),
+        "processed": len(durations),
+        "failed": failed,
+        "elapsed_s": elapsed,
+        "documents_per_minute": len(durations) / elapsed * 60 if elapsed else 0.0,
+        "p50_s": percentile(durations, 50),
+        "p95_s": percentile(durations, 95),
+        "max_s": max(durations, default=0.0),
+    }
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """Print the batch throughput as a readable summary"""
+    print("\n=== Precompute Report ===")
+    print(
+        f"Documents: {report['documents']} | skipped: {report['skipped']}"
+        f" | processed: {report['processed']} | failed: {report['failed']}"
+    )
+    print(
+        f"Elapsed: {report['elapsed_s']:.1f}s ({report['documents_per_minute']:.1f} documents/min)"
+    )
+    print(
+        f"Per document s: p50={report['p50_s']:.1f} p95={report['p95_s']:.1f} max={report['max_s']:.1f}"
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Precompute workflow results for a directory of lectures")
+    parser.add_argument("directory", help="Directory searched recursively for PDF/PNG/JPEG documents")
+    parser.add_argument("--output", default=config.PRECOMPUTED_DB, help="SQLite store served by the API, or a .jsonl file")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--concurrency", type=int, default=4, help="Documents run concurrently per worker")
+    parser.add_argument("--user-query", default="", help="Query text the results are computed for")
+    parser.add_argument("--mock", action="store_true", help="Use mocked Mistral and Google upstreams")
+    parser.add_argument("--mock-latency", type=float, default=0.5, help="Mean mocked upstream latency (s)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    print_report(run_batch(parse_args()))
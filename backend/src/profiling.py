@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""On-demand sampling profiler for individual workflow runs
+profiling.py
+
+Profiling is opt-in per request and admin-protected; when it is not
+requested the only cost is a header/query check.
+"""
+
+import asyncio
+import hmac
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from pyinstrument import Profiler
+from pyinstrument.renderers import HTMLRenderer, PstatsRenderer, SpeedscopeRenderer
+from pyinstrument.session import Session
+
+from src.config import config
+from src.storage import storage
+
+logger = logging.getLogger(__name__)
+
+# format -> (file suffix, renderer)
+PROFILE_FORMATS = {
+    "html": (".html", HTMLRenderer),
+    "speedscope": (".speedscope.json", SpeedscopeRenderer),
+    "pstats": (".pstats", PstatsRenderer),
+}
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """Check an admin token against `config.ADMIN_TOKEN` (disabled when unset)"""
+    if not config.ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token, config.ADMIN_TOKEN)
+
+
+def profile_path(run_id: str, fmt: str) -> str:
+    suffix, _ = PROFILE_FORMATS[fmt]
+    return os.path.join(storage.run_path(run_id), f"profile{suffix}")
+
+
+@asynccontextmanager
+async def profile_run(run_id: str, enabled: bool):
+    """Profile the enclosed block and store artifacts for `run_id` if enabled"""
+    if not enabled:
+        yield
+        return
+
+    # async_mode="enabled" attributes samples to this run's task context only,
+    # time spent awaiting other runs shows up as a single "await" frame
+    profiler = Profiler(interval=config.PROFILE_INTERVAL, async_mode="enabled")
+    profiler.start()
+    try:
+        yield
+    finally:
+        session = profiler.stop()
+        # Rendering takes up to seconds for long runs: keep it off the event loop
+        await asyncio.to_thread(_save_profiles, run_id, session)
+
+
+def _save_profiles(run_id: str, session: Session) -> None:
+    """Render a profiling session in every format into the run's directory"""
+    run_dir = storage.run_dir(run_id)
+    for fmt, (_, renderer) in PROFILE_FORMATS.items():
+        path = profile_path(run_id, fmt)
+        try:
+            output = renderer().render(session)
+            if renderer.output_is_binary:
+                # Binary renderers (pstats) return surrogate-escaped text
+                with open(path, "wb") as f:
+                    f.write(output.encode("utf-8", errors="surrogateescape"))
+            else:
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(output)
+        except Exception as e:
+            logger.warning(f"Could not write {fmt} profile for {run_id}: {e}")
+    storage.record(run_dir, "run", run_id)
+    logger.info(f"Profile for run {run_id} saved to {run_dir}")
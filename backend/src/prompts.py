@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Prompt building shared by the agents
+prompts.py
+
+Messages are laid out so that everything static (system prompt, schema,
+instructions) comes first and every per-request value comes last, in a
+single "inputs" block. Identical prefixes across calls let the provider's
+prefix cache apply. Prompts are measured with a local tokenizer and
+truncatable inputs are shortened to keep each agent within its budget.
+"""
+
+import functools
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+
+from src.config import config
+from src.metrics import PROMPT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# Rough characters-per-token ratio used when no tokenizer is available
+_CHARS_PER_TOKEN = 4
+
+
+@functools.lru_cache(maxsize=1)
+def _tokenizer():
+    """Load the local Mistral (Tekken) tokenizer once, or None if unavailable"""
+    try:
+        from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
+
+        return MistralTokenizer.v3(is_tekken=True).instruct_tokenizer.tokenizer
+    except Exception as e:  # ImportError or missing tokenizer assets
+        logger.warning(f"Local tokenizer unavailable, estimating tokens: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in `text` according to the local tokenizer"""
+    tokenizer = _tokenizer()
+    if tokenizer is None:
+        return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+    return len(tokenizer.encode(text, bos=False, eos=False))
+
+
+@functools.lru_cache(maxsize=64)
+def _static_tokens(text: str) -> int:
+    """`count_tokens` of a system prompt or instructions, which are module
+    constants: counted once per process instead of once per call"""
+    return count_tokens(text)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep at most `max_tokens` tokens from the start of `text`"""
+    if max_tokens <= 0:
+        return ""
+    tokenizer = _tokenizer()
+    if tokenizer is None:
+        limit = max_tokens * _CHARS_PER_TOKEN
+        return text if len(text) <= limit else text[:limit].rstrip() + "…"
+    tokens = tokenizer.encode(text, bos=False, eos=False)
+    if len(tokens) <= max_tokens:
+        return text
+    return tokenizer.decode(tokens[:max_tokens]).rstrip() + "…"
+
+
+def _render_inputs(inputs: Dict[str, str]) -> str:
+    return "\n".join(f"{label}: {value}" for label, value in inputs.items())
+
+
+def build_messages(
+    agent: str,
+    system_prompt: str,
+    instructions: str,
+    inputs: Dict[str, Any],
+    truncatable: Sequence[str] = (),
+    attachments: Optional[List[Dict[str, Any]]] = None,
+) -> List[Dict[str, Any]]:
+    """Build chat messages with static text first and `inputs` last
+
+    Args:
+        agent: Agent name, selects the token budget and labels metrics
+        system_prompt: Static system prompt (role, rules, output schema)
+        instructions: Static task instructions opening the user message
+        inputs: Per-request values, rendered as "label: value" lines at the end;
+            empty values are dropped
+        truncatable: Input labels that may be shortened to fit the budget,
+            lowest priority first
+        attachments: Extra user content parts appended after the text
+            (e.g. a document_url), which turns the content into a list
+
+    Returns:
+        Messages ready for `chat.complete`
+    """
+    values = {
+        label: str(value).strip()
+        for label, value in inputs.items()
+        if value not in (None, "", [], {})
+    }
+    static_tokens = _static_tokens(system_prompt) + _static_tokens(instructions)
+    budget = config.PROMPT_TOKEN_BUDGETS.get(agent)
+    total = static_tokens + count_tokens(_render_inputs(values))
+
+    if budget and total > budget:
+        for label in truncatable:
+            if label not in values:
+                continue
+            excess = total - budget
+            value_tokens = count_tokens(values[label])
+            # One extra token is reserved for the ellipsis marking the cut
+            values[label] = truncate_to_tokens(values[label], value_tokens - excess - 1)
+            if not values[label]:
+                del values[label]
+            total = static_tokens + count_tokens(_render_inputs(values))
+            if total <= budget:
+                break
+        if total > budget:
+            logger.warning(
+                f"Prompt for {agent} is {total} tokens, over its budget of {budget}"
+            )
+
+    PROMPT_TOKENS.labels(agent=agent).observe(total)
+    logger.info(f"Prompt for {agent}: {total} tokens (budget {budget})")
+
+    user_text = f"{instructions}\n\n{_render_inputs(values)}" if values else instructions
+    user_content: Any = user_text
+    if attachments:
+        user_content = [{"type": "text", "text": user_text}, *attachments]
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_content},
+    ]
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Latency-aware choice of the Mistral model for each call
+routing.py
+
+Every agent has a tier list of models, primary first and faster ones after.
+Rolling latency and error stats are kept per agent and model; a model whose
+p95 exceeds the agent's SLO or whose error rate is too high is skipped, and
+so is one whose p95 no longer fits in what is left of the run's latency
+budget. A failed call fails over to the next tier.
+
+Runs given an explicit deadline also degrade their own work as the budget
+runs out (see DEGRADATION_THRESHOLDS): the agents ask `should_degrade` before
+each optional piece of work and record what they left out with
+`mark_degraded`.
+"""
+
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from src.config import config
+from src.metrics import DEGRADATIONS
+
+logger = logging.getLogger(__name__)
+
+# Monotonic time by which the current run should be done, if any
+_run_deadline: ContextVar[Optional[float]] = ContextVar("run_deadline", default=None)
+# Whether the current run degrades its work to meet the deadline
+_degradable: ContextVar[bool] = ContextVar("degradable", default=False)
+
+
+@contextmanager
+def latency_budget(seconds: float, degrade: bool = False):
+    """Give the calls made inside the block (and their tasks) a deadline
+
+    With `degrade`, the deadline was asked for by the client and the run
+    gives up optional work to meet it (see `should_degrade`).
+    """
+    token = _run_deadline.set(time.monotonic() + seconds)
+    degrade_token = _degradable.set(degrade)
+    try:
+        yield
+    finally:
+        _degradable.reset(degrade_token)
+        _run_deadline.reset(token)
+
+
+def remaining_budget() -> Optional[float]:
+    """Seconds left before the current run's deadline, or None without one"""
+    deadline = _run_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def should_degrade(step: str) -> bool:
+    """Whether a degradation step applies now, given the remaining budget
+
+    Steps kick in, in the order of DEGRADATION_THRESHOLDS, as the remaining
+    budget of a run with a client deadline drops below their threshold.
+    """
+    remaining = remaining_budget()
+    return (
+        _degradable.get()
+        and remaining is not None
+        and remaining < config.DEGRADATION_THRESHOLDS[step]
+    )
+
+
+def mark_degraded(state: Dict[str, Any], step: str, item: str) -> None:
+    """Record in the run's state that `item` (a concept or application) was degraded"""
+    items = state.setdefault("degraded", {}).setdefault(step, [])
+    if item not in items:
+        items.append(item)
+        DEGRADATIONS.labels(step=step).inc()
+
+
+class ModelStats:
+    """Rolling latency and error samples of one model for one agent"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._samples: Deque[Tuple[float, float, bool]] = deque(maxlen=500)
+
+    def record(self, latency: float, ok: bool) -> None:
+        self._samples.append((time.monotonic(), latency, ok))
+
+    def _recent(self) -> List[Tuple[float, float, bool]]:
+        horizon = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < horizon:
+            self._samples.popleft()
+        return list(self._samples)
+
+    def summary(self) -> Dict[str, Any]:
+        samples = self._recent()
+        latencies = sorted(latency for _, latency, ok in samples if ok)
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] if latencies else None
+        errors = sum(1 for _, _, ok in samples if not ok)
+        return {
+            "calls": len(samples),
+            "p95_s": p95,
+            "error_rate": errors / len(samples) if samples else 0.0,
+        }
+
+
+@dataclass
+class Route:
+    """Models to try for one call, in order, and why the first was chosen"""
+
+    models: List[str]
+    reason: str
+
+
+class ModelRouter:
+    """Picks a model per call from the agent's tier list"""
+
+    def __init__(
+        self,
+        tiers: Dict[str, List[str]],
+        slo: Dict[str, float],
+        max_error_rate: float,
+        window: float,
+        min_samples: int,
+        max_attempts: int,
+    ):
+        self.tiers = tiers
+        self.slo = slo
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.max_attempts = max_attempts
+        self._stats: Dict[Tuple[str, str], ModelStats] = defaultdict(lambda: ModelStats(window))
+
+    def route(self, agent: str) -> Route:
+        tiers = self.tiers.get(agent) or [config.MISTRAL_MODEL]
+        remaining = remaining_budget()
+        reason = "primary"
+        for i, model in enumerate(tiers):
+            stats = self._stats[(agent, model)].summary()
+            if stats["calls"] >= self.min_samples:
+                slo = self.slo.get(agent)
+                if stats["error_rate"] > self.max_error_rate or (
+                    slo is not None and stats["p95_s"] is not None and stats["p95_s"] > slo
+                ):
+                    reason = "degraded"
+                    continue
+                if remaining is not None and stats["p95_s"] is not None and stats["p95_s"] > remaining:
+                    reason = "budget"
+                    continue
+            if i > 0:
+                logger.info(f"Routing {agent} to {model} ({reason} {tiers[i - 1]})")
+            return Route(models=tiers[i:][: self.max_attempts], reason=reason)
+        # Every tier is degraded: the last one is the fastest
+        return Route(models=tiers[-1:], reason="fallback")
+
+    def record(self, agent: str, model: str, latency: float, ok: bool) -> None:
+        self._stats[(agent, model)].record(latency, ok)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Rolling stats of every agent and model seen so far"""
+        return {f"{agent}/{model}": s.summary() for (agent, model), s in self._stats.items()}
+
+
+model_router = ModelRouter(
+    tiers=config.MODEL_TIERS,
+    slo=config.MODEL_LATENCY_SLO,
+    max_error_rate=config.MODEL_MAX_ERROR_RATE,
+    window=config.MODEL_STATS_WINDOW,
+    min_samples=config.MODEL_STATS_MIN_SAMPLES,
+    max_attempts=config.MODEL_MAX_ATTEMPTS,
+)
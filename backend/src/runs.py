@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""Registry of in-flight workflow runs, with cancellation
+runs.py
+
+Each run executes as its own asyncio task so it can be cancelled
+explicitly, when the same client submits a newer run, or when the client
+that started it disconnects. Cancellation is delivered at the run's current
+await point, which aborts any in-flight Mistral or Google request.
+
+Run statuses and the latest run of each client are kept in the shared state
+backend, so any worker process can report on or cancel any run. A cancel
+request for a run owned by another worker is left in the backend and picked
+up by that worker while it waits for the run.
+
+A running run also holds a lease in the backend naming the worker that owns
+it, renewed by that worker's heartbeat. If the worker dies (crash, restart),
+the lease expires and the run is reported as "interrupted" from then on, so
+it can be resumed.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Optional
+
+from src.config import config
+from src.metrics import RUNS_CANCELLED
+from src.state_backend import WORKER_ID, StateBackend, state_backend
+
+logger = logging.getLogger(__name__)
+
+
+class RunManager:
+    """Tracks this worker's run tasks and every worker's run statuses"""
+
+    def __init__(
+        self,
+        backend: StateBackend,
+        status_ttl: float,
+        lease_ttl: float,
+        heartbeat_interval: float,
+    ):
+        self.backend = backend
+        self.status_ttl = status_ttl
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_id = WORKER_ID
+        self._tasks: Dict[str, asyncio.Task] = {}
+        # run id -> cancellation reason, for this worker's runs
+        self._cancel_reasons: Dict[str, str] = {}
+        self._background_tasks: set = set()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+    async def start(
+        self,
+        run_id: str,
+        coro: Coroutine[Any, Any, Any],
+        client_id: Optional[str] = None,
+    ) -> asyncio.Task:
+        """Run `coro` as a task, cancelling the client's previous run if any"""
+        if client_id:
+            previous = await self.backend.get(f"client:{client_id}:run")
+            if previous and previous != run_id:
+                await self.cancel(previous, reason="superseded")
+            await self.backend.set(f"client:{client_id}:run", run_id, ttl=self.status_ttl)
+
+        # status is one of "running", "completed", "failed", "cancelled:<reason>",
+        # "interrupted" (its worker died while it ran)
+        await self._renew_lease(run_id)
+        await self._set_status(run_id, "running")
+        task = asyncio.create_task(self._execute(run_id, client_id, coro), name=f"run-{run_id}")
+        self._tasks[run_id] = task
+        task.add_done_callback(lambda t: self._on_done(run_id, client_id, t))
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat(), name="run-heartbeat")
+        return task
+
+    async def cancel(self, run_id: str, reason: str = "requested") -> bool:
+        """Cancel a running run on any worker; returns False if it is not running"""
+        task = self._tasks.get(run_id)
+        if task is None:
+            if await self.status(run_id) != "running":
+                return False
+            # Owned by another worker, which cancels it on its next poll
+            logger.info(f"Requesting cancellation of run {run_id} ({reason})")
+            await self.backend.set(f"run:{run_id}:cancel", reason, ttl=self.status_ttl)
+            RUNS_CANCELLED.labels(reason=reason).inc()
+            return True
+        if task.done():
+            return False
+        self._cancel_local(run_id, task, reason)
+        RUNS_CANCELLED.labels(reason=reason).inc()
+        return True
+
+    async def status(self, run_id: str) -> Optional[str]:
+        """Status of a run; a running run whose lease expired is marked interrupted"""
+        status = await self.backend.get(f"run:{run_id}:status")
+        if (
+            status == "running"
+            and run_id not in self._tasks
+            and not self._is_alive(await self.owner(run_id))
+        ):
+            logger.warning(f"Run {run_id} lost its worker, marking it interrupted")
+            await self._set_status(run_id, "interrupted")
+            await self.backend.delete(f"run:{run_id}:cancel")
+            return "interrupted"
+        return status
+
+    async def owner(self, run_id: str) -> Optional[str]:
+        """Worker holding a running run's lease"""
+        return await self.backend.get(f"run:{run_id}:lease")
+
+    def _is_alive(self, worker_id: Optional[str]) -> bool:
+        """Whether the worker holding a lease may still run; workers on this host
+        are checked at once, so runs of a restarted server need not wait for
+        their lease to expire"""
+        if worker_id is None:
+            return False
+        host, pid, _ = worker_id.rsplit(":", 2)
+        if worker_id == self.worker_id or host != socket.gethostname():
+            return True
+        if int(pid) == os.getpid():
+            # This process replaced the worker (e.g. PID 1 in a container)
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    async def wait(
+        self,
+        run_id: str,
+        is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    ) -> Any:
+        """Wait for a run, cancelling it if the waiting client goes away or
+        another worker asks for it
+
+        Raises:
+            asyncio.CancelledError: If the run was cancelled
+        """
+        task = self._tasks[run_id]
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=config.DISCONNECT_POLL_INTERVAL)
+                if task.done():
+                    break
+                reason = await self.backend.get(f"run:{run_id}:cancel")
+                if reason:
+                    self._cancel_local(run_id, task, reason)
+                elif is_disconnected and await is_disconnected():
+                    await self.cancel(run_id, reason="disconnected")
+            return task.result()
+        except asyncio.CancelledError:
+            # The request handler itself was cancelled (e.g. server shutdown)
+            if not task.done():
+                await self.cancel(run_id, reason="disconnected")
+            raise
+
+    def _cancel_local(self, run_id: str, task: asyncio.Task, reason: str) -> None:
+        logger.info(f"Cancelling run {run_id} ({reason})")
+        self._cancel_reasons[run_id] = reason
+        task.cancel(msg=reason)
+
+    async def _execute(
+        self, run_id: str, client_id: Optional[str], coro: Coroutine[Any, Any, Any]
+    ) -> Any:
+        """Await the run and record how it ended"""
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            reason = self._cancel_reasons.pop(run_id, "unknown")
+            await self._finish(run_id, client_id, f"cancelled:{reason}")
+            raise
+        except Exception:
+            await self._finish(run_id, client_id, "failed")
+            raise
+        await self._finish(run_id, client_id, "completed")
+        return result
+
+    def _on_done(self, run_id: str, client_id: Optional[str], task: asyncio.Task) -> None:
+        self._tasks.pop(run_id, None)
+        reason = self._cancel_reasons.pop(run_id, None)
+        if reason is not None:
+            # Cancelled before `_execute` started, so it could not record it
+            finish = asyncio.get_running_loop().create_task(
+                self._finish(run_id, client_id, f"cancelled:{reason}")
+            )
+            self._background_tasks.add(finish)
+            finish.add_done_callback(self._background_tasks.discard)
+
+    async def _finish(self, run_id: str, client_id: Optional[str], status: str) -> None:
+        await self._set_status(run_id, status)
+        await self.backend.delete(f"run:{run_id}:lease")
+        await self.backend.delete(f"run:{run_id}:cancel")
+        if client_id and await self.backend.get(f"client:{client_id}:run") == run_id:
+            await self.backend.delete(f"client:{client_id}:run")
+
+    async def _set_status(self, run_id: str, status: str) -> None:
+        await self.backend.set(f"run:{run_id}:status", status, ttl=self.status_ttl)
+
+    async def _renew_lease(self, run_id: str) -> None:
+        await self.backend.set(f"run:{run_id}:lease", self.worker_id, ttl=self.lease_ttl)
+
+    async def _heartbeat(self) -> None:
+        """Renew the leases of this worker's runs while it has any"""
+        while self._tasks:
+            await asyncio.sleep(self.heartbeat_interval)
+            for run_id in list(self._tasks):
+                try:
+                    await self._renew_lease(run_id)
+                except Exception as e:
+                    logger.warning(f"Renewing the lease of run {run_id} failed: {e}")
+
+
+run_manager = RunManager(
+    backend=state_backend,
+    status_ttl=config.RUN_STATUS_TTL,
+    lease_ttl=config.RUN_LEASE_TTL,
+    heartbeat_interval=config.RUN_HEARTBEAT_INTERVAL,
+)
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""Priority scheduling of upstream calls
+scheduler.py
+
+Every Mistral and Google call takes a slot of its upstream's pool (see
+SCHEDULER_LIMITS) before it is sent. When the pool is full, calls queue by
+priority class: interactive (live users), then background (batch jobs), then
+prefetch (speculative work). A queued call of a lower class is passed over
+as long as a higher class has calls waiting, and the last
+SCHEDULER_RESERVED_INTERACTIVE slots only go to interactive calls, so
+batches use spare capacity without delaying live users.
+
+Within a class, slots are shared fairly across runs: the next slot goes to
+the waiting run that was served least relative to its weight. The class,
+run and weight of a call come from the `scheduling(...)` block it runs in;
+calls outside any block are interactive. A call shared by several callers
+(see src/singleflight.py) runs at the highest class among them: its calls
+already queued move up when a caller of a higher class joins.
+
+The limits hold across processes: every API worker and precompute process
+records the slots it holds and the calls it has queued per class in a ledger
+on the shared state backend, and takes slots from it atomically. A process
+defers to the higher classes queued anywhere, and within a class to the
+processes holding fewer slots. Each process updates its ledger entry from
+one background task, which also renews the entry while slots are held; the
+slots of a process that dies are freed when its entry expires
+(SCHEDULER_LEASE_TTL).
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from src.config import config
+from src.metrics import UPSTREAM_QUEUE_WAIT
+from src.state_backend import WORKER_ID, StateBackend, state_backend
+
+logger = logging.getLogger(__name__)
+
+PRIORITIES = ("interactive", "background", "prefetch")
+
+
+@dataclass
+class Schedule:
+    """Class, run key and weight of the upstream calls made in a context"""
+
+    priority: str
+    key: str
+    weight: float = 1.0
+    # (pool, future) of its calls queued for a slot, moved along when it is promoted
+    queued: List[Tuple["_Pool", asyncio.Future]] = field(default_factory=list)
+
+
+_scheduling: ContextVar[Schedule] = ContextVar(
+    "scheduling", default=Schedule("interactive", "default")
+)
+
+
+@contextmanager
+def scheduling(priority: str, key: Optional[str] = None, weight: float = 1.0):
+    """Schedule the upstream calls made inside the block (and their tasks)
+    in `priority`, shared fairly with other runs under `key`"""
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority '{priority}', expected one of {PRIORITIES}")
+    token = _scheduling.set(Schedule(priority, key or _scheduling.get().key, weight))
+    try:
+        yield
+    finally:
+        _scheduling.reset(token)
+
+
+def current_schedule() -> Schedule:
+    return _scheduling.get()
+
+
+def schedule_context(schedule: Schedule) -> Tuple[contextvars.Context, Schedule]:
+    """Copy of the current context (trace, deadline, ...) whose upstream calls
+    are scheduled under a copy of `schedule`, and that copy (e.g. for a task
+    shared by several callers, see `promote`)"""
+    copy = Schedule(schedule.priority, schedule.key, schedule.weight)
+    context = contextvars.copy_context()
+    context.run(_scheduling.set, copy)
+    return context, copy
+
+
+def promote(schedule: Schedule, priority: str) -> None:
+    """Raise the class of the calls made under `schedule` to `priority` if it
+    is higher, including the calls already queued"""
+    if PRIORITIES.index(priority) >= PRIORITIES.index(schedule.priority):
+        return
+    previous, schedule.priority = schedule.priority, priority
+    for pool, future in list(schedule.queued):
+        pool.requeue(future, schedule, previous)
+
+
+def _settle(
+    ledger: Optional[Dict[str, Any]],
+    worker_id: str,
+    now: float,
+    limit: int,
+    reserved: int,
+    lease_ttl: float,
+    held: int,
+    waiting: Dict[str, int],
+    granted: Dict[str, int],
+) -> Dict[str, Any]:
+    """Ledger of an upstream after a process reports the slots it holds and
+    its queued calls per class; fills `granted` with the slots it gets"""
+    workers = {
+        w: entry
+        for w, entry in ((ledger or {}).get("workers") or {}).items()
+        if w != worker_id and entry["expires"] > now
+    }
+    in_use = held + sum(entry["in_use"] for entry in workers.values())
+    granted.update({p: 0 for p in PRIORITIES})
+    for i, priority in enumerate(PRIORITIES):
+        if any(entry["waiting"][j] for entry in workers.values() for j in range(i)):
+            continue  # a higher class is queued in another process
+        capacity = limit if priority == "interactive" else limit - reserved
+        # Processes queued in the same class with fewer slots go first
+        fewest = min(
+            (entry["in_use"] for entry in workers.values() if entry["waiting"][i]),
+            default=None,
+        )
+        while granted[priority] < waiting[priority] and in_use < capacity:
+            mine = held + sum(granted.values())
+            if fewest is not None and mine > fewest:
+                break
+            granted[priority] += 1
+            in_use += 1
+        if granted[priority] < waiting[priority]:
+            break  # lower classes wait behind this one
+
+    entry = {
+        "in_use": held + sum(granted.values()),
+        "waiting": [waiting[p] - granted[p] for p in PRIORITIES],
+        "expires": now + lease_ttl,
+    }
+    if entry["in_use"] or any(entry["waiting"]):
+        workers[worker_id] = entry
+    return {"workers": workers}
+
+
+class _Pool:
+    """Slots of one upstream, shared with the other processes through the
+    ledger, and this process's calls queued for them"""
+
+    def __init__(
+        self,
+        upstream: str,
+        limit: int,
+        reserved: int,
+        backend: StateBackend,
+        lease_ttl: float,
+        poll_interval: float,
+    ):
+        self.upstream = upstream
+        self.limit = limit
+        self.reserved = min(reserved, limit - 1)
+        self.backend = backend
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.in_use = 0  # slots held by this process
+        # priority -> run key -> queued calls, oldest first
+        self._queues: Dict[str, Dict[str, Deque[asyncio.Future]]] = {
+            p: defaultdict(deque) for p in PRIORITIES
+        }
+        # run key -> slots served so far divided by weight, while it has calls queued
+        self._served: Dict[str, float] = {}
+        self._weights: Dict[str, float] = {}
+        self._ledger: Dict[str, Any] = {}  # as of the last update, for snapshots
+        self._registered = False  # whether this process has an entry in the ledger
+        self._wake = asyncio.Event()
+        self._pump: Optional[asyncio.Task] = None
+
+    async def acquire(self, schedule: Schedule) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(schedule, future)
+        schedule.queued.append((self, future))
+        self._kick()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just before the cancellation: hand the slot on
+                self.release()
+            else:
+                self._dequeue(schedule, schedule.priority, future)
+            raise
+        finally:
+            schedule.queued.remove((self, future))
+
+    def _enqueue(self, schedule: Schedule, future: asyncio.Future) -> None:
+        key = schedule.key
+        if key not in self._served:
+            # A run joining the queue starts level with the least served one
+            self._served[key] = min(self._served.values(), default=0.0)
+        self._weights[key] = schedule.weight
+        self._queues[schedule.priority][key].append(future)
+
+    def _dequeue(self, schedule: Schedule, priority: str, future: asyncio.Future) -> bool:
+        queue = self._queues[priority].get(schedule.key)
+        if queue is None or future not in queue:
+            return False
+        queue.remove(future)
+        if not queue:
+            self._forget(priority, schedule.key)
+        return True
+
+    def requeue(self, future: asyncio.Future, schedule: Schedule, previous: str) -> None:
+        """Move a queued call to the class its schedule was promoted to"""
+        if self._dequeue(schedule, previous, future):
+            self._enqueue(schedule, future)
+            self._kick()
+
+    def release(self) -> None:
+        self.in_use -= 1
+        self._kick()
+
+    def _kick(self) -> None:
+        """Have the pump update the ledger now"""
+        loop = asyncio.get_running_loop()
+        if self._pump is not None and self._pump.get_loop() is not loop:
+            # Left over from a previous event loop (e.g. successive asyncio.run)
+            self._pump, self._wake = None, asyncio.Event()
+        self._wake.set()
+        if self._pump is None or self._pump.done():
+            # A clean context: the pump serves every run, not the caller's
+            self._pump = loop.create_task(
+                self._run_pump(), name=f"scheduler-{self.upstream}",
+                context=contextvars.Context(),
+            )
+
+    def _queued(self) -> Dict[str, int]:
+        return {p: sum(len(q) for q in self._queues[p].values()) for p in PRIORITIES}
+
+    async def _run_pump(self) -> None:
+        """Report this process's slots and queued calls to the ledger and grant
+        the slots it gets, until it holds and waits for none"""
+        while True:
+            self._wake.clear()
+            try:
+                await self._update()
+            except Exception as e:
+                logger.warning(f"Updating the {self.upstream} slot ledger failed: {e}")
+            queued = any(self._queued().values())
+            if not queued and not self.in_use and not self._registered:
+                self._pump = None
+                return
+            # Queued calls poll for slots freed by other processes; held slots
+            # only need their entry renewed
+            timeout = self.poll_interval if queued else self.lease_ttl / 3
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except TimeoutError:
+                pass
+
+    async def _update(self) -> None:
+        waiting = self._queued()
+        granted: Dict[str, int] = {}
+        held = self.in_use
+        self._ledger = await self.backend.update_json(
+            f"scheduler:{self.upstream}",
+            lambda ledger: _settle(
+                ledger, WORKER_ID, time.time(), self.limit, self.reserved,
+                self.lease_ttl, held, waiting, granted,
+            ),
+            ttl=self.lease_ttl,
+        )
+        self._registered = WORKER_ID in self._ledger["workers"]
+        # Slots released while the ledger was updated are reported next time
+        self.in_use += sum(granted.values())
+        spare = 0
+        for priority in PRIORITIES:
+            spare += self._grant(priority, granted[priority])
+        if spare:
+            # Callers cancelled meanwhile: give their slots back
+            self.in_use -= spare
+            self._wake.set()
+
+    def _grant(self, priority: str, count: int) -> int:
+        """Wake up to `count` queued calls of `priority`, fairly across runs;
+        returns the slots left over"""
+        queues = self._queues[priority]
+        while count and queues:
+            key = min(queues, key=lambda k: self._served[k])
+            future = queues[key].popleft()
+            if not queues[key]:
+                self._forget(priority, key)
+            else:
+                self._served[key] += 1 / self._weights[key]
+            if future.cancelled():
+                continue
+            future.set_result(None)
+            count -= 1
+        return count
+
+    def _forget(self, priority: str, key: str) -> None:
+        del self._queues[priority][key]
+        if not any(key in queues for queues in self._queues.values()):
+            self._served.pop(key, None)
+            self._weights.pop(key, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        workers: List[Dict[str, Any]] = list((self._ledger.get("workers") or {}).values())
+        return {
+            "limit": self.limit,
+            "in_use": self.in_use,
+            "queued": self._queued(),
+            # Every process, as of this process's last ledger update
+            "shared": {
+                "processes": len(workers),
+                "in_use": sum(entry["in_use"] for entry in workers),
+                "queued": {
+                    p: sum(entry["waiting"][i] for entry in workers)
+                    for i, p in enumerate(PRIORITIES)
+                },
+            },
+        }
+
+
+class UpstreamScheduler:
+    """Slot pools of the upstream services"""
+
+    def __init__(
+        self,
+        limits: Dict[str, int],
+        reserved: int,
+        backend: StateBackend,
+        lease_ttl: float,
+        poll_interval: float,
+    ):
+        self._pools = {
+            upstream: _Pool(upstream, limit, reserved, backend, lease_ttl, poll_interval)
+            for upstream, limit in limits.items()
+        }
+
+    @asynccontextmanager
+    async def slot(self, upstream: str):
+        """Hold a slot of `upstream` for the duration of the block"""
+        pool = self._pools.get(upstream)
+        if pool is None:
+            yield
+            return
+        schedule = _scheduling.get()
+        start = time.perf_counter()
+        await pool.acquire(schedule)
+        # Labelled with the class the call was granted in, after any promotion
+        UPSTREAM_QUEUE_WAIT.labels(upstream=upstream, priority=schedule.priority).observe(
+            time.perf_counter() - start
+        )
+        try:
+            yield
+        finally:
+            pool.release()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {upstream: pool.snapshot() for upstream, pool in self._pools.items()}
+
+
+upstream_scheduler = UpstreamScheduler(
+    limits=config.SCHEDULER_LIMITS,
+    reserved=config.SCHEDULER_RESERVED_INTERACTIVE,
+    backend=state_backend,
+    lease_ttl=config.SCHEDULER_LEASE_TTL,
+    poll_interval=config.SCHEDULER_POLL_INTERVAL,
+)
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Schemas of the agents' LLM outputs, with local repair
+schemas.py
+
+Model outputs are parsed and validated here rather than in each agent.
+Common defects are repaired locally, without another model call: text or
+markdown fences around the JSON, output cut off mid-way (the last complete
+values are kept), lists wrapped in an object (`{"applications": [...]}`),
+a single object where a list is expected, and roadmap rows of the wrong
+shape. Invalid items of a list are dropped rather than failing the whole
+list. `OutputError` is raised only when nothing usable is left; the caller
+may then re-ask the model (see `mistral_chat_json` in src/upstream.py).
+"""
+
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+
+logger = logging.getLogger(__name__)
+
+# Cut points tried when closing a truncated output, last ones first
+MAX_TRUNCATION_CANDIDATES = 50
+
+
+class OutputError(ValueError):
+    """Model output with no usable content, even after local repair"""
+
+
+class ConceptOutput(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    name: str = Field(min_length=1)
+    type: str = ""
+    domain: str = ""
+    significance: str = ""
+    confidence: float = 0.0
+
+
+class ApplicationOutput(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    name: str = Field(min_length=1)
+    brief_description: str = ""
+    description: str = Field(min_length=1)  # a cut-off item loses it and is dropped
+
+
+# Keys models use for the parts of a roadmap row given as an object
+ROW_KEYS = (
+    ("concept", "name", "topic", "title"),
+    ("estimated_time", "time", "duration"),
+    ("description", "details", "prerequisites"),
+)
+
+
+class RoadmapOutput(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    title: str = ""
+    description_1: List[Tuple[str, str, str]] = []
+    description_2: List[Tuple[str, str, str]] = []
+    description_3: List[Tuple[str, str, str]] = []
+
+    @field_validator("description_1", "description_2", "description_3", mode="before")
+    @classmethod
+    def coerce_rows(cls, rows: Any) -> Any:
+        """Rows as [concept, time, description]: objects, short or long rows and
+        bare strings are brought to that shape"""
+        if rows is None:
+            return []
+        if not isinstance(rows, list):
+            rows = [rows]
+        coerced = []
+        for row in rows:
+            if isinstance(row, dict):
+                row = [
+                    next((str(row[k]) for k in keys if row.get(k) is not None), "")
+                    for keys in ROW_KEYS
+                ]
+            elif not isinstance(row, (list, tuple)):
+                row = [row]
+            row = ["" if v is None else str(v) for v in row[:3]]
+            if row and row[0]:
+                coerced.append(row + [""] * (3 - len(row)))
+        return coerced
+
+    @model_validator(mode="after")
+    def has_rows(self) -> "RoadmapOutput":
+        if not (self.description_1 or self.description_2 or self.description_3):
+            raise ValueError("roadmap has no rows in any phase")
+        return self
+
+
+def _strip_fences(text: str) -> str:
+    """The JSON part of a reply, without markdown fences or surrounding text"""
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        return text
+    return text[min(starts):].strip().removesuffix("```").strip()
+
+
+def _close_truncated(text: str) -> Any:
+    """Parse an output cut off mid-way, keeping its last complete values
+
+    Raises:
+        ValueError: If no prefix of `text` can be closed into valid JSON
+    """
+    stack: List[str] = []
+    in_string = escaped = False
+    candidates: List[Tuple[int, Tuple[str, ...]]] = []
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "[{":
+            stack.append("]" if char == "[" else "}")
+        elif char in "]}":
+            if stack:
+                stack.pop()
+            candidates.append((i + 1, tuple(stack)))
+        elif char == ",":
+            candidates.append((i, tuple(stack)))
+    for cut, open_brackets in reversed(candidates[-MAX_TRUNCATION_CANDIDATES:]):
+        try:
+            return json.loads(text[:cut] + "".join(reversed(open_brackets)))
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("no complete JSON value in the output")
+
+
+def load_json(text: str) -> Tuple[Any, bool]:
+    """JSON value of a model reply, and whether it had to be repaired
+
+    Raises:
+        OutputError: If no JSON can be recovered from the reply
+    """
+    try:
+        return json.loads(text), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+    text = _strip_fences(text or "")
+    try:
+        return json.loads(text), True
+    except json.JSONDecodeError:
+        pass
+    try:
+        return _close_truncated(text), True
+    except ValueError as e:
+        raise OutputError(f"Output is not JSON: {e}") from e
+
+
+def _as_items(value: Any) -> Tuple[List[Any], bool]:
+    """Items of an output expected to be a list, unwrapping `{"<key>": [...]}`"""
+    if isinstance(value, list):
+        return value, False
+    if isinstance(value, dict):
+        if "name" not in value:
+            lists = [v for v in value.values() if isinstance(v, list)]
+            if len(lists) == 1:
+                return lists[0], True
+        return [value], True
+    raise OutputError(f"Expected a list, got {type(value).__name__}")
+
+
+def _as_object(value: Any) -> Tuple[Dict[str, Any], bool]:
+    """Object of an output expected to be one, unwrapping `{"<key>": {...}}` or `[{...}]`"""
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+        repaired = True
+    else:
+        repaired = False
+    if isinstance(value, dict) and len(value) == 1:
+        inner = next(iter(value.values()))
+        if isinstance(inner, dict):
+            return inner, True
+    if not isinstance(value, dict):
+        raise OutputError(f"Expected an object, got {type(value).__name__}")
+    return value, repaired
+
+
+def parse_output(text: str, schema: Type[BaseModel], many: bool = False) -> Tuple[Any, bool]:
+    """Validated output (a list of dicts with `many`, else a dict), and whether
+    it had to be repaired
+
+    Raises:
+        OutputError: If nothing valid is left after repair
+    """
+    value, repaired = load_json(text)
+    if not many:
+        obj, unwrapped = _as_object(value)
+        try:
+            return schema.model_validate(obj).model_dump(mode="json"), repaired or unwrapped
+        except ValidationError as e:
+            raise OutputError(_first_error(e)) from e
+
+    items, unwrapped = _as_items(value)
+    valid: List[Dict[str, Any]] = []
+    first_error: Optional[str] = None
+    for item in items:
+        try:
+            valid.append(schema.model_validate(item).model_dump(mode="json"))
+        except ValidationError as e:
+            first_error = first_error or _first_error(e)
+    if first_error:
+        if not valid:
+            raise OutputError(first_error)
+        logger.warning(f"Dropped {len(items) - len(valid)} invalid {schema.__name__} items: {first_error}")
+    return valid, repaired or unwrapped or first_error is not None
+
+
+def _first_error(e: ValidationError) -> str:
+    error = e.errors()[0]
+    location = ".".join(str(part) for part in error["loc"]) or "output"
+    return f"{location}: {error['msg']}"
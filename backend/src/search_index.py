@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Full-text index of the content generated by runs
+search_index.py
+
+Concepts, applications and roadmap items of every run are indexed in a
+SQLite FTS5 table as the run saves its state, so `/search` can return ranked
+"explore" results in milliseconds without starting a workflow. A run is
+re-indexed as a whole each time (e.g. once its roadmaps are generated), and
+the same item found by several runs is returned once, from its best match. The entries of a run are removed when it is evicted
+(see src/storage.py).
+
+Calls are blocking; async callers run them with `asyncio.to_thread`.
+
+RUN (from backend/):
+    python -m src.search_index --rebuild   # index every checkpointed run
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+from src.blobs import blob_store
+from src.config import config
+from src.storage import storage
+
+logger = logging.getLogger(__name__)
+
+KINDS = ("concept", "application", "roadmap_item")
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, list):
+        return " ".join(_text(v) for v in value)
+    return "" if value is None else str(value)
+
+
+def run_entries(state: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Indexable entries of a run's state (blob references are resolved)"""
+    entries = []
+    for concept in state.get("relevant_concepts") or []:
+        entries.append(
+            {
+                "kind": "concept",
+                "concept": concept["name"],
+                "application": "",
+                "title": concept["name"],
+                "body": " ".join(
+                    _text(concept.get(k)) for k in ("type", "domain", "significance")
+                ),
+            }
+        )
+    for concept_name, apps in (state.get("concept_applications") or {}).items():
+        for app in apps:
+            entries.append(
+                {
+                    "kind": "application",
+                    "concept": concept_name,
+                    "application": app["name"],
+                    "title": app["name"],
+                    "body": " ".join(
+                        (
+                            _text(app.get("brief_description")),
+                            _text(blob_store.resolve(app.get("description"))),
+                        )
+                    ),
+                }
+            )
+            for roadmap in blob_store.resolve(app.get("RoadmapData")) or []:
+                for phase in ("description_1", "description_2", "description_3"):
+                    for row in roadmap.get(phase) or []:
+                        entries.append(
+                            {
+                                "kind": "roadmap_item",
+                                "concept": concept_name,
+                                "application": app["name"],
+                                "title": _text(row[0]) if row else "",
+                                "body": _text(row[1:]),
+                            }
+                        )
+    return entries
+
+
+def match_expression(query: str) -> Optional[str]:
+    """FTS5 query matching every word of `query` as a prefix, or None if it has no words
+
+    User input is never passed to MATCH as is: quotes, operators and column
+    filters would be syntax errors or change the meaning of the query.
+    """
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+class SearchIndex:
+    """FTS5 index of the entries of every indexed run"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS entries USING fts5("
+            "run_id UNINDEXED, kind UNINDEXED, concept, application, title, body, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, text_input TEXT, indexed REAL)"
+        )
+        return conn
+
+    def index_run(self, state: Dict[str, Any]) -> int:
+        """Replace the entries of a run by those of `state`; returns their number"""
+        run_id = state["uuid"]
+        entries = run_entries(state)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE run_id = ?", (run_id,))
+            conn.executemany(
+                "INSERT INTO entries (run_id, kind, concept, application, title, body) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (run_id, e["kind"], e["concept"], e["application"], e["title"], e["body"])
+                    for e in entries
+                ],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO runs VALUES (?, ?, ?)",
+                (run_id, state.get("text_input") or "", time.time()),
+            )
+        return len(entries)
+
+    def search(
+        self, query: str, kind: Optional[str] = None, limit: int = 20
+    ) -> List[Dict[str, Any]]:
+        """Best-ranked entries matching `query`, one per distinct item
+
+        Every word matches as a prefix ("transf" finds "Fourier Transforms").
+        Titles weigh most, then application and concept names, then the body.
+        """
+        expression = match_expression(query)
+        if expression is None or not os.path.exists(self.path):
+            return []
+        sql = (
+            "SELECT run_id, kind, concept, application, title, "
+            "snippet(entries, 5, '<mark>', '</mark>', '…', 16), "
+            "bm25(entries, 0, 0, 2.0, 4.0, 8.0, 1.0) AS rank "
+            "FROM entries WHERE entries MATCH ?"
+        )
+        params: List[Any] = [expression]
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        # Over-fetch: the same item indexed by several runs is returned once
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit * 4)
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        results: List[Dict[str, Any]] = []
+        seen = set()
+        for run_id, kind_, concept, application, title, snippet, rank in rows:
+            key = (kind_, application.casefold(), title.casefold())
+            if key in seen:
+                continue
+            seen.add(key)
+            results.append(
+                {
+                    "kind": kind_,
+                    "run_id": run_id,
+                    "concept": concept,
+                    "application": application or None,
+                    "title": title,
+                    "snippet": snippet,
+                    "score": -rank,
+                }
+            )
+            if len(results) == limit:
+                break
+        return results
+
+    def delete_run(self, run_id: str) -> None:
+        """Remove the entries of a run (e.g. once it is evicted)"""
+        if not os.path.exists(self.path):
+            return
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+
+    def stats(self) -> Dict[str, int]:
+        if not os.path.exists(self.path):
+            return {"runs": 0, "entries": 0}
+        with self._connect() as conn:
+            runs = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+            entries = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"runs": runs, "entries": entries}
+
+
+search_index = SearchIndex(config.SEARCH_INDEX_DB)
+storage.on_evict("run", search_index.delete_run)
+
+
+async def rebuild() -> Dict[str, int]:
+    """Index every run with a checkpoint"""
+    from src.agents.orchestrator import Orchestrator
+
+    orchestrator = Orchestrator(publish_state=False)
+    await orchestrator.open_checkpointer(config.CHECKPOINT_DB)
+    try:
+        async with orchestrator.checkpointer.conn.execute(
+            "SELECT DISTINCT thread_id FROM checkpoints"
+        ) as cursor:
+            run_ids = [row[0] for row in await cursor.fetchall()]
+        for run_id in run_ids:
+            state = await orchestrator.get_state(run_id)
+            if state and state.get("uuid"):
+                await asyncio.to_thread(search_index.index_run, state)
+    finally:
+        await orchestrator.close_checkpointer()
+    return search_index.stats()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the full-text index of generated content")
+    parser.add_argument("--rebuild", action="store_true", help="Index every checkpointed run")
+    parser.add_argument("--query", default=None, help="Print the results of a search")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.rebuild:
+        print(asyncio.run(rebuild()))
+    if args.query:
+        for result in search_index.search(args.query):
+            print(f"{result['score']:6.2f} {result['kind']:<13} {result['title']} ({result['concept']})")
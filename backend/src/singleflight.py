@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""Single-flight coalescing of identical in-flight calls
+singleflight.py
+
+Concurrent calls with the same key share one execution: the first caller
+starts it as a task, later ones wait for the same task, and every caller
+receives its own copy of the result (so callers can mutate it freely) or
+the same exception. A caller going away does not cancel the shared call
+while others still wait for it; the last one leaving cancels it (unless the
+group keeps abandoned calls running). Nothing is kept once the call
+finishes: identical calls made afterwards run again (caching is
+src/cache.py's job).
+
+The shared call runs in a copy of its first caller's context, so it keeps
+that caller's deadline, degrade state and trace: its spans nest under the
+first caller's `singleflight.<name>` span. Its upstream calls are scheduled
+at the highest priority class of the callers waiting for it (see
+src/scheduler.py). Every caller records the wait as a span of its own trace;
+the span of a caller that joined links to the one holding the shared call's
+spans (`flight_trace_id`, `flight_span_id`).
+"""
+
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from src.metrics import COALESCED_CALLS
+from src.scheduler import Schedule, current_schedule, promote, schedule_context
+from src.tracing import Span, span
+
+logger = logging.getLogger(__name__)
+
+
+def flight_key(*parts: Any) -> str:
+    """Key of a call from its (JSON-serializable) inputs"""
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task, schedule: Schedule, root: Optional[Span]):
+        self.task = task
+        self.schedule = schedule
+        # Span of the first caller, parent of the shared call's spans
+        self.root = root
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Group of calls of one kind, coalesced by key"""
+
+    def __init__(self, name: str, cancel_abandoned: bool = True):
+        self.name = name
+        self.cancel_abandoned = cancel_abandoned
+        self._flights: Dict[str, _Flight] = {}
+
+    async def do(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Result of `fetch()`, shared with the identical calls in flight"""
+        waiter = current_schedule()
+        flight = self._flights.get(key)
+        coalesced = flight is not None
+        with span(f"singleflight.{self.name}", coalesced=coalesced) as s:
+            if flight is None:
+                # Started inside the span, so the call's spans nest under it
+                context, schedule = schedule_context(waiter)
+                task = asyncio.get_running_loop().create_task(fetch(), context=context)
+                flight = _Flight(task, schedule, s)
+                self._flights[key] = flight
+                flight.task.add_done_callback(lambda _: self._land(key, flight))
+            else:
+                COALESCED_CALLS.labels(call=self.name).inc()
+                promote(flight.schedule, waiter.priority)
+                if s is not None and flight.root is not None:
+                    s.set_attribute("flight_trace_id", flight.root.trace_id)
+                    s.set_attribute("flight_span_id", flight.root.span_id)
+            return await self._wait(key, flight)
+
+    async def _wait(self, key: str, flight: _Flight) -> Any:
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if self.cancel_abandoned and flight.waiters == 0 and not flight.task.done():
+                # Nobody is waiting for the result any more
+                self._land(key, flight)
+                flight.task.cancel()
+            raise
+        except Exception:
+            flight.waiters -= 1
+            raise
+        flight.waiters -= 1
+        return copy.deepcopy(result)
+
+    def _land(self, key: str, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def is_in_flight(self, key: str) -> bool:
+        return key in self._flights
+
+    def in_flight(self) -> int:
+        return len(self._flights)
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""Key-value state shared by every worker process
+state_backend.py
+
+Run statuses, cancellation requests, the latest workflow state, upstream
+caches, the upstream slot ledger (src/scheduler.py) and the locks guarding
+read-modify-writes of run checkpoints live here rather than in process memory, so any uvicorn worker can answer for any run. The default backend is a SQLite database in WAL mode
+(many readers, one writer, safe across processes on one box). The Redis
+backend accepts any client with the redis.asyncio get/set/delete API;
+`InMemoryRedis` is a local stand-in for tests and single-process use.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import aiosqlite
+
+from src.config import config
+
+logger = logging.getLogger(__name__)
+
+# Identity of this process among the workers sharing the backend
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# Longest a RedisBackend.update_json lock is held or waited for (seconds)
+UPDATE_LOCK_TIMEOUT = 5.0
+# A `lock` whose holder died is taken over after this long (seconds)
+LOCK_TTL = 30.0
+# How often a waiting `lock` checks whether it was released (seconds)
+LOCK_POLL_INTERVAL = 0.05
+
+
+class StateBackend:
+    """String key-value store with optional expiry"""
+
+    async def open(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        """Store `value`, expiring after `ttl` seconds if given"""
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def get_json(self, key: str) -> Any:
+        value = await self.get(key)
+        return None if value is None else json.loads(value)
+
+    async def set_json(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self.set(key, json.dumps(value, default=str), ttl=ttl)
+
+    async def update_json(
+        self, key: str, update: Callable[[Any], Any], ttl: Optional[float] = None
+    ) -> Any:
+        """Replace the value of `key` by `update(value)` atomically across
+        processes (None if missing) and return the new value; `update` must be
+        quick and must not await"""
+        raise NotImplementedError
+
+    async def purge_expired(self) -> None:
+        """Delete expired keys, for backends that do not expire them on their own"""
+        pass
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float = LOCK_TTL, timeout: float = LOCK_TTL):
+        """Hold the lock `name` for the block, exclusively across processes;
+        a holder that dies leaves it for `ttl` seconds at most
+
+        Raises:
+            TimeoutError: If the lock could not be taken within `timeout` seconds
+        """
+        key = f"lock:{name}"
+        token = uuid.uuid4().hex
+
+        def take(holder: Any) -> Any:
+            now = time.time()
+            if holder is None or holder["expires"] < now:
+                return {"token": token, "expires": now + ttl}
+            return holder
+
+        def release(holder: Any) -> Any:
+            return None if holder is not None and holder["token"] == token else holder
+
+        deadline = time.monotonic() + timeout
+        while (await self.update_json(key, take, ttl=ttl))["token"] != token:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not take lock {name}")
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            await self.update_json(key, release, ttl=ttl)
+
+
+class SqliteBackend(StateBackend):
+    """Backend storing keys in a SQLite table, opened on first use"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._open_lock = asyncio.Lock()
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self._conn is not None:
+                return
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = await aiosqlite.connect(self.db_path, timeout=30)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            await conn.execute(
+                "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?",
+                (time.time(),),
+            )
+            await conn.commit()
+            self._conn = conn
+            logger.info(f"Shared state stored in {self.db_path}")
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def _connection(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            await self.open()
+        return self._conn
+
+    async def get(self, key: str) -> Optional[str]:
+        conn = await self._connection()
+        async with conn.execute(
+            "SELECT value, expires_at FROM kv WHERE key = ?", (key,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            await self.delete(key)
+            return None
+        return value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        conn = await self._connection()
+        expires_at = time.time() + ttl if ttl else None
+        await conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, expires_at),
+        )
+        await conn.commit()
+
+    async def delete(self, key: str) -> None:
+        conn = await self._connection()
+        await conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+        await conn.commit()
+
+    async def purge_expired(self) -> None:
+        conn = await self._connection()
+        await conn.execute(
+            "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),)
+        )
+        await conn.commit()
+
+    async def update_json(
+        self, key: str, update: Callable[[Any], Any], ttl: Optional[float] = None
+    ) -> Any:
+        await self._connection()  # creates the table
+        return await asyncio.to_thread(self._update_json, key, update, ttl)
+
+    def _update_json(self, key: str, update: Callable[[Any], Any], ttl: Optional[float]) -> Any:
+        # Own connection: a transaction on the shared one would take in the
+        # statements other coroutines run meanwhile
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            # Takes the write lock up front, so no other process reads in between
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT value, expires_at FROM kv WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            current = None
+            if row is not None and (row[1] is None or row[1] >= now):
+                current = json.loads(row[0])
+            value = update(current)
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, default=str), now + ttl if ttl else None),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return value
+
+
+class RedisBackend(StateBackend):
+    """Backend on a Redis server, or on any client with the same API"""
+
+    def __init__(self, url: str = "", client: Any = None, prefix: str = "motivate_me:"):
+        self.url = url
+        self.client = client
+        self.prefix = prefix
+
+    async def open(self) -> None:
+        if self.client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError as e:
+                raise ImportError(
+                    "STATE_BACKEND=redis requires the redis package (pip install redis)"
+                ) from e
+            self.client = redis.from_url(self.url, decode_responses=True)
+            logger.info(f"Shared state stored in Redis at {self.url}")
+
+    async def close(self) -> None:
+        if self.client is not None and hasattr(self.client, "aclose"):
+            await self.client.aclose()
+
+    async def _client(self) -> Any:
+        if self.client is None:
+            await self.open()
+        return self.client
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await (await self._client()).get(self.prefix + key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        await (await self._client()).set(
+            self.prefix + key, value, px=int(ttl * 1000) if ttl else None
+        )
+
+    async def delete(self, key: str) -> None:
+        await (await self._client()).delete(self.prefix + key)
+
+    async def update_json(
+        self, key: str, update: Callable[[Any], Any], ttl: Optional[float] = None
+    ) -> Any:
+        # A lock key set with NX, released only by its holder; it expires on
+        # its own if the holder dies
+        client = await self._client()
+        lock_key = f"{self.prefix}lock:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + UPDATE_LOCK_TIMEOUT
+        while not await client.set(lock_key, token, nx=True, px=int(UPDATE_LOCK_TIMEOUT * 1000)):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not lock {key}")
+            await asyncio.sleep(0.005)
+        try:
+            value = update(await self.get_json(key))
+            await self.set_json(key, value, ttl=ttl)
+        finally:
+            if await client.get(lock_key) == token:
+                await client.delete(lock_key)
+        return value
+
+
+class InMemoryRedis:
+    """Process-local stand-in for a redis.asyncio client (get/set/delete)"""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        value, expires_at = self._data.get(key, (None, None))
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    async def set(
+        self, key: str, value: str, px: Optional[int] = None, nx: bool = False
+    ) -> Optional[bool]:
+        if nx and await self.get(key) is not None:
+            return None
+        self._data[key] = (value, time.monotonic() + px / 1000 if px else None)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self._data.pop(key, None) is not None for key in keys)
+
+    async def aclose(self) -> None:
+        pass
+
+
+def create_backend(kind: str) -> StateBackend:
+    """Backend selected by STATE_BACKEND: sqlite, redis or memory"""
+    if kind == "sqlite":
+        return SqliteBackend(config.STATE_DB)
+    if kind == "redis":
+        return RedisBackend(url=config.REDIS_URL)
+    if kind == "memory":
+        return RedisBackend(client=InMemoryRedis())
+    raise ValueError(f"Unknown STATE_BACKEND '{kind}', expected sqlite, redis or memory")
+
+
+state_backend = create_backend(config.STATE_BACKEND)
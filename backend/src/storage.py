@@ -0,0 +1,437 @@
+# -*- coding: utf-8 -*-
+"""Disk quota and LRU eviction for the files runs leave in tmp/
+storage.py
+
+Everything runs write counts towards STORAGE_QUOTA_MB:
+
+- artifacts, tracked one by one in a SQLite index with their size and last
+  access: each run's directory `RUNS_DIR/<run_id>/` (e.g. its profiles),
+  uploaded documents, blobs, and the page image directories older versions
+  left in tmp/<uuid>/
+- the live bytes of the SQLite databases (checkpoints, shared state, pages,
+  search index, precomputed results, this index)
+- the trace export files (capped by their own rotation, see src/tracing.py)
+
+A background task keeps the index in sync with the disk and, when usage
+exceeds the quota, deletes the least recently used artifacts until it is
+back under 90% of the quota. Evicting a run or a document also deletes the
+rows the databases hold for it, through the hooks their modules register
+with `on_evict` (a run's checkpoints and search entries, a document's OCR
+pages). Artifacts referenced by any run still running on any worker are
+never evicted.
+
+A blob stays referenced from the checkpoints of the runs that wrote it, so it
+is kept as long as any of them is: evicting a run also evicts the blobs no
+other tracked run uses.
+
+Image variants (bounded by their own cache, see src/image_proxy.py) are not
+managed here.
+
+Calls are blocking, except `cleanup`; async callers run them with
+`asyncio.to_thread`.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from src.config import config
+from src.runs import run_manager
+from src.state_backend import state_backend
+from src.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Usage is brought back under this fraction of the quota, so eviction is not
+# needed again after every new file
+LOW_WATERMARK = 0.9
+# Run statuses after which a run no longer protects what it used
+FINISHED = ("completed", "failed", "interrupted")
+# Files of the page image directories older versions left under the tmp root
+LEGACY_PAGE_PATTERN = re.compile(r"^page_\d+\.jpg$")
+
+
+def _disk_size(path: str) -> int:
+    """Bytes of a file, or of every file under a directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+    return total
+
+
+def _is_legacy_dir(path: str) -> bool:
+    """Whether `path` is a page image directory of an older version"""
+    if not os.path.isdir(path):
+        return False
+    with os.scandir(path) as entries:
+        return any(LEGACY_PAGE_PATTERN.match(entry.name) for entry in entries)
+
+
+def database_bytes(path: str) -> int:
+    """Bytes of the pages in use in a SQLite database (free pages are reused
+    before the file grows), 0 if it does not exist"""
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+    return (page_count - free) * page_size
+
+
+class StorageManager:
+    """Index of the managed artifacts, with quota enforcement"""
+
+    def __init__(
+        self,
+        index_path: str,
+        runs_dir: str,
+        documents_dir: str,
+        blobs_dir: str,
+        legacy_root: str,
+        databases: Dict[str, str],
+        quota_bytes: int,
+    ):
+        self.index_path = index_path
+        self.runs_dir = runs_dir
+        self.documents_dir = documents_dir
+        self.blobs_dir = blobs_dir
+        self.legacy_root = legacy_root
+        self.databases = databases
+        self.quota_bytes = quota_bytes
+        # kind -> hooks deleting what the databases hold for an evicted artifact
+        self._evict_hooks: Dict[str, List[Callable[[str], None]]] = defaultdict(list)
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(self.index_path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts (path TEXT PRIMARY KEY, kind TEXT, "
+            "run_id TEXT, size INTEGER, last_access REAL)"
+        )
+        # Every run that used an artifact, so each of them protects it while it runs
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifact_runs (path TEXT, run_id TEXT, "
+            "PRIMARY KEY (path, run_id))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS artifact_runs_run ON artifact_runs (run_id)")
+        return conn
+
+    def on_evict(self, kind: str, hook: Callable[[str], None]) -> None:
+        """Call `hook(key)` when an artifact of `kind` is evicted; the key is
+        the run id of a run, the document id of a document"""
+        self._evict_hooks[kind].append(hook)
+
+    # --- Recording ------------------------------------------------------------
+
+    def run_path(self, run_id: str) -> str:
+        """Directory of a run's artifacts (not created)"""
+        if not run_id or os.sep in run_id or run_id.startswith("."):
+            raise ValueError(f"Invalid run id: {run_id!r}")
+        return os.path.join(self.runs_dir, run_id)
+
+    def run_dir(self, run_id: str) -> str:
+        """Directory of a run's artifacts, created and tracked on first use"""
+        path = self.run_path(run_id)
+        os.makedirs(path, exist_ok=True)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO artifacts VALUES (?, 'run', ?, 0, ?) "
+                "ON CONFLICT(path) DO UPDATE SET last_access = excluded.last_access",
+                (path, run_id, now),
+            )
+            conn.execute("INSERT OR IGNORE INTO artifact_runs VALUES (?, ?)", (path, run_id))
+        return path
+
+    def adopt_runs(self, run_ids: List[str]) -> int:
+        """Track runs recorded elsewhere (e.g. checkpointed before runs were
+        tracked) that have no directory yet, so they can be evicted; returns
+        how many were adopted"""
+        adopted = []
+        for run_id in run_ids:
+            try:
+                path = self.run_path(run_id)
+            except ValueError:
+                continue
+            if not os.path.isdir(path):
+                os.makedirs(path, exist_ok=True)
+                adopted.append((path, run_id, time.time()))
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO artifacts VALUES (?, 'run', ?, 0, ?)", adopted
+            )
+        return len(adopted)
+
+    def record(self, path: str, kind: str, run_id: Optional[str] = None) -> None:
+        """Track a new or changed artifact (its size is measured now), used by `run_id`"""
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO artifacts VALUES (?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET "
+                "size = excluded.size, last_access = excluded.last_access, "
+                "run_id = COALESCE(excluded.run_id, run_id)",
+                (path, kind, run_id, _disk_size(path), time.time()),
+            )
+            if run_id:
+                conn.execute("INSERT OR IGNORE INTO artifact_runs VALUES (?, ?)", (path, run_id))
+
+    def touch(self, *paths: str, run_id: Optional[str] = None) -> None:
+        """Mark tracked artifacts as used (by `run_id`, which then protects them
+        while it runs); untracked paths are ignored"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE artifacts SET last_access = ?, run_id = COALESCE(?, run_id) WHERE path = ?",
+                [(now, run_id, path) for path in paths],
+            )
+            if run_id:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO artifact_runs SELECT path, ? FROM artifacts WHERE path = ?",
+                    [(run_id, path) for path in paths],
+                )
+
+    # --- Cleanup --------------------------------------------------------------
+
+    def _on_disk(self) -> Dict[str, Tuple[str, Optional[str]]]:
+        """Managed artifacts present on disk: path -> (kind, owning run id)"""
+        found: Dict[str, Tuple[str, Optional[str]]] = {}
+        for root, kind in (
+            (self.runs_dir, "run"),
+            (self.documents_dir, "document"),
+            (self.blobs_dir, "blob"),
+            (self.legacy_root, "legacy"),
+        ):
+            try:
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        # Skip partial writes
+                        if entry.name.startswith("."):
+                            continue
+                        if kind == "document" and entry.name.endswith(".json"):
+                            continue  # metadata, deleted with its document
+                        if kind == "legacy" and not _is_legacy_dir(entry.path):
+                            continue
+                        found[entry.path] = (kind, entry.name if kind == "run" else None)
+            except FileNotFoundError:
+                continue
+        return found
+
+    def sync(self) -> None:
+        """Bring the index in line with the disk: adopt untracked artifacts,
+        forget deleted ones, measure them again and take their modification
+        time as an access (e.g. blobs read or written again)"""
+        on_disk = self._on_disk()
+        with self._connect() as conn:
+            indexed = {
+                path: kind for path, kind in conn.execute("SELECT path, kind FROM artifacts")
+            }
+            gone = [(path,) for path in indexed if path not in on_disk]
+            conn.executemany("DELETE FROM artifacts WHERE path = ?", gone)
+            conn.executemany("DELETE FROM artifact_runs WHERE path = ?", gone)
+            updates, inserts = [], []
+            for path, (kind, run_id) in on_disk.items():
+                try:
+                    size, mtime = _disk_size(path), os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                if path in indexed:
+                    updates.append((size, mtime, path))
+                else:
+                    inserts.append((path, kind, run_id, size, mtime))
+            conn.executemany(
+                "UPDATE artifacts SET size = ?, last_access = MAX(last_access, ?) WHERE path = ?",
+                updates,
+            )
+            conn.executemany("INSERT INTO artifacts VALUES (?, ?, ?, ?, ?)", inserts)
+
+    def _by_last_access(self) -> List[Tuple[str, str, Set[str], int]]:
+        """Artifacts, least recently used first, with the runs that used them"""
+        with self._connect() as conn:
+            runs: Dict[str, Set[str]] = defaultdict(set)
+            for path, run_id in conn.execute("SELECT path, run_id FROM artifact_runs"):
+                runs[path].add(run_id)
+            return [
+                (path, kind, runs[path] | ({owner} if owner else set()), size)
+                for path, kind, owner, size in conn.execute(
+                    "SELECT path, kind, run_id, size FROM artifacts ORDER BY last_access"
+                )
+            ]
+
+    def _forget_runs(self, run_ids: List[str]) -> None:
+        """Drop the references of finished runs, except to their blobs (which
+        their checkpoints still reference)"""
+        with self._connect() as conn:
+            conn.executemany(
+                "DELETE FROM artifact_runs WHERE run_id = ? AND path NOT IN "
+                "(SELECT path FROM artifacts WHERE kind = 'blob')",
+                [(run_id,) for run_id in run_ids],
+            )
+
+    def _tracked_runs(self) -> Set[str]:
+        with self._connect() as conn:
+            return {
+                run_id for (run_id,) in conn.execute(
+                    "SELECT run_id FROM artifacts WHERE kind = 'run'"
+                )
+            }
+
+    def _exclusive_blobs(self, conn: sqlite3.Connection, run_id: str) -> List[Tuple[str, int]]:
+        """Blobs used by `run_id` and by no other tracked run, with their size"""
+        return conn.execute(
+            "SELECT a.path, a.size FROM artifacts a JOIN artifact_runs r ON r.path = a.path "
+            "WHERE a.kind = 'blob' AND r.run_id = ? AND NOT EXISTS ("
+            "  SELECT 1 FROM artifact_runs o JOIN artifacts t "
+            "  ON t.kind = 'run' AND t.run_id = o.run_id "
+            "  WHERE o.path = a.path AND o.run_id != ?)",
+            (run_id, run_id),
+        ).fetchall()
+
+    def fixed_usage(self) -> Dict[str, int]:
+        """Bytes of what is counted but not evicted: databases and trace files"""
+        usage = {name: database_bytes(path) for name, path in self.databases.items()}
+        usage["traces"] = sum(os.path.getsize(p) for p in tracer.export_files())
+        return usage
+
+    def _delete(self, path: str, kind: str) -> List[Tuple[str, int]]:
+        """Delete an artifact and what the databases hold for it; returns the
+        blobs deleted with it (those of an evicted run no other run uses)"""
+        key = os.path.splitext(os.path.basename(path))[0]
+        blobs: List[Tuple[str, int]] = []
+        if kind == "run":
+            with self._connect() as conn:
+                blobs = self._exclusive_blobs(conn, key)
+        for artifact_path in [path] + [blob_path for blob_path, _ in blobs]:
+            if os.path.isdir(artifact_path):
+                shutil.rmtree(artifact_path, ignore_errors=True)
+            elif os.path.exists(artifact_path):
+                os.remove(artifact_path)
+        if kind == "document":
+            # Its metadata, `<document_id>.json` next to it (see src/documents.py)
+            metadata_path = os.path.splitext(path)[0] + ".json"
+            if os.path.exists(metadata_path):
+                os.remove(metadata_path)
+        for hook in self._evict_hooks.get(kind, []):
+            try:
+                hook(key)
+            except Exception as e:
+                logger.warning(f"Could not delete the data of evicted {kind} {key}: {e}")
+        with self._connect() as conn:
+            for artifact_path in [path] + [blob_path for blob_path, _ in blobs]:
+                conn.execute("DELETE FROM artifacts WHERE path = ?", (artifact_path,))
+                conn.execute("DELETE FROM artifact_runs WHERE path = ?", (artifact_path,))
+            if kind == "run":
+                conn.execute("DELETE FROM artifact_runs WHERE run_id = ?", (key,))
+        return blobs
+
+    async def cleanup(self) -> Dict[str, int]:
+        """Sync the index and evict least recently used artifacts down to the
+        low watermark if usage exceeds the quota; returns what was done"""
+        await state_backend.purge_expired()
+        await asyncio.to_thread(self.sync)
+        artifacts = await asyncio.to_thread(self._by_last_access)
+        fixed = sum((await asyncio.to_thread(self.fixed_usage)).values())
+        files = sum(size for *_, size in artifacts)
+        usage = files + fixed
+        evicted = 0
+        statuses: Dict[str, Optional[str]] = {}
+        if usage > self.quota_bytes:
+            target = int(self.quota_bytes * LOW_WATERMARK)
+            tracked_runs = await asyncio.to_thread(self._tracked_runs)
+            deleted: Set[str] = set()
+            for path, kind, run_ids, size in artifacts:
+                if usage <= target:
+                    break
+                if path in deleted:
+                    continue  # a blob evicted with its run
+                if kind == "blob" and run_ids & tracked_runs:
+                    continue  # still referenced from a run's checkpoints
+                for run_id in run_ids - statuses.keys():
+                    statuses[run_id] = await run_manager.status(run_id)
+                if any(statuses[run_id] == "running" for run_id in run_ids):
+                    continue
+                blobs = await asyncio.to_thread(self._delete, path, kind)
+                if kind == "run":
+                    tracked_runs.discard(os.path.basename(path))
+                deleted.update(blob_path for blob_path, _ in blobs)
+                evicted += 1 + len(blobs)
+                files -= size + sum(blob_size for _, blob_size in blobs)
+                if self._evict_hooks.get(kind):
+                    # The hooks deleted database rows
+                    fixed = sum((await asyncio.to_thread(self.fixed_usage)).values())
+                usage = files + fixed
+            logger.info(
+                f"Evicted {evicted} artifacts, {usage / 2**20:.1f} MB "
+                f"of {self.quota_bytes / 2**20:.0f} MB used"
+            )
+        finished = [
+            run_id for run_id, status in statuses.items()
+            if status in FINISHED or (status or "").startswith("cancelled")
+        ]
+        if finished:
+            await asyncio.to_thread(self._forget_runs, finished)
+        return {"artifacts": len(artifacts) - evicted, "bytes": usage, "evicted": evicted}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT kind, COUNT(*), COALESCE(SUM(size), 0) FROM artifacts GROUP BY kind"
+            ).fetchall()
+        fixed = self.fixed_usage()
+        return {
+            "quota_bytes": self.quota_bytes,
+            "bytes": sum(size for _, _, size in rows) + sum(fixed.values()),
+            "kinds": {kind: {"artifacts": count, "bytes": size} for kind, count, size in rows},
+            "fixed": fixed,
+        }
+
+    def start(self) -> None:
+        self._loop_task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.cleanup()
+            except Exception as e:
+                logger.warning(f"Storage cleanup failed: {e}")
+            await asyncio.sleep(config.STORAGE_CLEANUP_INTERVAL)
+
+
+storage = StorageManager(
+    index_path=config.STORAGE_INDEX_DB,
+    runs_dir=config.RUNS_DIR,
+    documents_dir=config.DOCUMENTS_DIR,
+    blobs_dir=config.BLOBS_DIR,
+    legacy_root=config.LEGACY_PAGES_ROOT,
+    databases={
+        "checkpoints": config.CHECKPOINT_DB,
+        "state": config.STATE_DB,
+        "pages": config.PAGES_DB,
+        "search": config.SEARCH_INDEX_DB,
+        "precomputed": config.PRECOMPUTED_DB,
+        "storage_index": config.STORAGE_INDEX_DB,
+    },
+    quota_bytes=config.STORAGE_QUOTA_MB * 2**20,
+)
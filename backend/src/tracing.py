@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""Lightweight OpenTelemetry-style tracing of workflow runs
+tracing.py
+
+Each run is one trace (trace id = run id). Spans are opened with `span(...)`
+and nest through a context variable, so concurrent tasks spawned inside a
+span keep the right parent. Traces are kept in memory for the waterfall
+endpoint. Finished traces are also stored on the shared state backend (so
+every worker can serve them), appended to a JSONL file and optionally
+pushed to an OTLP/HTTP collector. The JSONL file is written off the event loop and
+rotated past TRACE_EXPORT_MAX_MB, keeping TRACE_EXPORT_BACKUPS old files.
+"""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from src.config import config
+from src.state_backend import StateBackend, state_backend
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Span:
+    """A timed operation within a run's trace"""
+
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    start_ns: int
+    end_ns: Optional[int] = None
+    status: str = "ok"
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Collects spans per trace and exports finished traces"""
+
+    def __init__(
+        self,
+        max_traces: int,
+        export_path: str,
+        export_max_bytes: int,
+        export_backups: int,
+        otlp_endpoint: str,
+        backend: Optional[StateBackend] = None,
+        shared_ttl: Optional[float] = None,
+    ):
+        self.max_traces = max_traces
+        self.export_path = export_path
+        self.export_max_bytes = export_max_bytes
+        self.export_backups = export_backups
+        self.otlp_endpoint = otlp_endpoint
+        self.backend = backend
+        self.shared_ttl = shared_ttl
+        self._traces: "OrderedDict[str, List[Span]]" = OrderedDict()
+        # Serializes the writer threads' appends and rotations
+        self._export_lock = threading.Lock()
+        self._background_tasks: set = set()
+
+    def _record(self, span: Span) -> None:
+        spans = self._traces.setdefault(span.trace_id, [])
+        spans.append(span)
+        self._traces.move_to_end(span.trace_id)
+        while len(self._traces) > self.max_traces:
+            self._traces.popitem(last=False)
+
+    def get_trace(self, trace_id: str) -> List[Span]:
+        return list(self._traces.get(trace_id, []))
+
+    async def load_trace(self, trace_id: str) -> List[Span]:
+        """Spans of a trace recorded by this process or, once finished, by any
+        other (e.g. a run executed on another worker)"""
+        spans = {s.span_id: s for s in self.get_trace(trace_id)}
+        if self.backend is not None:
+            try:
+                shared = await self.backend.get_json(f"trace:{trace_id}") or []
+            except Exception as e:
+                logger.warning(f"Could not load trace {trace_id}: {e}")
+                shared = []
+            for data in shared:
+                spans.setdefault(data["span_id"], Span(**data))
+        return sorted(spans.values(), key=lambda s: s.start_ns)
+
+    def finish_trace(self, trace_id: str) -> None:
+        """Export every span of a finished trace (in the background when
+        called from the event loop)"""
+        spans = self.get_trace(trace_id)
+        if not spans:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self.backend is not None and loop is not None:
+            self._spawn(loop, self._share(trace_id, spans))
+        if self.export_path:
+            if loop is None:
+                self._write(trace_id, spans)
+            else:
+                self._spawn(loop, asyncio.to_thread(self._write, trace_id, spans))
+        if self.otlp_endpoint and loop is not None:
+            self._spawn(loop, self._export_otlp(spans))
+
+    def _spawn(self, loop: asyncio.AbstractEventLoop, coro: Awaitable[None]) -> None:
+        task = loop.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def flush(self) -> None:
+        """Wait for the exports in progress (e.g. before closing the backend)"""
+        await asyncio.gather(*self._background_tasks, return_exceptions=True)
+
+    async def _share(self, trace_id: str, spans: List[Span]) -> None:
+        try:
+            await self.backend.set_json(
+                f"trace:{trace_id}", [asdict(s) for s in spans], ttl=self.shared_ttl
+            )
+        except Exception as e:
+            logger.warning(f"Could not store trace {trace_id}: {e}")
+
+    def _write(self, trace_id: str, spans: List[Span]) -> None:
+        lines = "".join(json.dumps(asdict(s), default=str) + "\n" for s in spans)
+        try:
+            with self._export_lock:
+                os.makedirs(os.path.dirname(self.export_path) or ".", exist_ok=True)
+                self._rotate()
+                with open(self.export_path, "a") as f:
+                    f.write(lines)
+        except OSError as e:
+            logger.warning(f"Could not write trace {trace_id}: {e}")
+
+    def _rotate(self) -> None:
+        """Shift `<path>` to `<path>.1` (and so on, dropping the oldest) once it
+        exceeds `export_max_bytes`"""
+        try:
+            if os.path.getsize(self.export_path) < self.export_max_bytes:
+                return
+        except FileNotFoundError:
+            return
+        for i in range(self.export_backups - 1, 0, -1):
+            if os.path.exists(f"{self.export_path}.{i}"):
+                os.replace(f"{self.export_path}.{i}", f"{self.export_path}.{i + 1}")
+        if self.export_backups:
+            os.replace(self.export_path, f"{self.export_path}.1")
+        else:
+            os.remove(self.export_path)
+
+    def export_files(self) -> List[str]:
+        """Export file and its rotated backups present on disk"""
+        if not self.export_path:
+            return []
+        paths = [self.export_path] + [
+            f"{self.export_path}.{i}" for i in range(1, self.export_backups + 1)
+        ]
+        return [p for p in paths if os.path.exists(p)]
+
+    async def _export_otlp(self, spans: List[Span]) -> None:
+        """Push spans to an OTLP/HTTP collector using the JSON encoding"""
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [_otlp_attribute("service.name", "motivate-me")]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": __name__},
+                            "spans": [_otlp_span(s) for s in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        try:
+            async with httpx.AsyncClient(timeout=5.0) as client:
+                response = await client.post(
+                    f"{self.otlp_endpoint.rstrip('/')}/v1/traces", json=payload
+                )
+                response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"OTLP export failed: {e}")
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_span(s: Span) -> Dict[str, Any]:
+    return {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "parentSpanId": s.parent_id or "",
+        "name": s.name,
+        "kind": 1,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns or s.start_ns),
+        "attributes": [_otlp_attribute(k, v) for k, v in s.attributes.items()],
+        "status": {"code": 1 if s.status == "ok" else 2},
+    }
+
+
+tracer = Tracer(
+    max_traces=config.TRACE_MAX_RUNS,
+    export_path=config.TRACE_EXPORT_PATH,
+    export_max_bytes=config.TRACE_EXPORT_MAX_MB * 2**20,
+    export_backups=config.TRACE_EXPORT_BACKUPS,
+    otlp_endpoint=config.OTLP_ENDPOINT,
+    backend=state_backend,
+    shared_ttl=config.TRACE_SHARED_TTL,
+)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    parent = _current_span.get()
+    return parent.trace_id if parent else None
+
+
+@contextmanager
+def span(name: str, trace_id: Optional[str] = None, **attributes):
+    """Open a span as a child of the current one (or as a trace root)"""
+    parent = _current_span.get()
+    trace_id = trace_id or (parent.trace_id if parent else None)
+    if trace_id is None:
+        # Not inside a traced run: nothing to attach the span to
+        yield None
+        return
+
+    s = Span(
+        trace_id=trace_id,
+        span_id=secrets.token_hex(8),
+        parent_id=parent.span_id if parent and parent.trace_id == trace_id else None,
+        name=name,
+        start_ns=time.time_ns(),
+        attributes=dict(attributes),
+    )
+    tracer._record(s)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.status = type(e).__name__
+        raise
+    finally:
+        s.end_ns = time.time_ns()
+        _current_span.reset(token)
+
+
+def node_of(s: Optional[Span]) -> Optional[str]:
+    """Name of the graph node a span belongs to, if any"""
+    by_id = {x.span_id: x for x in tracer.get_trace(s.trace_id)} if s else {}
+    while s is not None:
+        if s.name.startswith("node."):
+            return s.name[len("node."):]
+        s = by_id.get(s.parent_id)
+    return None
+
+
+def trace_node(name: str, node: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Wrap a LangGraph node so it runs inside a span named after it"""
+
+    @functools.wraps(node)
+    async def wrapper(state, *args, **kwargs):
+        with span(f"node.{name}", trace_id=state.get("uuid")) as s:
+            result = await node(state, *args, **kwargs)
+            if s is not None and isinstance(result, dict) and result.get("error"):
+                s.status = "error"
+            return result
+
+    return wrapper
+
+
+def waterfall(trace_id: str, spans: Optional[List[Span]] = None) -> List[Dict[str, Any]]:
+    """Spans of a trace (by default those recorded by this process) ordered
+    by start, with offsets relative to the root"""
+    spans = tracer.get_trace(trace_id) if spans is None else spans
+    if not spans:
+        return []
+    by_id = {s.span_id: s for s in spans}
+    origin = min(s.start_ns for s in spans)
+
+    def depth(s: Span) -> int:
+        level = 0
+        while s.parent_id and s.parent_id in by_id:
+            s = by_id[s.parent_id]
+            level += 1
+        return level
+
+    return [
+        {
+            "name": s.name,
+            "span_id": s.span_id,
+            "parent_id": s.parent_id,
+            "depth": depth(s),
+            "offset_ms": round((s.start_ns - origin) / 1e6, 1),
+            "duration_ms": round(s.duration_ms, 1),
+            "in_progress": s.end_ns is None,
+            "status": s.status,
+            "attributes": s.attributes,
+        }
+        for s in sorted(spans, key=lambda s: s.start_ns)
+    ]
+
+
+def render_waterfall(rows: List[Dict[str, Any]], width: int = 60) -> str:
+    """Render waterfall rows as a fixed-width text chart"""
+    if not rows:
+        return ""
+    total = max(r["offset_ms"] + r["duration_ms"] for r in rows) or 1.0
+    lines = []
+    for r in rows:
+        start = int(r["offset_ms"] / total * width)
+        length = max(1, int(r["duration_ms"] / total * width))
+        label = ("  " * r["depth"] + r["name"])[:40]
+        bar = " " * start + "█" * length
+        lines.append(f"{label:<40} |{bar:<{width}}| {r['duration_ms']:>9.1f} ms")
+    return "\n".join(lines)
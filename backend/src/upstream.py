@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Single entry point for calls to the Mistral API, shared by all agents
+upstream.py
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Dict, List, Optional, Type
+
+from pydantic import BaseModel
+
+from src.cache import cached
+from src.config import config
+from src.metrics import LLM_OUTPUTS, MODEL_ROUTES, record_llm_usage, track_upstream
+from src.routing import Route, model_router, should_degrade
+from src.scheduler import upstream_scheduler
+from src.singleflight import SingleFlight, flight_key
+from src.schemas import OutputError, parse_output
+from src.tracing import span
+
+logger = logging.getLogger(__name__)
+
+_chat_flights = SingleFlight("mistral_chat")
+
+
+async def mistral_chat(
+    client: Any,
+    *,
+    agent: str,
+    messages: List[Dict[str, Any]],
+    model: Optional[str] = None,
+    attributes: Optional[Dict[str, Any]] = None,
+    **kwargs,
+) -> Any:
+    """Call `client.chat.complete_async` and record latency, status and token usage
+
+    The async SDK call keeps the event loop free and lets run cancellation
+    abort the request in flight. Each attempt waits for a slot of the
+    upstream scheduler first. Without an explicit `model`, the model is
+    chosen by the router from the agent's tiers, and a failed call fails over
+    to the next tier. `attributes` are attached to each attempt's trace span
+    (e.g. concept, application).
+    """
+    route = Route(models=[model], reason="pinned") if model else model_router.route(agent)
+    reason = route.reason
+    for attempt, model in enumerate(route.models):
+        MODEL_ROUTES.labels(agent=agent, model=model, reason=reason).inc()
+        # Time queued for a slot is not the model's latency
+        async with upstream_scheduler.slot("mistral"):
+            start = time.perf_counter()
+            try:
+                with span(
+                    "mistral.chat", agent=agent, model=model, route=reason, **(attributes or {})
+                ) as s:
+                    async with track_upstream("mistral", "chat.complete"):
+                        response = await client.chat.complete_async(
+                            model=model, messages=messages, **kwargs
+                        )
+                    record_llm_usage(agent, model, response)
+                    usage = getattr(response, "usage", None)
+                    if s is not None and usage is not None:
+                        s.set_attribute("prompt_tokens", getattr(usage, "prompt_tokens", 0))
+                        s.set_attribute("completion_tokens", getattr(usage, "completion_tokens", 0))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                model_router.record(agent, model, time.perf_counter() - start, ok=False)
+                if attempt + 1 == len(route.models):
+                    raise
+                logger.warning(f"{agent} call on {model} failed ({e}), failing over")
+                reason = "failover"
+                continue
+        model_router.record(agent, model, time.perf_counter() - start, ok=True)
+        return response
+
+
+async def mistral_chat_json(
+    client: Any,
+    *,
+    agent: str,
+    messages: List[Dict[str, Any]],
+    schema: Type[BaseModel],
+    many: bool = False,
+    cache: Optional[str] = None,
+    **kwargs,
+) -> Any:
+    """Call `mistral_chat` and return its reply validated against `schema`
+    (a list of dicts with `many`, else a dict)
+
+    Defective replies are repaired locally first (see src/schemas.py); the
+    model is asked again, with the validation error, only if nothing usable
+    is left.
+
+    Identical concurrent calls (same agent, messages and options) share one
+    upstream call. With `cache` (a CACHE_TTLS name), replies are also kept in
+    that cache across runs and workers (see src/cache.py).
+
+    Raises:
+        OutputError: If the reply is still invalid after the re-asks
+    """
+    # Span attributes do not change the reply
+    key = flight_key(agent, messages, schema.__name__, many, {
+        k: v for k, v in kwargs.items() if k != "attributes"
+    })
+
+    def fetch() -> Awaitable[Any]:
+        return _chat_flights.do(
+            key,
+            lambda: _mistral_chat_json(
+                client, agent=agent, messages=messages, schema=schema, many=many, **kwargs
+            ),
+        )
+
+    if cache is None:
+        return await fetch()
+    return await cached(cache, key, fetch)
+
+
+async def _mistral_chat_json(
+    client: Any,
+    *,
+    agent: str,
+    messages: List[Dict[str, Any]],
+    schema: Type[BaseModel],
+    many: bool,
+    **kwargs,
+) -> Any:
+    reasks = 0
+    while True:
+        response = await mistral_chat(client, agent=agent, messages=messages, **kwargs)
+        content = response.choices[0].message.content
+        try:
+            result, repaired = parse_output(content, schema, many=many)
+        except OutputError as e:
+            if reasks >= config.LLM_OUTPUT_MAX_REASKS or should_degrade("cached_results"):
+                LLM_OUTPUTS.labels(agent=agent, outcome="invalid").inc()
+                raise
+            logger.warning(f"Invalid {agent} output ({e}), asking again")
+            reasks += 1
+            messages = messages + [
+                {"role": "assistant", "content": content},
+                {
+                    "role": "user",
+                    "content": f"Your answer was not valid ({e}). Reply with the corrected JSON only.",
+                },
+            ]
+            continue
+        outcome = "reasked" if reasks else "repaired" if repaired else "valid"
+        LLM_OUTPUTS.labels(agent=agent, outcome=outcome).inc()
+        return result
+
+
+async def mistral_upload_document(client: Any, document_path: str) -> str:
+    """Upload a document for OCR and return a signed URL to reference it"""
+    with span("mistral.upload", document=document_path):
+        content = await asyncio.to_thread(_read_bytes, document_path)
+        async with upstream_scheduler.slot("mistral"), track_upstream("mistral", "files.upload"):
+            uploaded = await client.files.upload_async(
+                file={"file_name": document_path, "content": content},
+                purpose="ocr",
+            )
+        async with track_upstream("mistral", "files.get_signed_url"):
+            signed_url = await client.files.get_signed_url_async(file_id=uploaded.id)
+    return signed_url.url
+
+
+async def mistral_ocr(client: Any, document: Dict[str, Any]) -> List[str]:
+    """OCR a document (a `document_url` or `image_url` chunk) into markdown, one string per page"""
+    with span("mistral.ocr", model=config.OCR_MODEL) as s:
+        async with upstream_scheduler.slot("mistral"), track_upstream("mistral", "ocr.process"):
+            response = await client.ocr.process_async(model=config.OCR_MODEL, document=document)
+        pages = [page.markdown for page in sorted(response.pages, key=lambda p: p.index)]
+        if s is not None:
+            s.set_attribute("pages", len(pages))
+    return pages
+
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
@@ -3,13 +3,21 @@ from typing import Dict, List, Any
 
 import httpx
 
+from src.cache import cached
 from src.config import config
+from src.metrics import track_upstream
+from src.scheduler import upstream_scheduler
+from src.tracing import span
 
 logger = logging.getLogger(__name__)
 
 
 async def search_google_images(query: str) -> List[Dict[str, Any]]:
-    """Search for images using Google Custom Search API"""
+    """Search for images using Google Custom Search API, cached across workers"""
+    return await cached("google_images", query, lambda: _search_google_images(query))
+
+
+async def _search_google_images(query: str) -> List[Dict[str, Any]]:
     try:
         url = "https://www.googleapis.com/customsearch/v1"
         params = {
@@ -21,9 +29,13 @@ async def search_google_images(query: str) -> List[Dict[str, Any]]:
             "num": config.MAX_IMAGE_RESULTS,
         }
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params)
-            response.raise_for_status()
+        with span("google.image_search", query=query) as s:
+            async with upstream_scheduler.slot("google"), httpx.AsyncClient() as client, track_upstream(
+                "google", "customsearch.images"
+            ) as upstream:
+                response = await client.get(url, params=params)
+                upstream["status"] = response.status_code
+                response.raise_for_status()
 
             data = response.json()
             images = []
@@ -39,9 +51,20 @@ async def search_google_images(query: str) -> List[Dict[str, Any]]:
                         "height": item.get("image", {}).get("height"),
                     }
                 )
+            if s is not None:
+                s.set_attribute("results", len(images))
 
             return images
 
     except Exception as e:
         logger.error(f"Error searching images for '{query}': {e}")
         return []
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of `values`"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
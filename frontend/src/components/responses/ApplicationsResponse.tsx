@@ -1,6 +1,7 @@
 
 import { Message, ApplicationData } from "@/types/chat";
 import { cn } from "@/lib/utils";
+import { APIService } from "@/services/apiService";
 import {
   Carousel,
   CarouselContent,
@@ -57,7 +58,8 @@ const ApplicationsResponse = ({ message, onApplicationClick }: ApplicationsRespo
                     <div className="mt-4">
                       <div className="relative group rounded-lg overflow-hidden bg-white">
                         <img
-                          src={application.images[0].url}
+                          src={APIService.getInstance().imageUrl(application.images[0].url)}
+                          loading="lazy"
                           alt={application.images[0].title}
                           className="w-full h-48 object-cover rounded-lg"
                         />
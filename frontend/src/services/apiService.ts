@@ -7,6 +7,19 @@ export class APIService {
     private pollingInterval: NodeJS.Timeout | null = null;
     private lastTimestamps = { concepts: 0, applications: 0 };
     private lastApplicationsData: Record<string, any[]> = {};
+    // Blobs are immutable, each one is fetched once
+    private blobCache = new Map<string, Promise<any>>();
+    // Identifies this browser tab, the backend cancels our previous run when we submit a new one
+    private clientId: string = APIService.loadClientId();
+
+    private static loadClientId(): string {
+        let clientId = sessionStorage.getItem('motivaty-client-id');
+        if (!clientId) {
+            clientId = crypto.randomUUID();
+            sessionStorage.setItem('motivaty-client-id', clientId);
+        }
+        return clientId;
+    }
 
     static getInstance(): APIService {
         if (!APIService.instance) {
@@ -21,14 +34,26 @@ export class APIService {
             'user_query': content
         });
 
+        // Upload the document first, the backend streams it to disk and returns its id
+        let documentId = '';
+        if (file) {
+            try {
+                documentId = await this.uploadDocument(file);
+            } catch (error) {
+                console.error("Document upload error:", error);
+            }
+        }
+
         // Start the workflow (don't wait for completion)
         fetch(`${BACKEND_URL}/run_workflow/`, {
             method: "POST",
             headers: {
-                "Content-Type": "application/json"
+                "Content-Type": "application/json",
+                "X-Client-Id": this.clientId
             },
             body: JSON.stringify({
                 'file_name': file?.name || '',
+                'document_id': documentId,
                 'user_query': content
             })
         }).catch(error => {
@@ -40,6 +65,23 @@ export class APIService {
         this.lastApplicationsData = {};
     }
 
+    private async uploadDocument(file: File): Promise<string> {
+        const formData = new FormData();
+        formData.append('file', file);
+
+        const response = await fetch(`${BACKEND_URL}/upload_document/`, {
+            method: "POST",
+            body: formData
+        });
+
+        if (!response.ok) {
+            throw new Error(`Failed to upload document: ${response.status}`);
+        }
+
+        const result = await response.json();
+        return result.data.document_id;
+    }
+
     startPolling(
         onConceptsUpdate: (concepts: any[], timestamp: number) => void,
         onApplicationsUpdate: (applications: Record<string, any[]>, timestamp: number) => void
@@ -142,6 +184,25 @@ export class APIService {
         }
     }
 
+    // Concepts, applications and roadmap items of past runs, from the backend's full-text index
+    async search(query: string, kind?: 'concept' | 'application' | 'roadmap_item', limit = 20): Promise<any[]> {
+        const params = new URLSearchParams({ q: query, limit: String(limit) });
+        if (kind) {
+            params.set('kind', kind);
+        }
+        const response = await fetch(`${BACKEND_URL}/search?${params}`);
+        if (!response.ok) {
+            throw new Error(`Search failed: ${response.status}`);
+        }
+        const result = await response.json();
+        return result.data;
+    }
+
+    // Image URLs are served by the backend's image proxy (`/images/<id>/<size>`)
+    imageUrl(url: string): string {
+        return url.startsWith('/') ? `${BACKEND_URL}${url}` : url;
+    }
+
     private async fetchData(): Promise<{ status: string; data?: any; message?: string }> {
         const response = await fetch(`${BACKEND_URL}/get_workflow_state/`);
 
@@ -149,6 +210,41 @@ export class APIService {
             throw new Error("Failed to fetch data");
         }
 
-        return await response.json();
+        const result = await response.json();
+        // Roadmaps, images and descriptions come as {"$blob": id} references
+        result.data = await this.resolveBlobs(result.data);
+        return result;
+    }
+
+    private async resolveBlobs(value: any): Promise<any> {
+        if (Array.isArray(value)) {
+            return Promise.all(value.map(item => this.resolveBlobs(item)));
+        }
+        if (value && typeof value === 'object') {
+            const keys = Object.keys(value);
+            if (keys.length === 1 && typeof value.$blob === 'string') {
+                return this.resolveBlobs(await this.fetchBlob(value.$blob));
+            }
+            const entries = await Promise.all(
+                keys.map(async key => [key, await this.resolveBlobs(value[key])] as const)
+            );
+            return Object.fromEntries(entries);
+        }
+        return value;
+    }
+
+    private fetchBlob(blobId: string): Promise<any> {
+        let blob = this.blobCache.get(blobId);
+        if (!blob) {
+            blob = fetch(`${BACKEND_URL}/blobs/${blobId}`).then(response => {
+                if (!response.ok) {
+                    throw new Error(`Failed to fetch blob: ${response.status}`);
+                }
+                return response.json();
+            });
+            blob.catch(() => this.blobCache.delete(blobId));
+            this.blobCache.set(blobId, blob);
+        }
+        return blob;
     }
 }
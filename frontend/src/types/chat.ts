@@ -44,6 +44,7 @@ export interface ApplicationImage {
   url: string;
   title: string;
   thumbnail: string;
+  source_url?: string;
   context: string;
   width: number;
   height: number;